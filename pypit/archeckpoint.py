@@ -0,0 +1,194 @@
+""" Checkpoints of the stages of the reduction of the science exposures,
+so that an interrupted reduction can be resumed (run resume)
+"""
+from __future__ import (print_function, absolute_import, division, unicode_literals)
+
+import hashlib
+import json
+import os
+import pickle
+
+from pypit import armasters
+from pypit import armsgs
+from pypit import arparse as settings
+from pypit import pyputils
+
+# Logging
+msgs = armsgs.get_logger()
+
+# The stages that are checkpointed: the sky model and object traces of each
+# detector, the extractions of each detector, and the sensitivity function
+checkpoint_stages = ['skymodel', 'objtrace', 'extraction', 'sensfunc']
+
+# The ScienceExposure attributes (indexed by detector) that hold the
+# products of the reduction of a science frame
+science_products = ['_sciframe', '_rawvarframe', '_modelvarframe', '_bgframe', '_scimask',
+                    '_scitrace', '_specobjs', '_wvcalib']
+
+
+def checkpoint_name(slf, stage, det=None):
+    """ Name of the file holding a checkpoint
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    stage : str
+      One of checkpoint_stages, or None for the marker of a completed exposure
+    det : int, optional
+      Detector index (starting from 1)
+
+    Returns
+    -------
+    name : str
+    """
+    name = "{0:s}/checkpoints/{1:s}".format(settings.argflag['run']['directory']['science'],
+                                            slf._basename.replace(":", "_"))
+    if stage is None:
+        return name + '.done'
+    name += '_' + stage
+    if det is not None:
+        name += '_' + settings.get_dnum(det)
+    return name + '.pkl'
+
+
+def checkpoint_key(slf):
+    """ The key of the checkpoints of a science exposure
+
+    This is the md5 hash of the checksums of the raw science and standard
+    frames, the keys of the master frames used to reduce the science frame
+    on each detector (see armasters.master_key), the settings of the
+    reduction and the PYPIT version. A checkpoint is only used if its key
+    matches the one for the current reduction.
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+
+    Returns
+    -------
+    key : str
+    """
+    fitsdict = slf._fitsdict
+    files = [armasters.file_checksum(fitsdict['directory'][i]+fitsdict['filename'][i])
+             for i in list(slf._idx_sci) + list(slf._idx_std)]
+    masters = [[armasters.master_key(slf, ftype, det+1, provenance=True) for ftype in ['bias', 'normpixelflat', 'wave']]
+               for det in range(settings.spect['mosaic']['ndet'])]
+    reduce = dict([(key, value) for key, value in settings.argflag['reduce'].items() if key != 'masters'])
+    inputs = dict(files=files, masters=masters, version=pyputils.get_version()[0],
+                  settings=dict(reduce=reduce, science=settings.argflag['science'],
+                                trace=settings.argflag['trace']['object']))
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def save_checkpoint(slf, stage, det, data):
+    """ Save a checkpoint (with 'run checkpoint True')
+
+    The checkpoint is written to a temporary file that is then renamed,
+    and is only complete once its marker (a .done file holding the key
+    of the checkpoint) has been written.
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    stage : str
+      One of checkpoint_stages
+    det : int or None
+      Detector index (starting from 1)
+    data : dict
+      The products of the stage
+    """
+    if not settings.argflag['run']['checkpoint']:
+        return
+    name = checkpoint_name(slf, stage, det)
+    if not os.path.exists(os.path.dirname(name)):
+        os.makedirs(os.path.dirname(name))
+    key = checkpoint_key(slf)
+    tmpname = name + '.tmp'
+    with open(tmpname, 'wb') as f:
+        pickle.dump(dict(key=key, data=data), f, protocol=2)
+    os.rename(tmpname, name)
+    with open(name + '.done', 'w') as f:
+        f.write(key)
+    return
+
+
+def load_checkpoint(slf, stage, det):
+    """ Load a checkpoint, when resuming a reduction (run resume)
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    stage : str
+      One of checkpoint_stages
+    det : int or None
+      Detector index (starting from 1)
+
+    Returns
+    -------
+    data : dict or None
+      The products of the stage, or None if there is no complete and up to
+      date checkpoint
+    """
+    if not settings.argflag['run']['resume']:
+        return None
+    name = checkpoint_name(slf, stage, det)
+    if not os.path.exists(name + '.done'):
+        return None
+    with open(name, 'rb') as f:
+        checkpoint = pickle.load(f)
+    if checkpoint['key'] != checkpoint_key(slf):
+        msgs.warn("The {0:s} checkpoint is out of date (the raw frames, master frames".format(stage) +
+                  msgs.newline() + "or settings have changed) -- it will be recomputed")
+        return None
+    msgs.info("Resuming from the {0:s} checkpoint {1:s}".format(stage, name))
+    return checkpoint['data']
+
+
+def exposure_done(slf):
+    """ Has this science exposure already been reduced, when resuming
+    a reduction (run resume)?
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+
+    Returns
+    -------
+    done : bool
+    """
+    if not settings.argflag['run']['resume']:
+        return False
+    name = checkpoint_name(slf, None)
+    if not os.path.exists(name):
+        return False
+    with open(name, 'r') as f:
+        key = f.read()
+    return key == checkpoint_key(slf)
+
+
+def mark_exposure_done(slf):
+    """ Mark this science exposure as reduced, and remove the checkpoints
+    of its stages, which are no longer needed
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    """
+    name = checkpoint_name(slf, None)
+    if not os.path.exists(os.path.dirname(name)):
+        os.makedirs(os.path.dirname(name))
+    with open(name, 'w') as f:
+        f.write(checkpoint_key(slf))
+    for stage in checkpoint_stages:
+        for det in [None] + list(range(1, settings.spect['mosaic']['ndet']+1)):
+            for ckname in [checkpoint_name(slf, stage, det), checkpoint_name(slf, stage, det)+'.done']:
+                if os.path.exists(ckname):
+                    os.remove(ckname)
+    return
@@ -2,19 +2,21 @@ from __future__ import (print_function, absolute_import, division, unicode_liter
 
 import numpy as np
 from pypit import armsgs
+from pypit import arutils
 from pypit import arparse as settings
 
 # Logging
 msgs = armsgs.get_logger()
 
 
-def comb_frames(frames_arr, det, frametype, weights=None, maskvalue=1048577, printtype=None):
+def comb_frames(frames_arr, det, frametype, weights=None, maskvalue=1048577, printtype=None, dtype=np.float64):
     """ Combine several frames
 
     Parameters
     ----------
-    frames_arr : ndarray (3D)
-      Array of frames to be combined
+    frames_arr : ndarray (3D) or arload.RawFrameStack
+      Array of frames to be combined. The frames are combined in
+      strips of rows, set by 'reduce combine tilesize'.
     det : int
       Detector index
     frametype : str
@@ -25,9 +27,10 @@ def comb_frames(frames_arr, det, frametype, weights=None, maskvalue=1048577, pri
       What should the masked values be set to (should be greater than the detector's saturation value -- Default = 1 + 2**20)
     printtype : str (optional)
       The frame type string that should be printed by armsgs. If None, frametype will be used
+    dtype : numpy type (optional)
+      Type of the combined frame. The frames are combined in the precision of
+      frames_arr, which is float32 if 'reduce precision' is 'single'.
     """
-    from pypit import arcycomb
-    dnum = settings.get_dnum(det)
     reject = settings.argflag[frametype]['combine']['reject']
     method = settings.argflag[frametype]['combine']['method']
     ###########
@@ -39,11 +42,13 @@ def comb_frames(frames_arr, det, frametype, weights=None, maskvalue=1048577, pri
     # Check the number of frames
     if frames_arr is None:
         msgs.error("No '{0:s}' frames were given to comb_frames to combine".format(printtype))
-    (sz_x, sz_y, num_frames) = np.shape(frames_arr)
+    (sz_x, sz_y, num_frames) = frames_arr.shape
     if num_frames == 1:
         msgs.info("Only one frame to combine!")
         msgs.info("Returning input frame")
-        return frames_arr[:, :, 0]
+        if isinstance(frames_arr, np.ndarray):
+            return frames_arr[:, :, 0].astype(dtype, copy=False)
+        return frames_arr.read_rows(0, sz_x)[:, :, 0].astype(dtype, copy=False)
     else:
         msgs.info("Combining {0:d} {1:s} frames".format(num_frames, printtype))
     # Check if the user has allowed the combination of long and short frames (e.g. different exposure times)
@@ -56,35 +61,133 @@ def comb_frames(frames_arr, det, frametype, weights=None, maskvalue=1048577, pri
     # Check that some information on the frames was supplied
     if settings.spect is None:
         msgs.error("When combining the {0:s} frames, spectrograph information".format(printtype)+msgs.newline()+"was not provided")
+    ##############
+    # Combine the frames, one strip of rows at a time
+    tilesize = settings.argflag['reduce']['combine']['tilesize']
+    if tilesize > 0:
+        nrows = tile_rows(sz_y, num_frames, maxmem=tilesize*2**20, itemsize=np.dtype(frames_arr.dtype).itemsize)
+    else:
+        nrows = sz_x
+    comb_arr = comb_tiles(frames_arr, det, frametype, nrows, maskvalue=maskvalue)
+    ##############
+    # And return a 2D numpy array
+    msgs.info("{0:d} {1:s} frames combined successfully!".format(num_frames, printtype))
+    # Make sure the returned array is the correct type
+    comb_arr = comb_arr.astype(dtype, copy=False)
+    return comb_arr
+
+
+def comb_tiles(frames_arr, det, frametype, nrows, maskvalue=1048577):
+    """ Combine a stack of frames in strips of rows
+
+    Only one strip of the stack (and the temporary arrays needed to
+    reject pixels in it) is in memory for each worker thread. The
+    strips are combined on a pool of 'run ncpus' threads; any cores
+    left over are used by the arcycomb kernels of each strip.
+
+    Parameters
+    ----------
+    frames_arr : ndarray (3D) or arload.RawFrameStack
+      Array of frames to be combined
+    det : int
+      Detector index
+    frametype : str
+      What is the type of frame being combining?
+    nrows : int
+      Number of rows in each strip
+    maskvalue : int (optional)
+      What should the masked values be set to
+
+    Returns
+    -------
+    comb_arr : ndarray (2D)
+      The combined frame
+    """
+    (sz_x, sz_y, num_frames) = frames_arr.shape
+    strips = [(x0, min(x0+nrows, sz_x)) for x0 in range(0, sz_x, nrows)]
+    comb_arr = np.zeros((sz_x, sz_y), dtype=frames_arr.dtype)
+
+    def comb_strip(strip):
+        x0, x1 = strip
+        if isinstance(frames_arr, np.ndarray):
+            block = frames_arr[x0:x1, :, :]
+        else:
+            block = frames_arr.read_rows(x0, x1)
+        comb_arr[x0:x1, :] = comb_block(block, det, frametype, maskvalue=maskvalue, verbose=(x0 == 0),
+                                        nthreads=nkernel)
+
+    # Share the cores between the strips and the (nogil) kernels that combine each strip
+    ncpus = max(1, settings.argflag['run']['ncpus'])
+    nthread = min(ncpus, len(strips))
+    nkernel = max(1, ncpus // nthread)
+    if len(strips) > 1:
+        msgs.info("Combining the frames in {0:d} strips of {1:d} rows with {2:d} threads".format(
+            len(strips), nrows, nthread))
+    arutils.thread_map(comb_strip, strips, nthread)
+    return comb_arr
+
+
+def comb_block(frames_arr, det, frametype, maskvalue=1048577, verbose=True, nthreads=1):
+    """ Reject pixels and combine a (block of a) stack of frames
+
+    Every operation is performed pixel by pixel, so combining a stack
+    in tiles gives an identical result to combining the whole stack.
+
+    Parameters
+    ----------
+    frames_arr : ndarray (3D)
+      Array of frames to be combined
+    det : int
+      Detector index
+    frametype : str
+      What is the type of frame being combining?
+    maskvalue : int (optional)
+      What should the masked values be set to
+    verbose : bool (optional)
+      Print out the steps being performed
+    nthreads : int (optional)
+      Number of threads used by the arcycomb kernels
+
+    Returns
+    -------
+    comb_arr : ndarray (2D)
+      The combined frame
+    """
+    from pypit import arcycomb
+    dnum = settings.get_dnum(det)
+    reject = settings.argflag[frametype]['combine']['reject']
+    method = settings.argflag[frametype]['combine']['method']
+    (sz_x, sz_y, num_frames) = np.shape(frames_arr)
+
     # Calculate the values to be used if all frames are rejected in some pixels
     if reject['replace'] == 'min':
-        allrej_arr = arcycomb.minmax(frames_arr, 0)
+        allrej_arr = arcycomb.minmax(frames_arr, 0, nthreads=nthreads)
     elif reject['replace'] == 'max':
-        allrej_arr = arcycomb.minmax(frames_arr, 1)
+        allrej_arr = arcycomb.minmax(frames_arr, 1, nthreads=nthreads)
     elif reject['replace'] == 'mean':
-        allrej_arr = arcycomb.mean(frames_arr)
+        allrej_arr = arcycomb.mean(frames_arr, nthreads=nthreads)
     elif reject['replace'] == 'median':
-        allrej_arr = arcycomb.median(frames_arr)
+        allrej_arr = arcycomb.median(frames_arr, nthreads=nthreads)
     elif reject['replace'] == 'weightmean':
-        msgs.work("No weights are implemented yet")
-        allrej_arr = arcycomb.masked_weightmean(frames_arr, maskvalue)
+        if verbose: msgs.work("No weights are implemented yet")
+        allrej_arr = arcycomb.masked_weightmean(frames_arr, maskvalue, nthreads=nthreads)
     elif reject['replace'] == 'maxnonsat':
-        allrej_arr = arcycomb.maxnonsat(frames_arr, settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear'])
+        allrej_arr = arcycomb.maxnonsat(frames_arr, settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear'], nthreads=nthreads)
     else:
         msgs.error("You must specify what to do in case all pixels are rejected")
     ################
     # Saturated Pixels
-    msgs.info("Finding saturated and non-linear pixels")
+    if verbose: msgs.info("Finding saturated and non-linear pixels")
     if settings.argflag[frametype]['combine']['satpix'] == 'force':
         # If a saturated pixel is in one of the frames, force them to all have saturated pixels
 #		satw = np.zeros_like(frames_arr)
 #		satw[np.where(frames_arr > settings.spect['det']['saturation']*settings.spect['det']['nonlinear'])] = 1.0
 #		satw = np.any(satw,axis=2)
-        setsat = arcycomb.masked_limitget(frames_arr, settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear'], 2)
+        setsat = np.any(frames_arr > settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear'], axis=2)
 #		del satw
     elif settings.argflag[frametype]['combine']['satpix'] == 'reject':
         # Ignore saturated pixels in frames if possible
-        frames_arr = arcycomb.masked_limitset(frames_arr, settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear'], 2, maskvalue)
+        frames_arr = arcycomb.masked_limitset(frames_arr, settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear'], 2, maskvalue, nthreads=nthreads)
     elif settings.argflag[frametype]['combine']['satpix'] == 'nothing':
         # Don't do anything special for saturated pixels (Hopefully the user has specified how to deal with them below!)
         pass
@@ -95,80 +198,68 @@ def comb_frames(frames_arr, det, frametype, weights=None, maskvalue=1048577, pri
     ################
     # Cosmic Rays
     if reject['cosmics'] > 0.0:
-        msgs.info("Rejecting cosmic rays")  # Use a robust statistic
-        medarr = arcycomb.masked_median(frames_arr, maskvalue)
-        stdarr = 1.4826*arcycomb.masked_median(np.abs(frames_arr-medarr[:, :, np.newaxis]), maskvalue)
-        frames_arr = arcycomb.masked_limitsetarr(frames_arr, (medarr + reject['cosmics']*stdarr), 2, maskvalue)
-        # Delete unecessary arrays
-        del medarr, stdarr
+        if verbose: msgs.info("Rejecting cosmic rays")  # Use a robust statistic
+        frames_arr = arcycomb.masked_levelclip(frames_arr, -1.0, reject['cosmics'], maskvalue, nthreads=nthreads)
     else:
-        msgs.info("Not rejecting cosmic rays")
+        if verbose: msgs.info("Not rejecting cosmic rays")
     ################
     # Low and High pixel rejection --- Masks *additional* pixels
-    rejlo, rejhi = reject['lowhigh']
     if reject['lowhigh'][0] > 0 or reject['lowhigh'][1] > 0:
-        # First reject low pixels
-        frames_arr = np.sort(frames_arr, axis=2)
-        if reject['lowhigh'][0] > 0:
-            msgs.info("Rejecting {0:d} deviant low pixels".format(reject['lowhigh'][0]))
-            while rejlo > 0:
-                xi, yi = np.indices(sz_x, sz_y)
-                frames_arr[xi, yi, np.argmin(frames_arr, axis=2)] = maskvalue
-                del xi, yi
-                rejlo -= 1
-        # Now reject high pixels
-        if reject['lowhigh'][1] > 0:
-            msgs.info("Rejecting {0:d} deviant high pixels".format(reject['lowhigh'][1]))
-            frames_arr[np.where(frames_arr == maskvalue)] *= -1
-            while rejhi > 0:
-                xi, yi = np.indices(sz_x, sz_y)
-                frames_arr[xi, yi, np.argmax(frames_arr, axis=2)] = -maskvalue
-                del xi, yi
-                rejhi -= 1
-            frames_arr[np.where(frames_arr) == -maskvalue] *= -1
-# The following is an example of *not* masking additional pixels
-#		if reject['lowhigh'][1] > 0:
-#			msgs.info("Rejecting {0:d} deviant high pixels".format(reject['lowhigh'][1]))
-#			masktemp[:,:,-reject['lowhigh'][0]:] = True
+        if verbose: msgs.info("Rejecting {0:d} deviant low and {1:d} deviant high pixels".format(
+            reject['lowhigh'][0], reject['lowhigh'][1]))
+        frames_arr = arcycomb.masked_lowhigh(frames_arr, reject['lowhigh'][0], reject['lowhigh'][1], maskvalue,
+                                             nthreads=nthreads)
     else:
-        msgs.info("Not rejecting any low/high pixels")
+        if verbose: msgs.info("Not rejecting any low/high pixels")
     ################
     # Deviant Pixels
     if reject['level'][0] > 0.0 or reject['level'][1] > 0.0:
-        msgs.info("Rejecting deviant pixels")  # Use a robust statistic
-        medarr = arcycomb.masked_median(frames_arr, maskvalue)
-        stdarr = 1.4826*arcycomb.masked_median(np.abs(frames_arr-medarr[:, :, np.newaxis]), maskvalue)
-        frames_arr = arcycomb.masked_limitsetarr(frames_arr, (medarr - reject['level'][0]*stdarr), -2, maskvalue)
-        frames_arr = arcycomb.masked_limitsetarr(frames_arr, (medarr + reject['level'][1]*stdarr), 2, maskvalue)
-        # Delete unecessary arrays
-        del medarr, stdarr
+        if verbose: msgs.info("Rejecting deviant pixels")  # Use a robust statistic
+        frames_arr = arcycomb.masked_levelclip(frames_arr, reject['level'][0], reject['level'][1], maskvalue,
+                                               nthreads=nthreads)
     else:
-        msgs.info("Not rejecting deviant pixels")
+        if verbose: msgs.info("Not rejecting deviant pixels")
     ##############
     # Combine the arrays
-    msgs.info("Combining frames with a {0:s} operation".format(method))
+    if verbose: msgs.info("Combining frames with a {0:s} operation".format(method))
     if method == 'mean':
-        frames_arr = arcycomb.masked_mean(frames_arr, maskvalue)
+        frames_arr = arcycomb.masked_mean(frames_arr, maskvalue, nthreads=nthreads)
     elif method == 'median':
-        frames_arr = arcycomb.masked_median(frames_arr, maskvalue)
+        frames_arr = arcycomb.masked_median(frames_arr, maskvalue, nthreads=nthreads)
     elif method == 'weightmean':
-        frames_arr = arcycomb.masked_weightmean(frames_arr, maskvalue)
+        frames_arr = arcycomb.masked_weightmean(frames_arr, maskvalue, nthreads=nthreads)
     else:
         msgs.error("Combination type '{0:s}' is unknown".format(method))
     ##############
     # If any pixels are completely masked, apply user-specified function
-    msgs.info("Replacing completely masked pixels with the {0:s} value of the input frames".format(reject['replace']))
-    frames_arr = arcycomb.masked_replace(frames_arr, allrej_arr, maskvalue)
+    if verbose: msgs.info("Replacing completely masked pixels with the {0:s} value of the input frames".format(reject['replace']))
+    frames_arr = arcycomb.masked_replace(frames_arr, allrej_arr, maskvalue, nthreads=nthreads)
     # Delete unecessary arrays
     del allrej_arr
     ##############
     # Apply the saturated pixels:
     if settings.argflag[frametype]['combine']['satpix'] == 'force':
-        msgs.info("Applying saturated pixels to final combined image")
+        if verbose: msgs.info("Applying saturated pixels to final combined image")
         frames_arr[setsat] = settings.spect[dnum]['saturation']
-    ##############
-    # And return a 2D numpy array
-    msgs.info("{0:d} {1:s} frames combined successfully!".format(num_frames, printtype))
-    # Make sure the returned array is the correct type
-    frames_arr = np.array(frames_arr, dtype=np.float)
     return frames_arr
+
+
+def tile_rows(sz_y, num_frames, maxmem=2**26, itemsize=8):
+    """ Number of rows in each tile when combining a stack of frames in tiles
+
+    Parameters
+    ----------
+    sz_y : int
+      Number of columns in each frame
+    num_frames : int
+      Number of frames in the stack
+    maxmem : int (optional)
+      Approximate memory (in bytes) of each tile of the stack
+    itemsize : int (optional)
+      Number of bytes per pixel (8 for float64, 4 for float32)
+
+    Returns
+    -------
+    nrows : int
+    """
+    return max(1, int(maxmem // (itemsize*sz_y*num_frames)))
@@ -0,0 +1,318 @@
+""" A fast engine for the detection of cosmic rays with the L.A.Cosmic
+algorithm (see arproc.lacosmic)
+"""
+from __future__ import (print_function, absolute_import, division, unicode_literals)
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy import ndimage
+
+from pypit import armsgs
+from pypit import arutils
+
+# Logging
+msgs = armsgs.get_logger()
+
+# The number of elements of the windows of each strip of a median filter
+# (the strips are run on separate threads)
+_filter_block = 2**20
+
+# The distance (in pixels) over which the L.A.Cosmic detection of a pixel
+# depends on the surrounding pixels (see detect)
+_detect_halo = 16
+
+
+def sort3(a, b, c):
+    """ Sort three arrays element by element
+
+    Parameters
+    ----------
+    a, b, c : ndarray
+
+    Returns
+    -------
+    low, mid, high : ndarray
+    """
+    low = np.minimum(a, b)
+    high = np.maximum(a, b)
+    return np.minimum(low, c), np.maximum(low, np.minimum(high, c)), np.maximum(high, c)
+
+
+def median_strip(padded, size):
+    """ Median filter a strip of rows that is padded by size//2 pixels on
+    every side, so that the filtered strip is smaller than padded by size-1
+    pixels along each axis
+
+    A 3x3 median is separable: the median of the 9 pixels is the median of
+    the largest of the minima, the median of the medians and the smallest
+    of the maxima of its 3 columns, and the columns are only sorted once.
+    For larger windows, the pixels of each window are partitioned.
+
+    Parameters
+    ----------
+    padded : ndarray
+    size : int
+      Size of the (square) filter
+
+    Returns
+    -------
+    strip : ndarray
+    """
+    nrow, ncol = padded.shape[0]-size+1, padded.shape[1]-size+1
+    if size == 3:
+        low, mid, high = sort3(padded[:-2], padded[1:-1], padded[2:])
+        low = np.maximum(np.maximum(low[:, :-2], low[:, 1:-1]), low[:, 2:])
+        mid = sort3(mid[:, :-2], mid[:, 1:-1], mid[:, 2:])[1]
+        high = np.minimum(np.minimum(high[:, :-2], high[:, 1:-1]), high[:, 2:])
+        return sort3(low, mid, high)[1]
+    windows = as_strided(padded, shape=(nrow, ncol, size, size), strides=2*padded.strides)
+    windows = windows.reshape(nrow, ncol, size*size)
+    if np.may_share_memory(windows, padded):
+        # The windows are partitioned in place
+        windows = windows.copy()
+    windows.partition(size*size//2, axis=2)
+    return windows[:, :, size*size//2]
+
+
+def median_filter(frame, size, nthreads=1, output=None):
+    """ Median filter a frame, in strips of rows on a pool of threads
+
+    The result is identical to ndimage.median_filter(frame, size, mode='mirror')
+    (for frames without NaNs).
+
+    Parameters
+    ----------
+    frame : ndarray
+    size : int
+      Size of the (square) filter (odd)
+    nthreads : int, optional
+      Number of threads
+    output : ndarray, optional
+      Array in which to store the result (a new array by default)
+
+    Returns
+    -------
+    output : ndarray
+    """
+    if output is None:
+        output = np.empty_like(frame)
+    halo = size//2
+    # ndimage's 'mirror' mode is numpy's 'reflect' mode
+    padded = np.pad(frame, halo, mode='reflect')
+    nrow = frame.shape[0]
+    nstrip = max(1, _filter_block // (padded.shape[1]*size*size))
+
+    def filter_strip(r0):
+        r1 = min(r0+nstrip, nrow)
+        output[r0:r1] = median_strip(padded[r0:r1+2*halo], size)
+
+    arutils.thread_map(filter_strip, range(0, nrow, nstrip), nthreads)
+    return output
+
+
+def laplacian_plus(frame):
+    """ The positive part of the Laplacian of a frame, as used by L.A.Cosmic
+
+    This is identical to subsampling the frame by a factor of 2, convolving
+    it with the Laplacian kernel (with symmetric boundaries), clipping the
+    negative values and rebinning it to the original size, without making
+    the subsampled frame. Each of the 4 subpixels of a pixel has the
+    Laplacian 2*I - V - H, where V (H) is the pixel above or below it (to
+    the left or right of it) in the original frame.
+
+    Parameters
+    ----------
+    frame : ndarray
+
+    Returns
+    -------
+    lplus : ndarray
+    """
+    padded = np.pad(frame, 1, mode='edge')
+    twice = 2.0*frame
+    lplus = np.zeros_like(frame)
+    for vert in [padded[:-2, 1:-1], padded[2:, 1:-1]]:
+        for horiz in [padded[1:-1, :-2], padded[1:-1, 2:]]:
+            lplus += np.clip(twice - vert - horiz, 0.0, None)
+    lplus /= 4.0
+    return lplus
+
+
+def grow_mask(mask, grow=1.5):
+    """ Grow a mask by all of the pixels within a given radius
+
+    This gives the same result as arcyutils.grow_masked. The default radius
+    grows the mask by one pixel in every direction (including the diagonals).
+
+    Parameters
+    ----------
+    mask : bool ndarray
+    grow : float, optional
+      Radius (in pixels) of the growth
+
+    Returns
+    -------
+    grown : bool ndarray
+    """
+    gval = int(1.0+grow)
+    x, y = np.mgrid[-gval:gval+1, -gval:gval+1]
+    structure = np.sqrt(x**2 + y**2) <= grow
+    return ndimage.binary_dilation(mask, structure=structure)
+
+
+def cr_screen(frame, maskval):
+    """ The significance of each pixel relative to the median (and the median
+    absolute deviation) of the unmasked pixels of its row
+
+    This gives the same result as arcyproc.cr_screen.
+
+    Parameters
+    ----------
+    frame : ndarray
+    maskval : float
+      Value of the masked pixels
+
+    Returns
+    -------
+    sigimg : ndarray
+    """
+    masked = np.where(frame == maskval, np.nan, frame)
+    good = np.any(frame != maskval, axis=1)
+    medarr = np.full(frame.shape[0], maskval)
+    madarr = np.full(frame.shape[0], maskval)
+    if np.any(good):
+        medarr[good] = np.nanmedian(masked[good], axis=1)
+        madarr[good] = 1.4826 * np.nanmedian(np.abs(masked[good] - medarr[good, np.newaxis]), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigimg = np.abs((frame - medarr[:, np.newaxis]) / madarr[:, np.newaxis])
+    sigimg[madarr == maskval, :] = maskval
+    return sigimg
+
+
+def slit_region(slitpix, halo=_detect_halo):
+    """ The rows and columns of a frame that contain the pixels of the
+    slits, and the pixels around them
+
+    Parameters
+    ----------
+    slitpix : ndarray
+      The slit that each pixel belongs to (0 for no slit)
+    halo : int, optional
+      Number of pixels to include around the slits
+
+    Returns
+    -------
+    region : tuple of slices, or None
+      None if there are no slit pixels
+    """
+    rows = np.where(np.any(slitpix > 0, axis=1))[0]
+    cols = np.where(np.any(slitpix > 0, axis=0))[0]
+    if rows.size == 0:
+        return None
+    return (slice(int(max(rows[0]-halo, 0)), int(min(rows[-1]+halo+1, slitpix.shape[0]))),
+            slice(int(max(cols[0]-halo, 0)), int(min(cols[-1]+halo+1, slitpix.shape[1]))))
+
+
+def detect(frame, noise_model, satpix=None, sigclip=5.0, sigfrac=0.3, objlim=5.0, maxiter=1, nthreads=1):
+    """ Identify cosmic rays with the L.A.Cosmic algorithm
+    U{http://www.astro.yale.edu/dokkum/lacosmic/}
+    (article : U{http://arxiv.org/abs/astro-ph/0108003})
+
+    The buffers of the median filters are reused between iterations.
+
+    Parameters
+    ----------
+    frame : ndarray
+      Science frame
+    noise_model : function
+      Returns the noise of each pixel, given the 5x5 median filtered frame
+    satpix : bool ndarray, optional
+      Saturated pixels
+    sigclip : float, optional
+      Detection limit of the Laplacian signal to noise
+    sigfrac : float, optional
+      Fraction of sigclip used for the pixels next to a cosmic ray
+    objlim : float, optional
+      Minimum contrast between the Laplacian and the fine structure image
+    maxiter : int, optional
+      Maximum number of iterations
+    nthreads : int, optional
+      Number of threads used by the median filters
+
+    Returns
+    -------
+    crmask : bool ndarray
+      True for the pixels affected by cosmic rays
+    """
+    scicopy = frame.copy()
+    crmask = np.zeros(frame.shape, dtype=bool)
+    sigcliplow = sigclip * sigfrac
+    m5 = np.empty_like(scicopy)
+    msp = np.empty_like(scicopy)
+    m3 = np.empty_like(scicopy)
+    m37 = np.empty_like(scicopy)
+    for i in range(1, maxiter+1):
+        msgs.info("Convolving image with Laplacian kernel")
+        lplus = laplacian_plus(scicopy)
+
+        msgs.info("Creating noise model")
+        # Build a custom noise map, and compare this to the laplacian
+        median_filter(scicopy, 5, nthreads=nthreads, output=m5)
+        noise = noise_model(m5)
+        msgs.info("Calculating Laplacian signal to noise ratio")
+
+        # Laplacian S/N
+        s = lplus / (2.0 * noise)  # Note that the 2.0 is from the 2x2 subsampling
+
+        # Remove the large structures
+        sp = s - median_filter(s, 5, nthreads=nthreads, output=msp)
+
+        msgs.info("Selecting candidate cosmic rays")
+        # Candidate cosmic rays (this will include HII regions)
+        candidates = sp > sigclip
+        msgs.info("{0:5d} candidate pixels".format(np.sum(candidates)))
+
+        # At this stage we use the saturated stars to mask the candidates, if available :
+        if satpix is not None:
+            msgs.info("Masking saturated pixels")
+            candidates &= np.logical_not(satpix)
+            msgs.info("{0:5d} candidate pixels not part of saturated stars".format(np.sum(candidates)))
+
+        msgs.info("Building fine structure image")
+        # We build the fine structure image :
+        median_filter(scicopy, 3, nthreads=nthreads, output=m3)
+        median_filter(m3, 7, nthreads=nthreads, output=m37)
+        f = m3 - m37
+        f /= noise
+        f = f.clip(min=0.01)
+
+        msgs.info("Removing suspected compact bright objects")
+        # Now we have our better selection of cosmics :
+        cosmics = np.logical_and(candidates, sp/f > objlim)
+        msgs.info("{0:5d} remaining candidate pixels".format(np.sum(cosmics)))
+
+        # What follows is a special treatment for neighbors, with more relaxed constains.
+        msgs.info("Finding neighboring pixels affected by cosmic rays")
+        # We grow these cosmics a first time to determine the immediate neighborhod,
+        # and keep those that have sp > sigmalim
+        growcosmics = np.logical_and(sp > sigclip, grow_mask(cosmics))
+        # Now we repeat this procedure, but lower the detection limit to sigmalimlow :
+        finalsel = np.logical_and(sp > sigcliplow, grow_mask(growcosmics))
+
+        # Unmask saturated pixels:
+        if satpix is not None:
+            msgs.info("Masking saturated stars")
+            finalsel &= np.logical_not(satpix)
+
+        ncrp = np.sum(finalsel)
+        msgs.info("{0:5d} pixels detected as cosmics".format(ncrp))
+
+        # We find how many cosmics are not yet known :
+        nnew = np.sum(np.logical_and(np.logical_not(crmask), finalsel))
+        # We update the mask with the cosmics we have found :
+        crmask |= finalsel
+
+        msgs.info("Iteration {0:d} -- {1:d} pixels identified as cosmic rays ({2:d} new)".format(i, ncrp, nnew))
+        if ncrp == 0:
+            break
+    return crmask
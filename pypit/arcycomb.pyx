@@ -1,230 +1,426 @@
 # To get this running, you must do the following at the command line:
 # python arcycomb_setup.py build_ext --inplace
 # although I'm not really sure what the --inplace does, I think it means "only valid for this directory"
+#
+# The pixel loops below release the GIL and are parallelised over the
+# first axis of the arrays with OpenMP. The number of threads is set by
+# the nthreads argument of each function (the default of 1 runs serially).
+# The calculation performed for each pixel does not depend on the number
+# of threads, so the results are identical for any value of nthreads.
+# If the module is compiled without OpenMP support, prange runs serially.
+# The kernels that need a buffer allocate one per thread; a thread whose
+# buffer could not be allocated skips its rows, and a MemoryError is
+# raised once the parallel block has finished.
+#
+# The frames may be either double (float64) or single (float32) precision
+# (see the 'reduce precision' setting). The output arrays have the same
+# type as the input stack, and all sums and sorts are performed in double
+# precision for both types.
 
 import numpy as np
 cimport numpy as np
 cimport cython
-DTYPE = np.float64
-ctypedef np.float_t DTYPE_t
+from cython.parallel import prange, parallel
+from libc.stdlib cimport malloc, free
 
-cdef extern from "math.h":
+ctypedef fused DTYPE_t:
+    np.float32_t
+    np.float64_t
+
+cdef extern from "math.h" nogil:
     double csqrt "sqrt" (double)
+    double cfabs "fabs" (double)
+
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void sort_values(double *vals, int cnt) nogil:
+    # Insertion sort (the number of frames is small)
+    cdef int i, j
+    cdef double temp
+    for i in range(1, cnt):
+        temp = vals[i]
+        j = i - 1
+        while j >= 0 and vals[j] > temp:
+            vals[j+1] = vals[j]
+            j -= 1
+        vals[j+1] = temp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void sort_indices(double *vals, int *idx, int cnt) nogil:
+    # Stable insertion sort of idx by vals[idx]
+    cdef int i, j, itemp
+    for i in range(1, cnt):
+        itemp = idx[i]
+        j = i - 1
+        while j >= 0 and vals[idx[j]] > vals[itemp]:
+            idx[j+1] = idx[j]
+            j -= 1
+        idx[j+1] = itemp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def masked_limitget(np.ndarray[DTYPE_t, ndim=3] array not None,
                   double limvalue,
-                  int limtype):
+                  int limtype,
+                  int nthreads=1):
 
     if limtype < -2 or limtype > 2:
         raise ValueError("Arg 3 of masked_limit can only be only of: -2 (<), -1 (<=), 0 (==), 1 (>=), 2 (>)")
 
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
-    cdef double sumv, intv
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             for n in range(nfr):
                 if limtype == -2:
-                    if array[x,y,n] < limvalue:
-                        array[x,y,n] = 1
+                    if arr[x,y,n] < limvalue:
+                        arr[x,y,n] = 1
                     else:
-                        array[x,y,n] = 0
+                        arr[x,y,n] = 0
                 elif limtype == -1:
-                    if array[x,y,n] <= limvalue:
-                        array[x,y,n] = 1
+                    if arr[x,y,n] <= limvalue:
+                        arr[x,y,n] = 1
                     else:
-                        array[x,y,n] = 0
+                        arr[x,y,n] = 0
                 elif limtype == 0:
-                    if array[x,y,n] == limvalue:
-                        array[x,y,n] = 1
+                    if arr[x,y,n] == limvalue:
+                        arr[x,y,n] = 1
                     else:
-                        array[x,y,n] = 0
+                        arr[x,y,n] = 0
                 elif limtype == 1:
-                    if array[x,y,n] >= limvalue:
-                        array[x,y,n] = 1
+                    if arr[x,y,n] >= limvalue:
+                        arr[x,y,n] = 1
                     else:
-                        array[x,y,n] = 0
+                        arr[x,y,n] = 0
                 elif limtype == 2:
-                    if array[x,y,n] > limvalue:
-                        array[x,y,n] = 1
+                    if arr[x,y,n] > limvalue:
+                        arr[x,y,n] = 1
                     else:
-                        array[x,y,n] = 0
+                        arr[x,y,n] = 0
     return array
 
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def masked_limitset(np.ndarray[DTYPE_t, ndim=3] array not None,
                   double limvalue,
                   int limtype,
-                  double maskvalue):
+                  double maskvalue,
+                  int nthreads=1):
 
     if limtype < -2 or limtype > 2:
         raise ValueError("Arg 3 of masked_limit can only be only of: -2 (<), -1 (<=), 0 (==), 1 (>=), 2 (>)")
 
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
-    cdef double sumv, intv
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             for n in range(nfr):
                 if limtype == -2:
-                    if array[x,y,n] < limvalue:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] < limvalue:
+                        arr[x,y,n] = maskvalue
                 elif limtype == -1:
-                    if array[x,y,n] <= limvalue:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] <= limvalue:
+                        arr[x,y,n] = maskvalue
                 elif limtype == 0:
-                    if array[x,y,n] == limvalue:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] == limvalue:
+                        arr[x,y,n] = maskvalue
                 elif limtype == 1:
-                    if array[x,y,n] >= limvalue:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] >= limvalue:
+                        arr[x,y,n] = maskvalue
                 elif limtype == 2:
-                    if array[x,y,n] > limvalue:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] > limvalue:
+                        arr[x,y,n] = maskvalue
     return array
 
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def masked_limitsetarr(np.ndarray[DTYPE_t, ndim=3] array not None,
                   np.ndarray[DTYPE_t, ndim=2] limvalue not None,
                   int limtype,
-                  double maskvalue):
+                  double maskvalue,
+                  int nthreads=1):
 
     if limtype < -2 or limtype > 2:
         raise ValueError("Arg 3 of masked_limit can only be only of: -2 (<), -1 (<=), 0 (==), 1 (>=), 2 (>)")
 
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
-    cdef double sumv, intv
+    cdef DTYPE_t[:, :, :] arr = array
+    cdef DTYPE_t[:, :] lim = limvalue
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             for n in range(nfr):
                 if limtype == -2:
-                    if array[x,y,n] < limvalue[x,y]:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] < lim[x,y]:
+                        arr[x,y,n] = maskvalue
                 elif limtype == -1:
-                    if array[x,y,n] <= limvalue[x,y]:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] <= lim[x,y]:
+                        arr[x,y,n] = maskvalue
                 elif limtype == 0:
-                    if array[x,y,n] == limvalue[x,y]:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] == lim[x,y]:
+                        arr[x,y,n] = maskvalue
                 elif limtype == 1:
-                    if array[x,y,n] >= limvalue[x,y]:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] >= lim[x,y]:
+                        arr[x,y,n] = maskvalue
                 elif limtype == 2:
-                    if array[x,y,n] > limvalue[x,y]:
-                        array[x,y,n] = maskvalue
+                    if arr[x,y,n] > lim[x,y]:
+                        arr[x,y,n] = maskvalue
+    return array
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def masked_levelclip(np.ndarray[DTYPE_t, ndim=3] array not None,
+                  double lolev,
+                  double hilev,
+                  double maskvalue,
+                  int nthreads=1):
+    # Mask the values of each pixel that are more than lolev (hilev)
+    # robust standard deviations below (above) the median of the
+    # unmasked values. The standard deviation is estimated from
+    # 1.4826 times the median absolute deviation. lolev or hilev <= 0.0
+    # means no rejection. The median, MAD and clipping are all
+    # performed in a single pass through the array.
+
+    cdef int sz_x, sz_y, nfr
+    cdef int x, y, n, cnt
+    cdef int nfail = 0
+    cdef double med, std, lim
+    cdef double *vals
+    cdef DTYPE_t[:, :, :] arr = array
+
+    sz_x = array.shape[0]
+    sz_y = array.shape[1]
+    nfr  = array.shape[2]
+
+    with nogil, parallel(num_threads=nthreads):
+        vals = <double *> malloc(nfr * sizeof(double))
+        for x in prange(sz_x, schedule='static'):
+            if vals == NULL:
+                nfail += 1
+                continue
+            for y in range(sz_y):
+                cnt = 0
+                for n in range(nfr):
+                    if arr[x,y,n] != maskvalue:
+                        vals[cnt] = arr[x,y,n]
+                        cnt = cnt + 1
+                if cnt == 0:
+                    continue
+                # Median
+                sort_values(vals, cnt)
+                if cnt%2==0:
+                    med = 0.5*(vals[cnt//2] + vals[cnt//2 - 1])
+                else:
+                    med = vals[(cnt-1)//2]
+                # Median absolute deviation
+                for n in range(cnt):
+                    vals[n] = cfabs(vals[n] - med)
+                sort_values(vals, cnt)
+                if cnt%2==0:
+                    std = 1.4826*(0.5*(vals[cnt//2] + vals[cnt//2 - 1]))
+                else:
+                    std = 1.4826*vals[(cnt-1)//2]
+                # Clip
+                if lolev > 0.0:
+                    lim = med - lolev*std
+                    for n in range(nfr):
+                        if arr[x,y,n] != maskvalue and arr[x,y,n] < lim:
+                            arr[x,y,n] = maskvalue
+                if hilev > 0.0:
+                    lim = med + hilev*std
+                    for n in range(nfr):
+                        if arr[x,y,n] != maskvalue and arr[x,y,n] > lim:
+                            arr[x,y,n] = maskvalue
+        free(vals)
+    if nfail > 0:
+        raise MemoryError("masked_levelclip could not allocate its buffers")
     return array
 
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def masked_lowhigh(np.ndarray[DTYPE_t, ndim=3] array not None,
+                  int nlow,
+                  int nhigh,
+                  double maskvalue,
+                  int nthreads=1):
+    # Mask the nlow lowest and nhigh highest unmasked values of each pixel
+
+    cdef int sz_x, sz_y, nfr
+    cdef int x, y, n, cnt
+    cdef int nfail = 0
+    cdef double *vals
+    cdef int *idx
+    cdef DTYPE_t[:, :, :] arr = array
+
+    sz_x = array.shape[0]
+    sz_y = array.shape[1]
+    nfr  = array.shape[2]
+
+    with nogil, parallel(num_threads=nthreads):
+        vals = <double *> malloc(nfr * sizeof(double))
+        idx = <int *> malloc(nfr * sizeof(int))
+        for x in prange(sz_x, schedule='static'):
+            if vals == NULL or idx == NULL:
+                nfail += 1
+                continue
+            for y in range(sz_y):
+                cnt = 0
+                for n in range(nfr):
+                    vals[n] = arr[x,y,n]
+                    if arr[x,y,n] != maskvalue:
+                        idx[cnt] = n
+                        cnt = cnt + 1
+                sort_indices(vals, idx, cnt)
+                for n in range(cnt):
+                    if n < nlow or n >= cnt - nhigh:
+                        arr[x,y,idx[n]] = maskvalue
+        free(vals)
+        free(idx)
+    if nfail > 0:
+        raise MemoryError("masked_lowhigh could not allocate its buffers")
+    return array
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def masked_mean(np.ndarray[DTYPE_t, ndim=3] array not None,
-                  double maskvalue):
+                  double maskvalue,
+                  int nthreads=1):
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
     cdef double sumv, intv
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    cdef np.ndarray[DTYPE_t, ndim=2] meanarr = np.zeros((sz_x,sz_y), dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=2] meanarr = np.zeros((sz_x,sz_y), dtype=array.dtype)
+    cdef DTYPE_t[:, :] mean_v = meanarr
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             # Fill in the array
             intv = 0.0
             sumv = 0.0
             for n in range(nfr):
-                if array[x,y,n] != maskvalue:
-                    sumv += array[x,y,n]
-                    intv += 1.0
+                if arr[x,y,n] != maskvalue:
+                    sumv = sumv + arr[x,y,n]
+                    intv = intv + 1.0
             if intv == 0.0:
-                meanarr[x,y] = maskvalue
+                mean_v[x,y] = maskvalue
             else:
-                meanarr[x,y] = sumv/intv
+                mean_v[x,y] = sumv/intv
     return meanarr
 
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def masked_median(np.ndarray[DTYPE_t, ndim=3] array not None,
-                  double maskvalue):
+                  double maskvalue,
+                  int nthreads=1):
     cdef int sz_x, sz_y, nfr
     cdef int i, j, cnt
     cdef int x, y, n
+    cdef int nfail = 0
     cdef double temp
+    cdef double *arrt
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    cdef np.ndarray[DTYPE_t, ndim=2] medarr = np.zeros((sz_x,sz_y), dtype=DTYPE)
-    cdef np.ndarray[DTYPE_t, ndim=1] arrt = np.zeros(nfr,dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=2] medarr = np.zeros((sz_x,sz_y), dtype=array.dtype)
+    cdef DTYPE_t[:, :] med_v = medarr
 
-    for x in range(sz_x):
-        for y in range(sz_y):
-            # Fill in the array
-            cnt = 0
-            for n in range(nfr):
-                if array[x,y,n] != maskvalue:
-                    arrt[cnt] = array[x,y,n]
-                    cnt += 1
-            if cnt == 0:
-                medarr[x,y] = maskvalue
+    with nogil, parallel(num_threads=nthreads):
+        # Each thread sorts the unmasked values of a pixel in its own buffer
+        arrt = <double *> malloc(nfr * sizeof(double))
+        for x in prange(sz_x, schedule='static'):
+            if arrt == NULL:
+                nfail += 1
                 continue
-            # Sort the array
-            for i in range(cnt-1):
-                for j in range(i+1,cnt):
-                    if arrt[j] < arrt[i]:
-                        temp = arrt[i]
-                        arrt[i] = arrt[j]
-                        arrt[j] = temp
-            # Find the median value
-            if cnt%2==0:
-                medarr[x,y] = 0.5*(arrt[cnt/2] + arrt[cnt/2 - 1])
-            else:
-                medarr[x,y] = arrt[(cnt-1)/2]
+            for y in range(sz_y):
+                # Fill in the array
+                cnt = 0
+                for n in range(nfr):
+                    if arr[x,y,n] != maskvalue:
+                        arrt[cnt] = arr[x,y,n]
+                        cnt = cnt + 1
+                if cnt == 0:
+                    med_v[x,y] = maskvalue
+                    continue
+                # Sort the array
+                for i in range(cnt-1):
+                    for j in range(i+1,cnt):
+                        if arrt[j] < arrt[i]:
+                            temp = arrt[i]
+                            arrt[i] = arrt[j]
+                            arrt[j] = temp
+                # Find the median value
+                if cnt%2==0:
+                    med_v[x,y] = 0.5*(arrt[cnt//2] + arrt[cnt//2 - 1])
+                else:
+                    med_v[x,y] = arrt[(cnt-1)//2]
+        free(arrt)
+    if nfail > 0:
+        raise MemoryError("masked_median could not allocate its buffers")
     return medarr
 
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def masked_replace(np.ndarray[DTYPE_t, ndim=2] array not None,
                   np.ndarray[DTYPE_t, ndim=2] repvalue not None,
-                  double maskvalue):
+                  double maskvalue,
+                  int nthreads=1):
 
     cdef int sz_x, sz_y
     cdef int x, y
+    cdef DTYPE_t[:, :] arr = array
+    cdef DTYPE_t[:, :] rep = repvalue
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
-            if array[x,y] == maskvalue:
-                array[x,y] = repvalue[x,y]
+            if arr[x,y] == maskvalue:
+                arr[x,y] = rep[x,y]
     return array
 
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def masked_weightmean(np.ndarray[DTYPE_t, ndim=3] array not None,
-                  double maskvalue):
+                  double maskvalue,
+                  int nthreads=1):
     # This routine uses the weighted mean formula described
     # by Mighell (1999), ApJ, 518, 380
     # and is given by their Eq. (18).
@@ -232,122 +428,139 @@ def masked_weightmean(np.ndarray[DTYPE_t, ndim=3] array not None,
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
     cdef double sumv, intv
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    cdef np.ndarray[DTYPE_t, ndim=2] meanarr = np.zeros((sz_x,sz_y), dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=2] meanarr = np.zeros((sz_x,sz_y), dtype=array.dtype)
+    cdef DTYPE_t[:, :] mean_v = meanarr
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             # Fill in the array
             intv = 0.0
             sumv = 0.0
             for n in range(nfr):
-                if array[x,y,n] != maskvalue:
-                    if array[x,y,n] <= 1.0: # Deal with spurious cases
-                        sumv += 0.0
-                        intv += 1.0
+                if arr[x,y,n] != maskvalue:
+                    if arr[x,y,n] <= 1.0: # Deal with spurious cases
+                        sumv = sumv + 0.0
+                        intv = intv + 1.0
                     else:
-                        sumv += csqrt(array[x,y,n])*array[x,y,n]
-                        intv += csqrt(array[x,y,n])
+                        sumv = sumv + csqrt(arr[x,y,n])*arr[x,y,n]
+                        intv = intv + csqrt(arr[x,y,n])
 #					else:
 #						sumv += 1.0
 #						intv += 1.0/(1.0+array[x,y,n])
             if intv == 0.0:
-                meanarr[x,y] = maskvalue
+                mean_v[x,y] = maskvalue
             else:
-                meanarr[x,y] = sumv/intv
+                mean_v[x,y] = sumv/intv
     return meanarr
 
 
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def maxnonsat(np.ndarray[DTYPE_t, ndim=3] array not None,
-           double satval):
+           double satval,
+           int nthreads=1):
 
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
     cdef double temp, minv
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    cdef np.ndarray[DTYPE_t, ndim=2] mmarr = np.zeros((sz_x,sz_y), dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=2] mmarr = np.zeros((sz_x,sz_y), dtype=array.dtype)
+    cdef DTYPE_t[:, :] mm_v = mmarr
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             # Sort the array
             temp = 0.0
             minv = satval
             for n in range(nfr):
-                if array[x,y,n] > temp and temp < satval:
-                    temp = array[x,y,n]
-                if array[x,y,n] < minv:
-                    minv = array[x,y,n]
+                if arr[x,y,n] > temp and temp < satval:
+                    temp = arr[x,y,n]
+                if arr[x,y,n] < minv:
+                    minv = arr[x,y,n]
             if temp == 0.0:
-                mmarr[x,y] = minv
+                mm_v[x,y] = minv
             else:
-                mmarr[x,y] = temp
+                mm_v[x,y] = temp
     return mmarr
 
 
-#@cython.boundscheck(False)
-def mean(np.ndarray[DTYPE_t, ndim=3] array not None):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def mean(np.ndarray[DTYPE_t, ndim=3] array not None,
+         int nthreads=1):
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
     cdef double sumv, intv
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    cdef np.ndarray[DTYPE_t, ndim=2] meanarr = np.zeros((sz_x,sz_y), dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=2] meanarr = np.zeros((sz_x,sz_y), dtype=array.dtype)
+    cdef DTYPE_t[:, :] mean_v = meanarr
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             # Fill in the array
             sumv = 0.0
             intv = 0.0
             for n in range(nfr):
-                sumv += array[x,y,n]
-                intv += 1.0
-            meanarr[x,y] = sumv/intv
+                sumv = sumv + arr[x,y,n]
+                intv = intv + 1.0
+            mean_v[x,y] = sumv/intv
     return meanarr
 
 
-#@cython.boundscheck(False)
-def median(np.ndarray[DTYPE_t, ndim=3] array not None):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def median(np.ndarray[DTYPE_t, ndim=3] array not None,
+           int nthreads=1):
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n, j
     cdef double temp
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    cdef np.ndarray[DTYPE_t, ndim=2] medarr = np.zeros((sz_x,sz_y), dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=2] medarr = np.zeros((sz_x,sz_y), dtype=array.dtype)
+    cdef DTYPE_t[:, :] med_v = medarr
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             # Sort the array
             for n in range(nfr-1):
                 for j in range(n+1,nfr):
-                    if array[x,y,j] < array[x,y,n]:
-                        temp = array[x,y,n]
-                        array[x,y,n] = array[x,y,j]
-                        array[x,y,j] = temp
+                    if arr[x,y,j] < arr[x,y,n]:
+                        temp = arr[x,y,n]
+                        arr[x,y,n] = arr[x,y,j]
+                        arr[x,y,j] = temp
             # Find the median value
             if nfr%2==0:
-                medarr[x,y] = 0.5*(array[x,y,nfr/2] + array[x,y,nfr/2 - 1])
+                med_v[x,y] = 0.5*(arr[x,y,nfr//2] + arr[x,y,nfr//2 - 1])
             else:
-                medarr[x,y] = array[x,y,(nfr-1)/2]
+                med_v[x,y] = arr[x,y,(nfr-1)//2]
     return medarr
 
-#@cython.boundscheck(False)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def minmax(np.ndarray[DTYPE_t, ndim=3] array not None,
-           int mm):
+           int mm,
+           int nthreads=1):
 
     if mm != 0 and mm != 1:
         raise ValueError("Arg 2 of minmax can only be 0 (for min) or 1 (for max)")
@@ -355,23 +568,25 @@ def minmax(np.ndarray[DTYPE_t, ndim=3] array not None,
     cdef int sz_x, sz_y, nfr
     cdef int x, y, n
     cdef double temp
+    cdef DTYPE_t[:, :, :] arr = array
 
     sz_x = array.shape[0]
     sz_y = array.shape[1]
     nfr  = array.shape[2]
 
-    cdef np.ndarray[DTYPE_t, ndim=2] mmarr = np.zeros((sz_x,sz_y), dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=2] mmarr = np.zeros((sz_x,sz_y), dtype=array.dtype)
+    cdef DTYPE_t[:, :] mm_v = mmarr
 
-    for x in range(sz_x):
+    for x in prange(sz_x, nogil=True, schedule='static', num_threads=nthreads):
         for y in range(sz_y):
             # Sort the array
-            temp = array[x,y,0]
+            temp = arr[x,y,0]
             for n in range(1,nfr):
                 if mm == 0:
-                    if array[x,y,n] < temp:
-                        temp = array[x,y,n]
+                    if arr[x,y,n] < temp:
+                        temp = arr[x,y,n]
                 else:
-                    if array[x,y,n] > temp:
-                        temp = array[x,y,n]
-            mmarr[x,y] = temp
+                    if arr[x,y,n] > temp:
+                        temp = arr[x,y,n]
+            mm_v[x,y] = temp
     return mmarr
@@ -6,5 +6,7 @@ import numpy
 setup(
     cmdclass = {'build_ext': build_ext},
     ext_modules = [Extension("arcycomb", ["arcycomb.pyx"],
-                             include_dirs=[numpy.get_include()])]
+                             include_dirs=[numpy.get_include()],
+                             extra_compile_args=['-fopenmp'],
+                             extra_link_args=['-fopenmp'])]
 )
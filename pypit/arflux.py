@@ -24,6 +24,11 @@ from pypit import ardebug as debugger
 # Logging
 msgs = armsgs.get_logger()
 
+# The archived standard star catalogues that have been loaded, with a
+# spatial index of their stars (see std_index)
+_std_catalogues = {}
+_std_indices = {}
+
 
 def apply_sensfunc(slf, det, scidx, fitsdict, MAX_EXTRAP=0.05, standard=False):
     """ Apply the sensitivity function to the data
@@ -205,6 +210,122 @@ def extinction_correction(wave, airmass, extinct):
     return flux_corr
 
 
+def radec_to_xyz(ra, dec):
+    """ Convert coordinates into unit vectors on the sphere
+
+    Parameters
+    ----------
+    ra, dec : array_like
+      RA and DEC in string format ('05:06:36.6','52:52:01.0')
+
+    Returns
+    -------
+    xyz : ndarray
+      Unit vectors, of shape (N, 3)
+    """
+    coord = SkyCoord(ra, dec, unit=(u.hourangle, u.deg))
+    return np.atleast_2d(np.array(coord.cartesian.xyz.value).T)
+
+
+def std_index(sset):
+    """ Load an archived set of standard stars, with a KD-tree of the
+    positions of its stars on the unit sphere. Each set is only loaded
+    once.
+
+    Parameters
+    ----------
+    sset : function
+      Loads the set of standard stars (e.g. load_calspec)
+
+    Returns
+    -------
+    path : str
+      Path from pypitdir to the standard star files
+    star_tbl : Table
+      The standard stars
+    tree : cKDTree
+      Spatial index of the standard stars
+    """
+    from scipy.spatial import cKDTree
+    path, star_tbl = sset()
+    key = (sset.__name__, id(star_tbl))
+    if key not in _std_indices:
+        _std_indices[key] = cKDTree(radec_to_xyz(star_tbl['RA_2000'], star_tbl['DEC_2000']))
+    return path, star_tbl, _std_indices[key]
+
+
+def find_standard_files(radecs, toler=20.*u.arcmin, check=False):
+    """
+    Find a match for several input files to the archived standard
+    star files (see find_standard_file), with a single query of the
+    spatial index of each set of standards.
+
+    Parameters
+    ----------
+    radecs : list
+      ra, dec tuples in string format ('05:06:36.6','52:52:01.0')
+    toler : Angle
+      Tolerance on matching archived standards to input
+    check : bool
+      If True, the routine will only check to see if a
+      standard star exists within the input ra, dec, and toler range.
+
+    Returns
+    -------
+    sdicts : list
+      For each input, a dict (see find_standard_file) or None, or a
+      bool if check is True
+    """
+    # Priority
+    std_sets = [load_calspec]
+    std_file_fmt = [1]  # 1=Calspec style FITS binary table
+
+    nobj = len(radecs)
+    if nobj == 0:
+        return []
+    # Unit vectors
+    obj_xyz = radec_to_xyz([radec[0] for radec in radecs], [radec[1] for radec in radecs])
+    # Loop on standard sets
+    sdicts = [None for i in range(nobj)]
+    closest = [dict(sep=999*u.deg) for i in range(nobj)]
+    for qq,sset in enumerate(std_sets):
+        # Stars
+        path, star_tbl, tree = std_index(sset)
+        # Match -- the chord distance on the unit sphere gives the angular separation
+        dist, idx = tree.query(obj_xyz, k=1)
+        d2d = (2.0*np.arcsin(np.minimum(dist/2.0, 1.0))*u.rad).to(u.deg)
+        for ii in range(nobj):
+            if sdicts[ii] is not None:
+                continue
+            if d2d[ii] < toler:
+                if check:
+                    sdicts[ii] = True
+                else:
+                    # Generate a dict
+                    sdicts[ii] = dict(file=path+star_tbl[int(idx[ii])]['File'], name=star_tbl[int(idx[ii])]['Name'],
+                                      fmt=std_file_fmt[qq], ra=star_tbl[int(idx[ii])]['RA_2000'],
+                                      dec=star_tbl[int(idx[ii])]['DEC_2000'])
+            elif d2d[ii] < closest[ii]['sep']:  # Save closest, if it is
+                closest[ii]['sep'] = d2d[ii]
+                closest[ii].update(dict(name=star_tbl[int(idx[ii])]['Name'],
+                                        ra=star_tbl[int(idx[ii])]['RA_2000'],
+                                        dec=star_tbl[int(idx[ii])]['DEC_2000']))
+    for ii in range(nobj):
+        if sdicts[ii] is not None:
+            if not check:
+                msgs.info("Using standard star {:s}".format(sdicts[ii]['name']))
+            continue
+        # Standard star not found
+        if check:
+            sdicts[ii] = False
+            continue
+        msgs.warn("No standard star was found within a tolerance of {:g}".format(toler))
+        msgs.info("Closest standard was {:s} at separation {:g}".format(closest[ii]['name'],
+                                                                        closest[ii]['sep'].to('arcmin')))
+        msgs.warn("Flux calibration will not be performed")
+    return sdicts
+
+
 def find_standard_file(radec, toler=20.*u.arcmin, check=False):
     """
     Find a match for the input file to one of the archived
@@ -230,49 +351,12 @@ def find_standard_file(radec, toler=20.*u.arcmin, check=False):
       'ra': str -- RA(2000)
       'dec': str -- DEC(2000)
     """
-    # Priority
-    std_sets = [load_calspec]
-    std_file_fmt = [1]  # 1=Calspec style FITS binary table
-
-    # SkyCoord
-    obj_coord = SkyCoord(radec[0], radec[1], unit=(u.hourangle, u.deg))
-    # Loop on standard sets
-    closest = dict(sep=999*u.deg)
-    for qq,sset in enumerate(std_sets):
-        # Stars
-        path, star_tbl = sset()
-        star_coords = SkyCoord(star_tbl['RA_2000'], star_tbl['DEC_2000'],
-            unit=(u.hourangle, u.deg))
-        # Match
-        idx, d2d, d3d = coords.match_coordinates_sky(obj_coord, star_coords, nthneighbor=1)
-        if d2d < toler:
-            if check:
-                return True
-            else:
-                # Generate a dict
-                std_dict = dict(file=path+star_tbl[int(idx)]['File'], name=star_tbl[int(idx)]['Name'], fmt=std_file_fmt[qq], ra=star_tbl[int(idx)]['RA_2000'], dec=star_tbl[int(idx)]['DEC_2000'])
-                # Return
-                msgs.info("Using standard star {:s}".format(std_dict['name']))
-                return std_dict
-        else: # Save closest, if it is
-            imind2d = np.argmin(d2d)
-            mind2d = d2d[imind2d]
-            if mind2d < closest['sep']:
-                closest['sep'] = mind2d
-                closest.update(dict(name=star_tbl[int(idx)]['Name'],
-                    ra=star_tbl[int(idx)]['RA_2000'],
-                    dec=star_tbl[int(idx)]['DEC_2000']))
-    # Standard star not found
-    if check: return False
-    msgs.warn("No standard star was found within a tolerance of {:g}".format(toler))
-    msgs.info("Closest standard was {:s} at separation {:g}".format(closest['name'],closest['sep'].to('arcmin')))
-    msgs.warn("Flux calibration will not be performed")
-    return None
+    return find_standard_files([radec], toler=toler, check=check)[0]
 
 
 def load_calspec():
     """
-    Load the list of calspec standards
+    Load the list of calspec standards. The list is only read once.
 
     Parameters
     ----------
@@ -287,7 +371,9 @@ def load_calspec():
     # Read
     calspec_path = '/data/standards/calspec/'
     calspec_file = settings.argflag['run']['pypitdir'] + calspec_path + 'calspec_info.txt'
-    calspec_stds = Table.read(calspec_file, comment='#', format='ascii')
+    if calspec_file not in _std_catalogues:
+        _std_catalogues[calspec_file] = Table.read(calspec_file, comment='#', format='ascii')
+    calspec_stds = _std_catalogues[calspec_file]
     # Return
     return calspec_path, calspec_stds
 
@@ -1,6 +1,8 @@
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 
 import os
+import json
+import time
 import astropy.io.fits as pyfits
 from astropy.time import Time
 import numpy as np
@@ -8,9 +10,7 @@ from pypit import arparse as settings
 from pypit import armsgs
 from pypit import arproc
 from pypit import arlris
-#from multiprocessing import Pool as mpPool
-#from multiprocessing.pool import ApplyResult
-#import arutils
+from pypit import arutils
 
 try:
     basestring
@@ -22,11 +22,20 @@ from pypit import ardebug as debugger
 # Logging
 msgs = armsgs.get_logger()
 
+# The header indices loaded or saved by this process, with the modification
+# time of their file and their hash (see load_header_index)
+_header_indices = {}
+
 
 def load_headers(datlines):
     """
     Load the header information for each fits file
 
+    If 'run headindex' is set, the values extracted from the headers
+    are stored in a persistent index (see load_header_index), and only
+    the headers of new or modified files are read. The headers are read
+    on a pool of 'run ncpus' threads.
+
     Parameters
     ----------
     datlines : list
@@ -39,121 +48,64 @@ def load_headers(datlines):
     fitsdict : dict
       The relevant header information of all fits files
     """
-    chks = settings.spect['check'].keys()
     keys = settings.spect['keyword'].keys()
     fitsdict = dict({'directory': [], 'filename': [], 'utc': []})
-    whddict = dict({})
     for k in keys:
         fitsdict[k]=[]
-    allhead = []
-    headarr = [None for k in range(settings.spect['fits']['numhead'])]
+    index_file = header_index_file()
+    index = load_header_index(index_file)
     numfiles = len(datlines)
+    # Find the files that are not in the index, or have changed
+    entries = [index.get(datlines[i]) for i in range(numfiles)]
+    filestats = [None for i in range(numfiles)]
     for i in range(numfiles):
-        # Try to open the fits file
         try:
-            for k in range(settings.spect['fits']['numhead']):
-                headarr[k] = pyfits.getheader(datlines[i], ext=settings.spect['fits']['headext{0:02d}'.format(k+1)])
-                whddict['{0:02d}'.format(settings.spect['fits']['headext{0:02d}'.format(k+1)])] = k
-        except:
-            if settings.argflag['run']['setup']:
-                msgs.warn("Bad header in extension {0:d} of file:".format(settings.spect['fits']['headext{0:02d}'.format(k+1)])+msgs.newline()+datlines[i])
-                msgs.warn("Proceeding on the hopes this was a calibration file, otherwise consider removing.")
-            else:
-                msgs.error("Error reading header from extension {0:d} of file:".format(settings.spect['fits']['headext{0:02d}'.format(k+1)])+msgs.newline()+datlines[i])
-        # Save
-        for k in range(settings.spect['fits']['numhead']):
-            tmp = [head.copy() for head in headarr]
-            allhead.append(tmp)
-        # Perform checks on each fits files, as specified in the settings.instrument file.
-        skip = False
-        for ch in chks:
-            tfrhd = int(ch.split('.')[0])-1
-            kchk  = '.'.join(ch.split('.')[1:])
-            frhd  = whddict['{0:02d}'.format(tfrhd)]
-            if settings.spect['check'][ch] != str(headarr[frhd][kchk]).strip():
-                print(ch, frhd, kchk)
-                print(settings.spect['check'][ch], str(headarr[frhd][kchk]).strip())
-                msgs.warn("The following file:"+msgs.newline()+datlines[i]+msgs.newline()+"is not taken with the settings.{0:s} detector".format(settings.argflag['run']['spectrograph'])+msgs.newline()+"Remove this file, or specify a different settings file.")
-                msgs.warn("Skipping the file..")
-                skip = True
-        if skip:
-            numfiles -= 1
+            filestats[i] = os.stat(datlines[i])
+        except OSError:
+            pass
+        if entries[i] is None or filestats[i] is None or \
+                entries[i]['size'] != filestats[i].st_size or entries[i]['mtime'] != filestats[i].st_mtime:
+            entries[i] = None
+    toread = [i for i in range(numfiles) if entries[i] is None]
+    # Read their headers on a pool of threads
+    tstart = time.time()
+    nthread = max(1, min(settings.argflag['run']['ncpus'], len(toread)))
+    if nthread > 1:
+        msgs.info("Reading the headers of {0:d} files with {1:d} threads".format(len(toread), nthread))
+    newentries = arutils.thread_map(read_header_values, [datlines[i] for i in toread], nthread)
+    header_times([entry for entry in newentries if entry['valid']])
+    for i, entry in zip(toread, newentries):
+        entries[i] = entry
+        if entry['cache'] and filestats[i] is not None:
+            entry['size'], entry['mtime'] = filestats[i].st_size, filestats[i].st_mtime
+            index[datlines[i]] = entry
+        else:
+            index.pop(datlines[i], None)
+    if len(toread) > 0:
+        msgs.info("Read the headers of {0:d} files in {1:.2f}s".format(len(toread), time.time()-tstart))
+    loaded = []
+    for i in range(numfiles):
+        entry = entries[i]
+        if not entry['valid']:
+            msgs.warn("The following file:"+msgs.newline()+datlines[i]+msgs.newline()+"is not taken with the settings.{0:s} detector".format(settings.argflag['run']['spectrograph'])+msgs.newline()+"Remove this file, or specify a different settings file.")
+            msgs.warn("Skipping the file..")
             continue
         # Now set the key values for each of the required keywords
         dspl = datlines[i].split('/')
         fitsdict['directory'].append('/'.join(dspl[:-1])+'/')
         fitsdict['filename'].append(dspl[-1])
-        # Attempt to load a UTC
-        utcfound = False
-        for k in range(settings.spect['fits']['numhead']):
-            if 'UTC' in headarr[k].keys():
-                utc = headarr[k]['UTC']
-                utcfound = True
-                break
-            elif 'UT' in headarr[k].keys():
-                utc = headarr[k]['UT']
-                utcfound = True
-                break
-        if utcfound:
-            fitsdict['utc'].append(utc)
-        else:
-            fitsdict['utc'].append(None)
+        fitsdict['utc'].append(entry['utc'])
+        if entry['utc'] is None:
             msgs.warn("UTC is not listed as a header keyword in file:"+msgs.newline()+datlines[i])
-        # Read binning-dependent detector properties here? (maybe read speed too)
-        #if settings.argflag['run']['spectrograph'] in ['lris_blue']:
-        #    arlris.set_det(fitsdict, headarr[k])
-        # Now get the rest of the keywords
         for kw in keys:
-            if settings.spect['keyword'][kw] is None:
-                value = str('None')  # This instrument doesn't have/need this keyword
-            else:
-                ch = settings.spect['keyword'][kw]
-                try:
-                    tfrhd = int(ch.split('.')[0])-1
-                except ValueError:
-                    value = ch  # Keyword given a value. Only a string allowed for now
-                else:
-                    frhd = whddict['{0:02d}'.format(tfrhd)]
-                    kchk = '.'.join(ch.split('.')[1:])
-                    try:
-                        value = headarr[frhd][kchk]
-                    except KeyError: # Keyword not found in header
-                        msgs.warn("{:s} keyword not in header. Setting to None".format(kchk))
-                        value=str('None')
-            # Convert the input time into hours
-            if kw == 'time':
-                if settings.spect['fits']['timeunit']   == 's'  : value = float(value)/3600.0    # Convert seconds to hours
-                elif settings.spect['fits']['timeunit'] == 'm'  : value = float(value)/60.0      # Convert minutes to hours
-                elif settings.spect['fits']['timeunit'] in Time.FORMATS.keys() : # Astropy time format
-                    if settings.spect['fits']['timeunit'] in ['mjd']:
-                        ival = float(value)
-                    else:
-                        ival = value
-                    tval = Time(ival, scale='tt', format=settings.spect['fits']['timeunit'])
-                    # dspT = value.split('T')
-                    # dy,dm,dd = np.array(dspT[0].split('-')).astype(np.int)
-                    # th,tm,ts = np.array(dspT[1].split(':')).astype(np.float64)
-                    # r=(14-dm)/12
-                    # s,t=dy+4800-r,dm+12*r-3
-                    # jdn = dd + (153*t+2)/5 + 365*s + s/4 - 32083
-                    # value = jdn + (12.-th)/24 + tm/1440 + ts/86400 - 2400000.5  # THIS IS THE MJD
-                    value = tval.mjd * 24.0 # Put MJD in hours
-                else:
-                    msgs.error('Bad time unit')
-            # Put the value in the keyword
-            typv = type(value)
-            if typv is int or typv is np.int_:
-                fitsdict[kw].append(value)
-            elif typv is float or typv is np.float_:
-                fitsdict[kw].append(value)
-            elif isinstance(value, basestring) or typv is np.string_:
-                fitsdict[kw].append(value.strip())
-            elif typv is bool or typv is np.bool_:
-                fitsdict[kw].append(value)
-            else:
-                msgs.bug("I didn't expect a useful header ({0:s}) to contain type {1:s}".format(kw, typv).replace('<type ','').replace('>',''))
-
+            fitsdict[kw].append(entry[kw])
+        loaded.append(datlines[i])
         msgs.info("Successfully loaded headers for file:"+msgs.newline()+datlines[i])
+    numfiles = len(loaded)
+    if index_file is not None:
+        msgs.info("Read the headers of {0:d} new or modified files (of {1:d})".format(len(toread), len(datlines)))
+        if len(toread) > 0:
+            save_header_index(index_file, index)
     # Convert the fitsdict arrays into numpy arrays
     for k in fitsdict.keys():
         fitsdict[k] = np.array(fitsdict[k])
@@ -163,15 +115,768 @@ def load_headers(datlines):
     if numfiles == 0:
         msgs.error("The headers could not be read from the input data files." + msgs.newline() +
                    "Please check that the settings file matches the data.")
-    # Return
-    fitsdict['headers'] = allhead
+    # The full headers are only read if they are needed
+    fitsdict['headers'] = HeaderList(loaded)
     return fitsdict
 
 
-def load_frames(fitsdict, ind, det, frametype='<None>', msbias=None, trim=True):
+def header_extensions():
+    """ The extensions of the raw files whose headers are needed
+
+    Returns
+    -------
+    exts : list of int
+    """
+    return [settings.spect['fits']['headext{0:02d}'.format(k+1)] for k in range(settings.spect['fits']['numhead'])]
+
+
+def read_headers(filename, setup=None):
+    """ Read the headers of a raw file
+
+    Parameters
+    ----------
+    filename : str
+    setup : bool, optional
+      If True, an unreadable header is replaced by an empty one (with
+      a warning). Otherwise, an error is raised. Defaults to 'run setup'.
+
+    Returns
+    -------
+    headarr : list of Header
+      One header for each of the 'fits headext' extensions
+    success : bool
+      Were all of the headers read successfully?
+    """
+    if setup is None:
+        setup = settings.argflag['run']['setup']
+    exts = header_extensions()
+    headarr = [pyfits.Header() for ext in exts]
+    k = 0
+    try:
+        with pyfits.open(filename) as hdulist:
+            for k, ext in enumerate(exts):
+                headarr[k] = raw_hdu(hdulist, ext).header.copy()
+    except Exception:
+        if setup:
+            msgs.warn("Bad header in extension {0:d} of file:".format(exts[k])+msgs.newline()+filename)
+            msgs.warn("Proceeding on the hopes this was a calibration file, otherwise consider removing.")
+            return headarr, False
+        else:
+            msgs.error("Error reading header from extension {0:d} of file:".format(exts[k])+msgs.newline()+filename)
+    return headarr, True
+
+
+def read_header_cards(filename, exts=None):
+    """ Read the keywords of the headers of a raw file, without astropy
+
+    Only the header blocks of the requested extensions are read and
+    parsed; the data units in between are skipped.
+
+    Parameters
+    ----------
+    filename : str
+      A FITS file, optionally gzip compressed
+    exts : list of int, optional
+      Extensions to read. Defaults to the 'fits headext' extensions
+
+    Returns
+    -------
+    headarr : list of dict, or None
+      The keywords and values of each header. None if the file cannot
+      be read this way (e.g. tile compressed images, other compression
+      formats, or a truncated file), and astropy should be used instead.
+    """
+    import gzip
+    if exts is None:
+        exts = header_extensions()
+    if filename.endswith('.gz'):
+        opener = gzip.open
+    elif os.path.splitext(filename)[1].lower() in ['.fits', '.fit', '.fts']:
+        opener = open
+    else:
+        return None
+    headers = dict({})
+    try:
+        with opener(filename, 'rb') as fil:
+            for ext in range(max(exts)+1):
+                cards = dict({})
+                end = False
+                while not end:
+                    block = fil.read(2880)
+                    if len(block) < 2880:
+                        return None
+                    end = parse_header_block(block.decode('latin-1'), cards)
+                cards.pop('_continue', None)
+                if cards.get('ZIMAGE', False) or cards.get('GROUPS', False):
+                    return None
+                headers[ext] = cards
+                if ext == max(exts):
+                    break
+                # Skip the data
+                naxis = cards.get('NAXIS', 0)
+                if naxis > 0:
+                    npix = np.prod([cards['NAXIS{0:d}'.format(n+1)] for n in range(naxis)], dtype=np.int64)
+                    size = abs(cards['BITPIX'])//8 * cards.get('GCOUNT', 1) * (cards.get('PCOUNT', 0) + npix)
+                    fil.seek(2880*((size+2879)//2880), 1)
+    except (IOError, OSError, KeyError, ValueError, TypeError, EOFError):
+        return None
+    return [headers[ext] for ext in exts]
+
+
+def parse_header_block(block, cards):
+    """ Parse the 80 character cards of a 2880 byte FITS header block
+
+    The values are converted as astropy would: strings (with trailing
+    blanks removed), bool, int or float. Only the first occurrence of
+    a keyword is kept, and long strings continued with CONTINUE cards
+    are joined.
+
+    Parameters
+    ----------
+    block : str
+    cards : dict
+      Updated with the keywords and values of the block
+
+    Returns
+    -------
+    end : bool
+      True if the END card was found
+    """
+    for i in range(0, 2880, 80):
+        card = block[i:i+80]
+        key = card[:8].strip()
+        if key == 'END':
+            return True
+        if key == 'CONTINUE' and cards.get('_continue') is not None:
+            value = parse_card_value(card[8:])
+            prev = cards['_continue']
+            if isinstance(value, basestring) and cards[prev].endswith('&'):
+                cards[prev] = cards[prev][:-1] + value
+                continue
+        cards['_continue'] = None
+        if card[8:10] != '= ' or key in cards:
+            continue
+        cards[key] = parse_card_value(card[10:])
+        if isinstance(cards[key], basestring):
+            cards['_continue'] = key
+    return False
+
+
+def parse_card_value(field):
+    """ Convert the value field of a FITS header card
+
+    Parameters
+    ----------
+    field : str
+
+    Returns
+    -------
+    value : str, bool, int, float or None
+    """
+    field = field.strip()
+    if field.startswith("'"):
+        # A string, where '' is an escaped quote
+        value = ''
+        i = 1
+        while i < len(field):
+            if field[i] == "'":
+                if field[i+1:i+2] == "'":
+                    value += "'"
+                    i += 2
+                    continue
+                break
+            value += field[i]
+            i += 1
+        return value.rstrip()
+    field = field.split('/')[0].strip()
+    if field == 'T':
+        return True
+    elif field == 'F':
+        return False
+    elif field == '':
+        return None
+    try:
+        return int(field)
+    except ValueError:
+        pass
+    try:
+        return float(field.replace('D', 'E'))
+    except ValueError:
+        return field
+
+
+def header_times(entries):
+    """ Convert the 'time' keyword of header entries into hours (in place)
+
+    The conversion is performed for all entries at once.
+
+    Parameters
+    ----------
+    entries : list of dict
+      As returned by read_header_values
+    """
+    if len(entries) == 0 or 'time' not in settings.spect['keyword'].keys():
+        return
+    timeunit = settings.spect['fits']['timeunit']
+    values = [entry['time'] for entry in entries]
+    if timeunit == 's':
+        hours = np.array(values, dtype=np.float)/3600.0    # Convert seconds to hours
+    elif timeunit == 'm':
+        hours = np.array(values, dtype=np.float)/60.0      # Convert minutes to hours
+    elif timeunit in Time.FORMATS.keys():  # Astropy time format
+        if timeunit in ['mjd']:
+            values = np.array(values, dtype=np.float)
+        tval = Time(values, scale='tt', format=timeunit)
+        hours = tval.mjd * 24.0  # Put MJD in hours
+    else:
+        msgs.error('Bad time unit')
+    for entry, value in zip(entries, hours):
+        entry['time'] = value
+
+
+def read_header_values(filename):
+    """ Extract the values of the 'keyword' settings from the headers of a raw file
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    entry : dict
+      The value of every keyword, the 'utc', whether the file passed the
+      'check' settings ('valid'), and whether the headers were read
+      successfully and the entry can be kept in the header index ('cache').
+      The 'time' keyword is as given in the header (see header_times).
+    """
+    headarr, success = read_header_cards(filename), True
+    if headarr is None:
+        headarr, success = read_headers(filename)
+    whddict = dict({})
+    for k, ext in enumerate(header_extensions()):
+        whddict['{0:02d}'.format(ext)] = k
+    entry = dict({'valid': True, 'cache': success})
+    # Perform checks on each fits files, as specified in the settings.instrument file.
+    for ch in settings.spect['check'].keys():
+        tfrhd = int(ch.split('.')[0])-1
+        kchk  = '.'.join(ch.split('.')[1:])
+        frhd  = whddict['{0:02d}'.format(tfrhd)]
+        if settings.spect['check'][ch] != str(headarr[frhd].get(kchk)).strip():
+            print(ch, frhd, kchk)
+            print(settings.spect['check'][ch], str(headarr[frhd].get(kchk)).strip())
+            entry['valid'] = False
+    if not entry['valid']:
+        return entry
+    # Attempt to load a UTC
+    entry['utc'] = None
+    for k in range(len(headarr)):
+        if 'UTC' in headarr[k].keys():
+            entry['utc'] = headarr[k]['UTC']
+            break
+        elif 'UT' in headarr[k].keys():
+            entry['utc'] = headarr[k]['UT']
+            break
+    # Read binning-dependent detector properties here? (maybe read speed too)
+    #if settings.argflag['run']['spectrograph'] in ['lris_blue']:
+    #    arlris.set_det(fitsdict, headarr[k])
+    # Now get the rest of the keywords
+    for kw in settings.spect['keyword'].keys():
+        if settings.spect['keyword'][kw] is None:
+            value = str('None')  # This instrument doesn't have/need this keyword
+        else:
+            ch = settings.spect['keyword'][kw]
+            try:
+                tfrhd = int(ch.split('.')[0])-1
+            except ValueError:
+                value = ch  # Keyword given a value. Only a string allowed for now
+            else:
+                frhd = whddict['{0:02d}'.format(tfrhd)]
+                kchk = '.'.join(ch.split('.')[1:])
+                try:
+                    value = headarr[frhd][kchk]
+                except KeyError: # Keyword not found in header
+                    msgs.warn("{:s} keyword not in header. Setting to None".format(kchk))
+                    value=str('None')
+        # Put the value in the keyword
+        typv = type(value)
+        if typv is int or typv is np.int_:
+            entry[kw] = value
+        elif typv is float or typv is np.float_:
+            entry[kw] = value
+        elif isinstance(value, basestring) or typv is np.string_:
+            entry[kw] = value.strip()
+        elif typv is bool or typv is np.bool_:
+            entry[kw] = value
+        else:
+            msgs.bug("I didn't expect a useful header ({0:s}) to contain type {1:s}".format(kw, typv).replace('<type ','').replace('>',''))
+    return entry
+
+
+class HeaderList(object):
+    """ The headers of the loaded raw files, which are only read when requested
+
+    HeaderList()[i] returns the list of 'fits headext' headers of file i.
+
+    Parameters
+    ----------
+    filenames : list of str
+    """
+    def __init__(self, filenames):
+        self._filenames = list(filenames)
+        self._headers = dict({})
+
+    def __len__(self):
+        return len(self._filenames)
+
+    def __getitem__(self, i):
+        if i not in self._headers:
+            self._headers[i], _ = read_headers(self._filenames[i], setup=True)
+        return self._headers[i]
+
+
+def header_index_file():
+    """ The name of the persistent header index of this reduction
+
+    Returns
+    -------
+    index_file : str or None
+      None if 'run headindex' is False, or there is no reduction file name
+    """
+    if not settings.argflag['run']['headindex']:
+        return None
+    redname = settings.argflag['run'].get('redname')
+    if not isinstance(redname, basestring):
+        return None
+    return redname.replace('.pypit', '') + '.hindex'
+
+
+def header_index_hash():
+    """ A hash of the settings that determine the values in the header index
+
+    Returns
+    -------
+    hash : str
+    """
+    import hashlib
+    pars = [settings.argflag['run']['spectrograph'], settings.spect['fits']['timeunit']]
+    pars += ['{0:s}={1:s}'.format(key, str(settings.spect['keyword'][key]))
+             for key in sorted(settings.spect['keyword'].keys())]
+    pars += ['{0:s}={1:s}'.format(key, str(settings.spect['check'][key]))
+             for key in sorted(settings.spect['check'].keys())]
+    pars += [str(ext) for ext in header_extensions()]
+    return hashlib.md5(';'.join(pars).encode('utf-8')).hexdigest()
+
+
+def load_header_index(index_file):
+    """ Load the persistent header index
+
+    The index is a FITS binary table, with one row per raw file. The
+    path, size and modification time identify the file. The value of
+    each keyword is stored as a string, and a 'types' column holds a
+    type code for each keyword (in the order given by the KEYWORDS
+    header card), so that the values are recovered exactly.
+
+    Parameters
+    ----------
+    index_file : str or None
+
+    Returns
+    -------
+    index : dict
+      An entry (see read_header_values) for each path. Empty if the
+      index does not exist, or was made with different settings.
+    """
+    from astropy.table import Table
+    index = dict({})
+    if index_file is None or not os.path.isfile(index_file):
+        return index
+    # An index that this process has already read or written is kept in memory
+    mtime, pyphash = os.stat(index_file).st_mtime, header_index_hash()
+    if _header_indices.get(index_file, (None, None, None))[:2] == (mtime, pyphash):
+        return dict(_header_indices[index_file][2])
+    try:
+        tbl = Table.read(index_file, format='fits')
+    except Exception:
+        msgs.warn("Could not read the header index {0:s}".format(index_file))
+        return index
+    if tbl.meta.get('PYPHASH') != pyphash:
+        msgs.info("The header index {0:s} is out of date".format(index_file))
+        return index
+    keys = tbl.meta['KEYWORDS'].split(',') if len(tbl.meta['KEYWORDS']) > 0 else []
+    convert = dict({'i': int, 'f': float, 'b': lambda v: v == 'True', 's': lambda v: v, 'n': lambda v: None})
+    for row in tbl:
+        types = row['types']
+        entry = dict({'valid': bool(row['valid']), 'cache': True,
+                      'size': int(row['size']), 'mtime': float(row['mtime'])})
+        for i, kw in enumerate(['utc'] + keys):
+            entry[kw] = convert[types[i]](row[kw])
+        index[row['path']] = entry
+    msgs.info("Loaded the header index {0:s}".format(index_file))
+    _header_indices[index_file] = (mtime, pyphash, dict(index))
+    return index
+
+
+def save_header_index(index_file, index):
+    """ Save the persistent header index (see load_header_index)
+
+    Parameters
+    ----------
+    index_file : str
+    index : dict
+    """
+    from astropy.table import Table
+    keys = list(settings.spect['keyword'].keys())
+    paths = sorted(index.keys())
+    cols = dict({'path': paths, 'types': []})
+    for kw in ['size', 'mtime', 'valid', 'utc'] + keys:
+        cols[kw] = []
+    for path in paths:
+        entry = index[path]
+        types = ''
+        for kw in ['utc'] + keys:
+            value = entry.get(kw)
+            if value is None:
+                types += 'n'
+            elif isinstance(value, (bool, np.bool_)):
+                types += 'b'
+            elif isinstance(value, (int, np.integer)):
+                types += 'i'
+            elif isinstance(value, (float, np.floating)):
+                types += 'f'
+            else:
+                types += 's'
+            cols[kw].append(repr(float(value)) if types[-1] == 'f' else str(value))
+        cols['types'].append(types)
+        cols['size'].append(entry['size'])
+        cols['mtime'].append(entry['mtime'])
+        cols['valid'].append(entry['valid'])
+    names = ['path', 'size', 'mtime', 'valid', 'types', 'utc'] + keys
+    tbl = Table([cols[kw] for kw in names], names=names)
+    tbl.meta['PYPHASH'] = header_index_hash()
+    tbl.meta['KEYWORDS'] = ','.join(keys)
+    try:
+        tbl.write(index_file, format='fits', overwrite=True)
+    except Exception:
+        msgs.warn("Could not write the header index {0:s}".format(index_file))
+    else:
+        msgs.info("Saved the header index {0:s}".format(index_file))
+        _header_indices[index_file] = (os.stat(index_file).st_mtime, tbl.meta['PYPHASH'], dict(index))
+
+
+def frame_dtype(frametype='<None>'):
+    """
+    The floating point type used to process frames of a given type.
+    Calibration frames are processed in single precision if
+    'reduce precision' is 'single'. Science and standard star frames
+    are always processed in double precision.
+
+    Parameters
+    ----------
+    frametype : str, optional
+      The type of frame
+
+    Returns
+    -------
+    dtype : numpy type
+    """
+    if settings.argflag['reduce']['precision'] == 'single' and frametype not in ['science', 'standard']:
+        return np.float32
+    return np.float64
+
+
+def load_raw_frame(fitsdict, idx, det, frametype='<None>', msbias=None, trim=True, gain=False):
+    """
+    Load and process a single raw data frame.
+    Bias subtract (if msbias!=None), trim (if True) and apply the gain
+    (if True) in a single pass through the raw data (see arproc.preprocess_frame)
+
+    Parameters
+    ----------
+    fitsdict : dict
+      Contains relevant information from fits header files
+    idx : int
+      Index of the frame in fitsdict
+    det : int
+      Detector number, starts at 1
+    frametype : str, optional
+      The type of frame being loaded (sets the precision of the frame, see frame_dtype)
+    msbias : ndarray or str, optional
+      Master bias frame, or 'overscan' to subtract the overscan region
+    trim : bool, optional
+      Trim the frame (only when msbias is not None)
+    gain : bool, optional
+      Convert the counts of each amplifier to electrons
+
+    Returns
+    -------
+    frame : ndarray (2 dimensional)
+    """
+    dnum = settings.get_dnum(det)
+    filename = fitsdict['directory'][idx]+fitsdict['filename'][idx]
+    transpose = settings.argflag['trace']['dispersion']['direction'] == 1
+    if isinstance(msbias, basestring) and msbias != "overscan":
+        msgs.error("Could not subtract bias level when loading {0:s} frames".format(frametype))
+    # Instrument specific read
+    if settings.argflag['run']['spectrograph'] in ['lris_blue', 'lris_red']:
+        temp, head0, _ = arlris.read_lris(filename, det=det)
+        temp = temp.T if transpose else temp
+        return arproc.preprocess_frame(temp, det, msbias=msbias, trim=trim, gain=gain,
+                                       dtype=frame_dtype(frametype))
+    with pyfits.open(filename) as hdulist:
+        hdu = raw_hdu(hdulist, settings.spect[dnum]['dataext01'])
+        if isinstance(hdu, pyfits.CompImageHDU):
+            # Only the tiles that are needed are decompressed
+            data = CompressedSection(hdu, transpose=transpose)
+        else:
+            data = hdu.data.T if transpose else hdu.data
+        return arproc.preprocess_frame(data, det, msbias=msbias, trim=trim, gain=gain,
+                                       dtype=frame_dtype(frametype))
+
+
+class RawFrameStack(object):
+    """
+    A stack of raw frames that are converted lazily, in spatial tiles.
+
+    Uncompressed frames are memory-mapped, and only the tiles of tile
+    compressed (e.g. fpack) images that overlap the rows being combined
+    are decompressed. Only the rows of a given tile are scaled,
+    bias/overscan subtracted and trimmed, so the peak memory does not
+    scale with the number of frames in the stack. Other frames (e.g.
+    gzip compressed files, or instruments with a dedicated reader) are
+    processed in full on initialisation with load_raw_frame().
+
+    Parameters
+    ----------
+    fitsdict : dict
+      Contains relevant information from fits header files
+    ind : list or array
+      integers of indices
+    det : int
+      Detector number, starts at 1
+    frametype : str, optional
+      The type of frame being loaded (sets the precision of the frames, see frame_dtype)
+    msbias : ndarray or str, optional
+      Master bias frame, or 'overscan' to subtract the overscan region
+    trim : bool, optional
+      Trim the frames (only when msbias is not None)
+    gain : bool, optional
+      Convert the counts of each amplifier to electrons
+    """
+    def __init__(self, fitsdict, ind, det, frametype='<None>', msbias=None, trim=True, gain=False):
+        self.det = det
+        self.frametype = frametype
+        self.dtype = frame_dtype(frametype)
+        self._msbias = msbias
+        self._trim = trim
+        self._gain = gain
+        self._hdulists = []
+        self._frames = []
+        dnum = settings.get_dnum(det)
+        transpose = settings.argflag['trace']['dispersion']['direction'] == 1
+        if isinstance(msbias, basestring) and msbias != "overscan":
+            msgs.error("Could not subtract bias level when loading {0:s} frames".format(frametype))
+        rawshapes = []
+        for idx in ind:
+            filename = fitsdict['directory'][idx]+fitsdict['filename'][idx]
+            if not self.memmap_allowed(filename):
+                # Process the entire frame now
+                self._frames.append(dict(data=load_raw_frame(fitsdict, idx, det, frametype=frametype,
+                                                             msbias=msbias, trim=trim, gain=gain)))
+                continue
+            hdulist = pyfits.open(filename, memmap=True, do_not_scale_image_data=True)
+            hdu = raw_hdu(hdulist, settings.spect[dnum]['dataext01'])
+            if isinstance(hdu, pyfits.CompImageHDU):
+                data = CompressedSection(hdu, transpose=transpose)
+            else:
+                data = hdu.data.T if transpose else hdu.data
+            frame = dict(data=data, bscale=hdu.header.get('BSCALE', 1.0),
+                         bzero=hdu.header.get('BZERO', 0.0), oscan=None)
+            self._hdulists.append(hdulist)
+            self._frames.append(frame)
+            rawshapes.append(data.shape)
+        # The lazy frames share the indices of the rows and columns that are retained,
+        # so their raw frames must have the same shape
+        if len(set(rawshapes)) > 1:
+            msgs.error("The raw {0:s} frames do not all have the same shape".format(frametype))
+        rawshape = rawshapes[0] if len(rawshapes) > 0 else None
+        # Rows and columns of the raw frames retained in the output
+        if rawshape is not None and msbias is not None and trim:
+            self._xv, self._yv = arproc.trim_indices(rawshape, det)
+        elif rawshape is not None:
+            self._xv, self._yv = np.arange(rawshape[0]), np.arange(rawshape[1])
+        else:
+            self._xv, self._yv = None, None
+        # Check the frames are consistent
+        shapes = []
+        for frame in self._frames:
+            if 'oscan' in frame:
+                shapes.append((self._xv.size, self._yv.size))
+            else:
+                shapes.append(frame['data'].shape)
+        if len(set(shapes)) != 1:
+            msgs.error("The {0:s} frames do not all have the same shape".format(frametype))
+        self.shape = shapes[0] + (len(self._frames),)
+        # Model the overscan regions of all the frames together
+        lazy = [frame for frame in self._frames if 'oscan' in frame]
+        if isinstance(msbias, basestring) and len(lazy) > 0:
+            models = arproc.overscan_models([RawFrameView(frame) for frame in lazy], det)
+            for frame, model in zip(lazy, models):
+                frame['oscan'] = model
+        msgs.info("Memory-mapped or tile compressed {0:d}/{1:d} {2:s} frames".format(
+            len(self._hdulists), self.shape[2], frametype))
+
+    @staticmethod
+    def memmap_allowed(filename):
+        """ Can this raw frame be memory-mapped (or decompressed a section at a time)?
+        """
+        if settings.argflag['run']['spectrograph'] in ['lris_blue', 'lris_red']:
+            return False
+        return os.path.splitext(filename)[1].lower() in ['.fits', '.fit', '.fts', '.fz']
+
+    def read_rows(self, x0, x1):
+        """ Process rows x0:x1 (of the output frames) of every frame in the stack
+
+        Parameters
+        ----------
+        x0 : int
+        x1 : int
+
+        Returns
+        -------
+        block : ndarray (3 dimensional)
+          The processed rows of each frame
+        """
+        block = np.zeros((x1-x0, self.shape[1], self.shape[2]), dtype=self.dtype)
+        for i, frame in enumerate(self._frames):
+            if 'oscan' not in frame:
+                block[:, :, i] = frame['data'][x0:x1, :]
+                continue
+            arproc.preprocess_frame(RawFrameView(frame, dtype=self.dtype), self.det, msbias=self._msbias,
+                                    trim=self._trim, gain=self._gain, oscan=frame['oscan'], rows=(x0, x1),
+                                    out=block[:, :, i])
+        return block
+
+    def tiles(self, nrows):
+        """ Iterate over the stack in blocks of rows
+
+        Parameters
+        ----------
+        nrows : int
+          Number of rows per tile
+
+        Returns
+        -------
+        x0, x1, block : generator of the row range and the processed block
+        """
+        for x0 in range(0, self.shape[0], nrows):
+            x1 = min(x0+nrows, self.shape[0])
+            yield x0, x1, self.read_rows(x0, x1)
+
+    def close(self):
+        for hdulist in self._hdulists:
+            hdulist.close()
+        self._hdulists = []
+
+
+class CompressedSection(object):
+    """ Decompress only the tiles of a tile compressed image that are sliced
+
+    The image can be indexed with slices, integers or index arrays
+    (e.g. from np.ix_). Only the bounding box of the requested pixels
+    is decompressed.
+
+    Parameters
+    ----------
+    hdu : CompImageHDU
+    transpose : bool, optional
+      Index the transpose of the image
+    """
+    def __init__(self, hdu, transpose=False):
+        # Older versions of astropy cannot decompress a section of the image
+        self._section = hdu.section if hasattr(hdu, 'section') else hdu.data
+        self._transpose = transpose
+        self.shape = tuple(hdu.shape[::-1]) if transpose else tuple(hdu.shape)
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        item = item + (slice(None),)*(2-len(item))
+        box, sub = [], []
+        for index in item:
+            if isinstance(index, slice):
+                box.append(index)
+                sub.append(slice(None))
+            else:
+                index = np.asarray(index)
+                if index.size == 0:
+                    box.append(slice(0, 0))
+                    sub.append(index)
+                    continue
+                box.append(slice(int(index.min()), int(index.max())+1))
+                sub.append(index - index.min())
+        if self._transpose:
+            data = self._section[box[1], box[0]].T
+        else:
+            data = self._section[box[0], box[1]]
+        return data[tuple(sub)]
+
+
+class RawFrameView(object):
+    """ Apply the FITS scaling to a memory-mapped raw frame when it is sliced
+
+    Unscaled data are returned in their native type.
+    """
+    def __init__(self, frame, dtype=np.float64):
+        self._frame = frame
+        self.shape = frame['data'].shape
+        self.dtype = dtype
+
+    def _scale(self, data):
+        if self._frame['bscale'] == 1.0 and self._frame['bzero'] == 0.0:
+            return data
+        data = data.astype(self.dtype)
+        if self._frame['bscale'] != 1.0:
+            data *= self._frame['bscale']
+        if self._frame['bzero'] != 0.0:
+            data += self._frame['bzero']
+        return data
+
+    def __getitem__(self, item):
+        return self._scale(self._frame['data'][item])
+
+
+def raw_hdu(hdulist, ext):
+    """ The HDU of a raw file holding a given extension of the original file
+
+    fpack replaces an image in the primary HDU with an empty primary
+    HDU, and stores the compressed image in the first extension. The
+    extensions of these files are offset by one.
+
+    Parameters
+    ----------
+    hdulist : HDUList
+    ext : int
+      Extension of the original (uncompressed) file
+
+    Returns
+    -------
+    hdu : HDU
+    """
+    if len(hdulist) > 1 and isinstance(hdulist[1], pyfits.CompImageHDU) and \
+            'SIMPLE' in hdulist[1].header:
+        ext += 1
+    return hdulist[ext]
+
+
+def load_frames(fitsdict, ind, det, frametype='<None>', msbias=None, trim=True, memmap=False, gain=False):
     """
     Load data frames, usually raw.
-    Bias subtract (if not msbias!=None) and trim (if True)
+    Bias subtract (if not msbias!=None), trim (if True) and apply the gain (if True)
+
+    The frames are read on a pool of 'run ncpus' threads, so that
+    the reading and decompression of one file overlaps with the
+    preprocessing (see arproc.preprocess_frame) of the others. Each
+    frame is written directly into the output cube.
 
     Parameters
     ----------
@@ -181,78 +886,56 @@ def load_frames(fitsdict, ind, det, frametype='<None>', msbias=None, trim=True):
       integers of indices
     det : int
       Detector number, starts at 1
+    memmap : bool, optional
+      If True, and 'reduce memmap' is set, return a RawFrameStack that
+      processes the frames lazily in spatial tiles
+    gain : bool, optional
+      Convert the counts of each amplifier to electrons
 
     Returns
     -------
-    frames : ndarray (3 dimensional)
+    frames : ndarray (3 dimensional) or RawFrameStack
       One image per ind
     """
-    def load_indfr(name,ext):
-        msgs.work("Trim and overscan has not been applied")
-        temp = pyfits.getdata(name, ext)
-        return temp
-
     msgs.info("Loading individual {0:s} frames".format(frametype))
-    # Get detector number
-    dnum = settings.get_dnum(det)
     if np.size(ind) == 0:
         msgs.warn("No {0:s} frames to load".format(frametype))
         return None
-    msgs.work("Implement multiprocessing here (better -- at the moment it's slower than not) to speed up data reading")
-    for i in range(np.size(ind)):
-        # Instrument specific read
-        if settings.argflag['run']['spectrograph'] in ['lris_blue', 'lris_red']:
-            temp, head0, _ = arlris.read_lris(fitsdict['directory'][ind[i]]+fitsdict['filename'][ind[i]], det=det)
-        else:
-            hdulist = pyfits.open(fitsdict['directory'][ind[i]]+fitsdict['filename'][ind[i]])
-            temp = hdulist[settings.spect[dnum]['dataext01']].data
-            head0 = hdulist[0].header
-        temp = temp.astype(np.float)  # Let us avoid uint16
-        if settings.argflag['trace']['dispersion']['direction'] == 1:
-            temp = temp.T
-        if msbias is not None:
-            if type(msbias) is np.ndarray:
-                temp -= msbias  # Subtract the master bias frame
-            elif isinstance(msbias,basestring):
-                if msbias == "overscan":
-                    arproc.sub_overscan(temp, det)
-                else:
-                    msgs.error("Could not subtract bias level when loading {0:s} frames".format(frametype))
-            if trim:
-                temp = arproc.trim(temp, det)
-        # Save image
-        if i == 0:
-            frames = np.zeros((temp.shape[0], temp.shape[1], np.size(ind)))
-            frames[:,:,i] = temp.copy()
-        else:
-            frames[:,:,i] = temp.copy()
-        del temp
-
-#	pool = mpPool(processes=np.min([settings.argflag['run']['ncpus'],np.size(ind)]))
-#	async_results = []
-#	for i in range(np.size(ind)):
-#		async_results.append(pool.apply_async(pyfits.getdata, (fitsdict['directory'][ind[i]]+fitsdict['filename'][ind[i]], settings.spect['fits']['dataext'])))
-#	pool.close()
-#	pool.join()
-#	map(ApplyResult.wait, async_results)
-#	for j in range(np.size(ind)):
-#		if j == 0:
-#			temp = async_results[j].get()
-#			frames = np.zeros((temp.shape[0], temp.shape[1], np.size(ind)))
-#			if msbias is None:
-#				frames[:,:,i] = temp
-#			else:
-#				frames[:,:,i] = temp - msbias
-#			del temp
-#		else:
-#			if msbias is None:
-#				frames[:,:,i] = async_results[j].get()
-#			else:
-#				frames[:,:,i] = async_results[j].get() - msbias
-    if np.size(ind) == 1:
-        msgs.info("Loaded {0:d} {1:s} frame successfully".format(np.size(ind), frametype))
+    ind = np.atleast_1d(ind)
+    if memmap and settings.argflag['reduce']['memmap']:
+        return RawFrameStack(fitsdict, ind, det, frametype=frametype, msbias=msbias, trim=trim, gain=gain)
+    numfr = np.size(ind)
+    tstart = time.time()
+    # The first frame sets the size of the output cube
+    temp = load_raw_frame(fitsdict, ind[0], det, frametype=frametype, msbias=msbias, trim=trim, gain=gain)
+    frames = np.zeros((temp.shape[0], temp.shape[1], numfr), dtype=temp.dtype)
+    frames[:, :, 0] = temp
+    del temp
+    timings = [time.time()-tstart]
+
+    def fill_frame(i):
+        tfr = time.time()
+        temp = load_raw_frame(fitsdict, ind[i], det, frametype=frametype, msbias=msbias, trim=trim, gain=gain)
+        if temp.shape != frames.shape[:2]:
+            msgs.error("The {0:s} frame below has a different shape to the first frame:".format(frametype) +
+                       msgs.newline() + fitsdict['filename'][ind[i]])
+        frames[:, :, i] = temp
+        return time.time()-tfr
+
+    # Read the remaining frames
+    nthread = max(1, min(settings.argflag['run']['ncpus'], numfr-1))
+    if nthread > 1:
+        msgs.info("Reading {0:d} {1:s} frames with {2:d} threads".format(numfr-1, frametype, nthread))
+    timings += arutils.thread_map(fill_frame, range(1, numfr), nthread)
+    # Report the timings
+    for i in range(numfr):
+        msgs.info("Loaded {0:s} in {1:.2f}s".format(fitsdict['filename'][ind[i]], timings[i]))
+    if numfr == 1:
+        msgs.info("Loaded {0:d} {1:s} frame successfully".format(numfr, frametype))
     else:
-        msgs.info("Loaded {0:d} {1:s} frames successfully".format(np.size(ind), frametype))
+        msgs.info("Loaded {0:d} {1:s} frames successfully".format(numfr, frametype))
+    msgs.info("Frame loading took {0:.2f}s ({1:.2f}s summed over files)".format(time.time()-tstart,
+                                                                                np.sum(timings)))
     return frames
 
 
@@ -298,7 +981,7 @@ def load_extraction(name, frametype='<None>', wave=True):
         return sciext, props
 
 
-def load_master(name, exten=0, frametype='<None>'):
+def load_master(name, exten=0, frametype='<None>', section=None):
     """
     Load a pre-existing master calibration frame
 
@@ -309,13 +992,29 @@ def load_master(name, exten=0, frametype='<None>'):
     exten : int, optional
     frametype : str, optional
       The type of master calibration frame being loaded.
-      This keyword is only used for terminal print out.
+      This keyword is only used for terminal print out, except
+      for a single file of master frames (.hdf5), where it
+      selects the master frame.
+    section : tuple of slice, optional
+      Only load this section of the frame (e.g. the columns
+      of one slit)
 
     Returns
     -------
     frame : ndarray
       The data from the master calibration frame
     """
+    if name.endswith('.hdf5'):
+        msgs.info("Loading Master {0:s} frame:".format(frametype)+msgs.newline()+name)
+        grp = master_bundle_group(name, frametype)
+        try:
+            if frametype == 'wv_calib':
+                return json.loads(grp['json'][()].decode('utf-8'))
+            data = grp[str(exten)][Ellipsis if section is None else section].astype(np.float)
+            head = dict(grp.attrs)
+        finally:
+            grp.file.close()
+        return data, head
     if frametype is None:
         msgs.info("Loading a pre-existing master calibration frame")
         try:
@@ -324,7 +1023,7 @@ def load_master(name, exten=0, frametype='<None>'):
             msgs.error("Master calibration file does not exist:"+msgs.newline()+name)
         msgs.info("Master {0:s} frame loaded successfully:".format(hdu[0].header['FRAMETYP'])+msgs.newline()+name)
         head = hdu[0].header
-        data = hdu[exten].data.astype(np.float)
+        data = (hdu[exten].data if section is None else hdu[exten].section[section]).astype(np.float)
         return data, head
         #return np.array(infile[0].data, dtype=np.float)
     else:
@@ -337,11 +1036,66 @@ def load_master(name, exten=0, frametype='<None>'):
             # Load
             hdu = pyfits.open(name)
             head = hdu[0].header
-            data = hdu[exten].data.astype(np.float)
+            data = (hdu[exten].data if section is None else hdu[exten].section[section]).astype(np.float)
             return data, head
         #return np.array(pyfits.getdata(name, 0), dtype=np.float)
 
 
+def load_master_header(name, frametype=None):
+    """
+    Load the header of a pre-existing master calibration frame,
+    without reading the frame itself
+
+    Parameters
+    ----------
+    name : str
+      Name of the master calibration file
+    frametype : str, optional
+      The type of master calibration frame (needed for a single
+      file of master frames)
+
+    Returns
+    -------
+    head : Header or dict
+    """
+    if name.endswith('.hdf5'):
+        grp = master_bundle_group(name, frametype)
+        head = dict(grp.attrs)
+        grp.file.close()
+        return head
+    return pyfits.getheader(name, 0)
+
+
+def master_bundle_group(name, frametype):
+    """
+    Open the group of a master frame in a single file of
+    master frames (see arsave.save_master_bundle)
+
+    Parameters
+    ----------
+    name : str
+      Name of the .hdf5 file
+    frametype : str
+      The type of master calibration frame
+
+    Returns
+    -------
+    grp : h5py.Group
+      The caller should close grp.file
+    """
+    import h5py
+    # Groups are named as in armasters.master_name
+    groups = {'wv_calib': 'wave_calib', 'slit profile': 'slitprof'}
+    frametype = groups.get(frametype, frametype)
+    if not os.path.exists(name):
+        raise IOError("No such file: {0:s}".format(name))
+    hdf = h5py.File(name, 'r')
+    if frametype not in hdf:
+        hdf.close()
+        raise IOError("No master {0:s} frame in {1:s}".format(frametype, name))
+    return hdf[frametype]
+
+
 def load_ordloc(fname):
     # Load the files
     mstrace_bname, mstrace_bext = os.path.splitext(fname)
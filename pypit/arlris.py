@@ -1,6 +1,7 @@
 # Module for LRIS specific codes
 from __future__ import absolute_import, division, print_function
 
+import os
 import numpy as np
 import glob
 import astropy.io.fits as pyfits
@@ -18,6 +19,9 @@ except NameError:  # For Python 3
 # Logging
 msgs = armsgs.get_logger()
 
+# Amplifier layouts computed by lris_geometry, for each configuration
+_lris_geometry = dict({})
+
 
 def read_lris(raw_file, det=None, TRIM=False):
     """
@@ -25,6 +29,10 @@ def read_lris(raw_file, det=None, TRIM=False):
     Packed in a multi-extension HDU
     Based on readmhdufits.pro
 
+    The layout of the amplifiers is computed once for each configuration
+    (see lris_geometry), only the data of the amplifiers of the requested
+    detector are read, and they are copied directly into the output array.
+
     Parameters
     ----------
     raw_file : str
@@ -44,15 +52,80 @@ def read_lris(raw_file, det=None, TRIM=False):
     """
 
     # Check for file; allow for extra .gz, etc. suffix
-    fil = glob.glob(raw_file+'*') 
+    if os.path.isfile(raw_file):
+        fil = [raw_file]
+    else:
+        fil = glob.glob(raw_file+'*')
     if len(fil) != 1:
-        msgs.error("Found {:d} files matching {:s}".format(len(fil)))
+        msgs.error("Found {:d} files matching {:s}".format(len(fil), raw_file))
 
     # Read
     msgs.info("Reading LRIS file: {:s}".format(fil[0]))
     hdu = pyfits.open(fil[0])
     head0 = hdu[0].header
 
+    # Amplifier layout for this configuration
+    geom = lris_geometry(head0, [hdu[i].header for i in range(1, len(hdu))], det=det, TRIM=TRIM)
+
+    # allocate output array...
+    array = np.zeros((geom['nx'], geom['ny']))
+
+    # insert the amplifiers of the requested detector into the master image...
+    for ext, yflip, pieces in geom['amps']:
+        temp = hdu[ext].data.T  # Silly Python nrow,ncol formatting
+        for sx, dx, sy, dy, xflip in pieces:
+            src = temp[sx[0]:sx[1], :]
+            if xflip:
+                src = src[::-1, :]
+            if yflip:
+                src = src[:, ::-1]
+            array[dx[0]:dx[1], dy[0]:dy[1]] = src[:, sy[0]:sy[1]]
+    hdu.close()
+
+    # make sure BZERO is a valid integer for IRAF
+    obzero = head0['BZERO']
+    head0['O_BZERO'] = obzero
+    head0['BZERO'] = 32768-obzero
+
+    # Return, transposing array back to goofy Python indexing
+    return array.T, head0, (list(geom['dsec']), list(geom['osec']))
+
+
+def lris_geometry(head0, amp_heads, det=None, TRIM=False):
+    """
+    The layout of the amplifiers of an LRIS frame in the array
+    assembled by read_lris.
+
+    The layout only depends on the binning, the pre/post scan
+    regions and the DETSEC/DATASEC/size of each amplifier, so it
+    is computed once for each configuration and cached.
+
+    Parameters
+    ----------
+    head0 : FITS header
+      Primary header
+    amp_heads : list of FITS headers
+      Headers of the amplifier extensions (1, 2, ...)
+    det : int, optional
+      Detector number; Default = both
+    TRIM : bool, optional
+      Trim the image?
+
+    Returns
+    -------
+    geom : dict
+      nx, ny : size of the output array (before it is transposed)
+      amps : list of (extension, yflip, pieces), where each piece is
+        (source x range, output x range, source y range, output y range, xflip)
+        of the transposed amplifier data
+      dsec, osec : data and overscan sections
+    """
+    key = (head0['BINNING'], head0['PRECOL'], head0['POSTPIX'], head0['PRELINE'], head0['POSTLINE'],
+           tuple([(head['DETSEC'], head.get('DATASEC'), head.get('NAXIS1'), head.get('NAXIS2'))
+                  for head in amp_heads]), det, TRIM)
+    if key in _lris_geometry:
+        return _lris_geometry[key]
+
     # Get post, pre-pix values
     precol = head0['PRECOL']
     postpix = head0['POSTPIX']
@@ -68,14 +141,13 @@ def read_lris(raw_file, det=None, TRIM=False):
     xbin, ybin = [int(ibin) for ibin in binning.split(',')]
 
     # First read over the header info to determine the size of the output array...
-    n_ext = len(hdu)-1  # Number of extensions (usually 4)
+    n_ext = len(amp_heads)  # Number of extensions (usually 4)
     xcol = []
     xmax = 0
     ymax = 0
     xmin = 10000
     ymin = 10000
-    for i in np.arange(1, n_ext+1):
-        theader = hdu[i].header
+    for theader in amp_heads:
         detsec = theader['DETSEC']
         if detsec != '0':
             # parse the DETSEC keyword to determine the size of the array.
@@ -113,9 +185,7 @@ def read_lris(raw_file, det=None, TRIM=False):
         nx = nx // 2
         n_ext = n_ext // 2
         det_idx = np.arange(n_ext, dtype=np.int) + (det-1)*n_ext
-        ndet = 1
     elif det is None:
-        ndet = 2
         det_idx = np.arange(n_ext).astype(int)
     else:
         raise ValueError('Bad value for det')
@@ -125,91 +195,55 @@ def read_lris(raw_file, det=None, TRIM=False):
         nx += n_ext*(precol+postpix)
         ny += preline + postline
 
-    # allocate output array...
-    array = np.zeros( (nx, ny) )
     order = np.argsort(np.array(xcol))
-
-
-    # insert extensions into master image...
+    xshape = 1024 // xbin
+    amps = []
     for kk, i in enumerate(order[det_idx]):
-
-        # grab complete extension...
-        data, predata, postdata, x1, y1 = lris_read_amp(hdu, i+1)
-                            #, linebias=linebias, nobias=nobias, $
-                            #x1=x1, x2=x2, y1=y1, y2=y2, gaindata=gaindata)
-        # insert components into output array...
+        header = amp_heads[i]
+        # Size of the transposed amplifier data
+        nxt, nydata = header['NAXIS1'], header['NAXIS2']
+        # parse the DETSEC keyword to determine the position of the amplifier.
+        x1, x2, y1, y2 = np.array(load_sections(header['DETSEC'])).flatten()
+        # parse the DATASEC keyword to determine the size of the science region (unbinned)
+        xdata1, xdata2, ydata1, ydata2 = np.array(load_sections(header['DATASEC'])).flatten()
+        # datasec appears to have the x value for the keywords that are zero
+        # based. This is only true in the image header extensions
+        # not true in the main header.  They also appear inconsistent between
+        # LRISr and LRISb!
+        if (xdata1-1) != precol:
+            msgs.error("Something wrong in LRIS datasec or precol")
+        if (xshape+precol+postpix) != nxt:
+            msgs.error("Wrong size for in LRIS detector somewhere.  Funny binning?")
+        # flip in X and Y as needed...
+        xflip = x1 > x2
+        yflip = y1 > y2
+        x1, y1 = min(x1, x2), min(y1, y2)
+        pieces = []
         if not TRIM:
-            # insert predata...
-            buf = predata.shape
-            nxpre = buf[0]
+            # predata...
             xs = kk*precol
-            xe = xs + nxpre
-            '''
-            if keyword_set(VERBOSITY) then begin
-                section = '['+stringify(xs)+':'+stringify(xe)+',*]'
-                message, 'inserting extension '+stringify(i)+ $
-                         ' predata  in '+section, /info
-            endif 
-            '''
-            array[xs:xe, :] = predata
-
-            # insert data...
-            buf = data.shape
-            nxdata = buf[0]
-            nydata = buf[1]
-            xs = n_ext*precol + kk*nxdata #(x1-xmin)/xbin
-            xe = xs + nxdata
+            pieces.append(((0, precol), (xs, xs+precol), (0, nydata), (0, ny), False))
+            # data...
+            xs = n_ext*precol + kk*xshape
+            pieces.append(((precol, precol+xshape), (xs, xs+xshape), (0, nydata), (0, ny), xflip))
             # Data section
-            section = '[{:d}:{:d},{:d}:{:d}]'.format(preline,nydata-postline, xs, xe)  # Eliminate lines
-            dsec.append(section)
-            #print('data',xs,xe)
-            array[xs:xe, :] = data   # Include postlines
-
-            #; insert postdata...
-            buf = postdata.shape
-            nxpost = buf[0]
+            dsec.append('[{:d}:{:d},{:d}:{:d}]'.format(preline, nydata-postline, xs, xs+xshape))  # Eliminate lines
+            # postdata...
             xs = nx - n_ext*postpix + kk*postpix
-            xe = xs + nxpost 
-            section = '[:,{:d}:{:d}]'.format(xs, xe)
-            osec.append(section)
-            '''
-            if keyword_set(VERBOSITY) then begin
-                section = '['+stringify(xs)+':'+stringify(xe)+',*]'
-                message, 'inserting extension '+stringify(i)+ $
-                         ' postdata in '+section, /info
-            endif 
-            '''
-            array[xs:xe, :] = postdata
+            pieces.append(((nxt-postpix, nxt), (xs, xs+postpix), (0, nydata), (0, ny), False))
+            osec.append('[:,{:d}:{:d}]'.format(xs, xs+postpix))
         else:
-            buf = data.shape
-            nxdata = buf[0]
-            nydata = buf[1]
-
             xs = (x1-xmin)//xbin
-            xe = xs + nxdata 
+            if det == 2:
+                xs -= nx  # Relative to the start of the second detector
             ys = (y1-ymin)//ybin
-            ye = ys + nydata - postline
-
-            yin1 = preline
-            yin2 = nydata - postline 
-
-            '''
-            if keyword_set(VERBOSITY) then begin
-                section = '['+stringify(xs)+':'+stringify(xe)+ $
-                          ','+stringify(ys)+':'+stringify(ye)+']'
-                message, 'inserting extension '+stringify(i)+ $
-                         ' data     in '+section, /info
-            endif 
-            '''
-            array[xs:xe, ys:ye] = data[:, yin1:yin2]
-
-    # make sure BZERO is a valid integer for IRAF
-    obzero = head0['BZERO']
-    head0['O_BZERO'] = obzero
-    head0['BZERO'] = 32768-obzero
+            pieces.append(((precol, precol+xshape), (xs, xs+xshape), (preline, nydata-postline),
+                           (ys, ys+nydata-postline-preline), xflip))
+        amps.append((i+1, yflip, pieces))
 
-    # Return, transposing array back to goofy Python indexing
-    return array.T, head0, (dsec, osec)
+    geom = dict(nx=nx, ny=ny, amps=amps, dsec=dsec, osec=osec)
+    _lris_geometry[key] = geom
+    return geom
 
 
 def lris_read_amp(inp, ext):
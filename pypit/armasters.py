@@ -1,8 +1,20 @@
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 
+import atexit
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from collections import OrderedDict
+
 from pypit import armsgs
+from pypit import arload
 from pypit import arparse as settings
 from pypit import arsave
+from pypit import pyputils
 
 try:
     basestring
@@ -52,19 +64,389 @@ class MasterFrames:
         self._mspixelflat_name = [None for all in range(ndet)]  # Master Pixel Flat Name
 
 
-def master_name(ftype, setup, mdir=None):
+# The inputs that determine each master frame: the ScienceExposure attribute
+# holding the indices of the raw frames that are used, the settings used to
+# build the frame (given as paths into argflag, where a leading '!' excludes
+# part of a previous path), and the master frames it is built from. This is
+# the dependency graph of the master frames: a change to the inputs of one
+# master frame changes the keys of all of the master frames built from it.
+master_inputs = dict(bias=('_idx_bias', ['bias', 'reduce.overscan', 'reduce.trim', 'reduce.precision'], []),
+                     arc=('_idx_arcs', ['arc.useframe', 'arc.combine'], ['bias']),
+                     trace=('_idx_trace', ['trace.useframe', 'trace.combine', 'trace.dispersion', 'trace.slits',
+                                           '!trace.slits.tilts', 'reduce.trace'], ['bias']),
+                     pinhole=('_idx_cent', ['pinhole', 'reduce.slitcen'], ['bias']),
+                     pixelflat=('_idx_flat', ['pixelflat', 'reduce.flatfield'], ['bias']),
+                     normpixelflat=('_idx_flat', ['reduce.flatfield', 'reduce.slitprofile'], ['pixelflat', 'trace']),
+                     wave_calib=('_idx_arcs', ['arc.calibrate', 'arc.extract', 'arc.load'], ['arc', 'trace']),
+                     tilts=('_idx_arcs', ['trace.slits.tilts'], ['arc', 'trace', 'wave_calib']),
+                     wave=('_idx_arcs', ['reduce.calibrate'], ['tilts', 'wave_calib']))
+
+
+# md5 checksums of the raw files, keyed by their name, size and modification time
+_checksums = {}
+
+
+def file_checksum(filename):
+    """ The md5 checksum of a file
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    checksum : str
+    """
+    stat = os.stat(filename)
+    ckey = (filename, stat.st_size, stat.st_mtime)
+    if ckey not in _checksums:
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                md5.update(chunk)
+        _checksums[ckey] = md5.hexdigest()
+    return _checksums[ckey]
+
+
+def master_settings(ftype):
+    """ The settings used to build a master frame
+
+    Parameters
+    ----------
+    ftype : str
+      Type of master frame (one of the keys of master_inputs)
+
+    Returns
+    -------
+    msettings : dict
+      The value of each path into argflag given in master_inputs
+    """
+    msettings = {}
+    for section in master_inputs[ftype][1]:
+        if section.startswith('!'):
+            path = section[1:].split('.')
+            for ii in range(len(path)-1, 0, -1):
+                if '.'.join(path[:ii]) in msettings:
+                    value = msettings['.'.join(path[:ii])]
+                    for key in path[ii:-1]:
+                        value = value[key]
+                    del value[path[-1]]
+                    break
+            continue
+        value = settings.argflag
+        for key in section.split('.'):
+            value = value[key]
+        msettings[section] = copy.deepcopy(value) if isinstance(value, dict) else value
+    return msettings
+
+
+def master_key(slf, ftype, det, provenance=False):
+    """ The content address of a master calibration frame
+
+    This is the md5 hash of the frame type, the detector, the raw frames,
+    the settings used to build the frame and the content addresses of
+    the master frames that it is built from. Two science exposures with
+    the same key for a given frame type will use an identical master frame.
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    ftype : str
+      Type of master frame (one of the keys of master_inputs)
+    det : int
+      Detector index (starting from 1)
+    provenance : bool, optional
+      Identify the raw frames by the checksums of their files (and include
+      the PYPIT version), rather than by their indices in this reduction.
+      Use this for master frames that are saved to disk.
+
+    Returns
+    -------
+    key : str
+    """
+    idxattr, sections, parents = master_inputs[ftype]
+    inputs = dict(ftype=ftype, det=det, spectrograph=settings.argflag['run']['spectrograph'],
+                  parents=[master_key(slf, parent, det, provenance=provenance) for parent in parents],
+                  settings=master_settings(ftype))
+    if provenance:
+        inputs['files'] = [file_checksum(slf._fitsdict['directory'][i]+slf._fitsdict['filename'][i])
+                           for i in getattr(slf, idxattr)]
+        inputs['version'] = pyputils.get_version()[0]
+    else:
+        inputs['index'] = [int(i) for i in getattr(slf, idxattr)]
+    return settings.FrozenSettings(inputs).key
+
+
+def master_provenance(slf, ftype, det):
+    """ Provenance of a master frame, to be saved with it
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    ftype : str
+      Type of master frame (one of the keys of master_inputs)
+    det : int
+      Detector index (starting from 1)
+
+    Returns
+    -------
+    prov : OrderedDict
+      PYPKEY is the key of the master frame (see master_key), PYPVER is
+      the PYPIT version, PYPSETT holds the settings used to build the
+      frame (as JSON), and FMD5nnn is the checksum of each raw frame.
+    """
+    prov = OrderedDict()
+    prov['PYPKEY'] = master_key(slf, ftype, det, provenance=True)
+    prov['PYPVER'] = pyputils.get_version()[0]
+    prov['PYPSETT'] = json.dumps(master_settings(ftype), sort_keys=True, default=str)
+    for i, idx in enumerate(getattr(slf, master_inputs[ftype][0])):
+        prov['FMD5{0:03d}'.format(i+1)] = file_checksum(slf._fitsdict['directory'][idx]+slf._fitsdict['filename'][idx])
+    return prov
+
+
+def master_uptodate(slf, ftype, det, head):
+    """ Can a master frame that was loaded from disk be reused?
+
+    It can if it was built from the same raw frames and settings (and the
+    same version of PYPIT) as it would be now, and the master frames that
+    it depends on are also up to date.
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    ftype : str
+      Type of master frame (one of the keys of master_inputs)
+    det : int
+      Detector index (starting from 1)
+    head : Header or dict
+      Header of the loaded master frame (see master_provenance)
+
+    Returns
+    -------
+    uptodate : bool
+    """
+    if head.get('PYPKEY', None) == master_key(slf, ftype, det, provenance=True):
+        return True
+    msgs.warn("The master {0:s} frame on disk is out of date (the raw frames, settings".format(ftype) +
+              msgs.newline() + "or master frames it depends on have changed) -- it will be rebuilt")
+    return False
+
+
+class MasterStore(object):
+    """ A store of the master calibration frames shared by the science exposures
+
+    Each master frame is held read-only under its content address (see
+    master_key), so that every science exposure that uses an identical
+    master frame shares a single array. When the frames held in memory
+    exceed the cache size, the least recently used frames are written to
+    a temporary directory, and are memory mapped from there (read-only)
+    when they are next requested. Frames that can be read from a file in
+    the MasterFrames directory (see register) are simply released from
+    memory instead, and are read again when they are next requested.
+
+    Parameters
+    ----------
+    cachesize : float, optional
+      Memory (in MB) of the frames held in memory, where <= 0 means no
+      limit. Taken from settings.argflag['reduce']['masters']['cachesize']
+      by default.
+    """
+
+    def __init__(self, cachesize=None):
+        if cachesize is None:
+            cachesize = settings.argflag['reduce']['masters']['cachesize']
+        self._maxbytes = cachesize*1024.0**2
+        self._frames = OrderedDict()   # Frames in memory, least recently used first
+        self._spilled = {}             # Filenames of the frames spilled to disk
+        self._sources = {}             # Functions that read the frames from the MasterFrames directory
+        self._nbytes = 0
+        self._spilldir = None
+
+    def __contains__(self, key):
+        return (key in self._frames) or (key in self._spilled) or (key in self._sources)
+
+    def get(self, key):
+        """ Return the (read-only) master frame with a given key, or None
+        """
+        if key in self._frames:
+            # Mark as the most recently used
+            frame = self._frames.pop(key)
+            self._frames[key] = frame
+            return frame
+        elif key in self._spilled:
+            return np.load(self._spilled[key], mmap_mode='r')
+        elif key in self._sources:
+            frame = self._sources[key]()
+            self._add(key, frame)
+            return frame
+        return None
+
+    def put(self, key, frame):
+        """ Add a master frame to the store
+
+        The store holds a read-only view of the frame (the frame itself
+        stays writable, but should not be modified). If the store already
+        holds a frame with this key, that frame is kept instead.
+
+        Parameters
+        ----------
+        key : str
+          Content address of the frame (see master_key)
+        frame : ndarray
+
+        Returns
+        -------
+        ref : MasterRef
+          A reference to the stored frame
+        """
+        if key not in self._frames and key not in self._spilled:
+            self._add(key, frame)
+        return MasterRef(self, key)
+
+    def register(self, key, loader):
+        """ Register a function that reads a master frame from disk
+
+        The frame is read when it is first requested, and is released
+        from memory (rather than spilled to disk) when the store is full.
+
+        Parameters
+        ----------
+        key : str
+          Content address of the frame (see master_key)
+        loader : callable
+          Function (without arguments) that returns the frame (see master_loader)
+
+        Returns
+        -------
+        ref : MasterRef
+          A reference to the stored frame
+        """
+        self._sources[key] = loader
+        return MasterRef(self, key)
+
+    def clear(self):
+        """ Remove all frames from the store (and from disk)
+        """
+        self._frames.clear()
+        self._spilled = {}
+        self._sources = {}
+        self._nbytes = 0
+        if self._spilldir is not None:
+            shutil.rmtree(self._spilldir, ignore_errors=True)
+            self._spilldir = None
+
+    def _add(self, key, frame):
+        """ Hold a read-only view of a frame in memory
+        """
+        frame = frame.view()
+        frame.setflags(write=False)
+        self._frames[key] = frame
+        self._nbytes += frame.nbytes
+        self._spill()
+
+    def _spill(self):
+        """ Spill the least recently used frames to disk until the
+        frames in memory fit within the cache size. The most recently
+        used frame is always kept in memory.
+        """
+        if self._maxbytes <= 0.0:
+            return
+        while self._nbytes > self._maxbytes and len(self._frames) > 1:
+            key, frame = self._frames.popitem(last=False)
+            self._nbytes -= frame.nbytes
+            if key in self._sources:
+                msgs.info("Master frame cache is full -- released a master frame from memory")
+                continue
+            if self._spilldir is None:
+                self._spilldir = tempfile.mkdtemp(prefix='pypit_masters_')
+                atexit.register(self.clear)
+            filename = os.path.join(self._spilldir, key+'.npy')
+            np.save(filename, frame)
+            self._spilled[key] = filename
+            msgs.info("Master frame cache is full -- moved a master frame to disk")
+
+
+class MasterRef(object):
+    """ A reference to a master frame held in a MasterStore
+    """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def get(self):
+        return self.store.get(self.key)
+
+
+class MasterSlots(list):
+    """ The master frames of each detector
+
+    A list that returns the frame held in a MasterStore in place of any
+    MasterRef that it contains, so that slots[det-1] always gives the
+    master frame itself.
+    """
+
+    def __getitem__(self, item):
+        value = list.__getitem__(self, item)
+        if isinstance(value, MasterRef):
+            return value.get()
+        return value
+
+    def ref(self, item):
+        """ Return the content of a slot, without reading a referenced frame
+        """
+        return list.__getitem__(self, item)
+
+
+def master_loader(name, ftype, exten=0):
+    """ A function that reads a master frame from disk
+
+    Parameters
+    ----------
+    name : str
+      Name of the master frame file
+    ftype : str
+      Type of master frame
+    exten : int, optional
+      Extension of the file holding the frame
+
+    Returns
+    -------
+    loader : function
+      Returns the frame, in the same precision as a master frame built
+      by ScienceExposure
+    """
+    def loader():
+        frame, head = arload.load_master(name, exten=exten, frametype=ftype)
+        if ftype in ["bias", "normpixelflat"]:
+            frame = frame.astype(arload.frame_dtype(ftype), copy=False)
+        return frame
+    return loader
+
+
+def master_name(ftype, setup, mdir=None, bundle=None):
     """ Default filenames
     Parameters
     ----------
     ftype
     mdir : str, optional
       Master directory; usually taken from settings
+    bundle : bool, optional
+      Are all of the master frames of a setup saved to a single HDF5 file?
+      Usually taken from settings (reduce masters format)
 
     Returns
     -------
     """
     if mdir is None:
         mdir = settings.argflag['run']['directory']['master']+'_'+settings.argflag['run']['spectrograph']
+    if bundle is None:
+        bundle = (settings.argflag is not None) and (settings.argflag['reduce']['masters']['format'] == 'hdf5')
+    if bundle:
+        return '{:s}/Masters_{:s}.hdf5'.format(mdir, setup)
     name_dict = dict(bias='{:s}/MasterBias_{:s}.fits'.format(mdir, setup),
                      badpix='{:s}/MasterBadPix_{:s}.fits'.format(mdir, setup),
                      trace='{:s}/MasterTrace_{:s}.fits'.format(mdir, setup),
@@ -126,18 +508,31 @@ def save_masters(slf, det, setup):
     import io, json
 
     transpose = bool(settings.argflag['trace']['dispersion']['direction'])
+    # With reduce masters format hdf5, the master frames are written together to a single file
+    hdf5 = settings.argflag['reduce']['masters']['format'] == 'hdf5'
+    bundle = []
+    saved = []
+
+    def provenance(ftype, **keywds):
+        # The raw frames and provenance of each master frame are written to its header
+        keywds.update(master_provenance(slf, ftype, det))
+        return dict(ind=getattr(slf, master_inputs[ftype][0]), keywds=keywds)
+
+    def save(ftype, data, **kwargs):
+        if ftype in master_inputs:
+            saved.append(ftype)
+        if hdf5:
+            bundle.append(dict(ftype=ftype, data=data, **kwargs))
+        else:
+            arsave.save_master(slf, data, filename=master_name(ftype, setup), **kwargs)
 
     # Bias
     if 'bias'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
         if not isinstance(slf._msbias[det-1], (basestring)):
-            arsave.save_master(slf, slf._msbias[det-1],
-                               filename=master_name('bias', setup),
-                               frametype='bias')
+            save('bias', slf._msbias[det-1], frametype='bias', **provenance('bias'))
     # Bad Pixel
     if 'badpix'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
-        arsave.save_master(slf, slf._bpix[det-1],
-                               filename=master_name('badpix', setup),
-                               frametype='badpix')
+        save('badpix', slf._bpix[det-1], frametype='badpix')
     # Trace
     if 'trace'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
         extensions = [slf._lordloc[det-1], slf._rordloc[det-1],
@@ -145,46 +540,54 @@ def save_masters(slf, det, setup):
                       slf._lordpix[det-1], slf._rordpix[det-1],
                       slf._slitpix[det-1]]
         names = ['LeftEdges_det', 'RightEdges_det', 'SlitCentre', 'SlitLength', 'LeftEdges_pix', 'RightEdges_pix', 'SlitPixels']
-        arsave.save_master(slf, slf._mstrace[det-1],
-                           filename=master_name('trace', setup),
-                           frametype='trace', extensions=extensions, names=names)
+        save('trace', slf._mstrace[det-1], frametype='trace', extensions=extensions, names=names,
+             **provenance('trace'))
     # Pixel Flat
     if 'normpixelflat'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
-        arsave.save_master(slf, slf._mspixelflatnrm[det-1],
-                           filename=master_name('normpixelflat', setup),
-                           frametype='normpixelflat')
+        save('normpixelflat', slf._mspixelflatnrm[det-1], frametype='normpixelflat', **provenance('normpixelflat'))
     # Pinhole Flat
     if 'pinhole'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
-        arsave.save_master(slf, slf._mspinhole[det-1],
-                           filename=master_name('pinhole', setup),
-                           frametype='pinhole')
+        save('pinhole', slf._mspinhole[det-1], frametype='pinhole', **provenance('pinhole'))
     # Arc/Wave
     if 'arc'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
-        arsave.save_master(slf, slf._msarc[det-1],
-                           filename=master_name('arc', setup),
-                           frametype='arc', keywds=dict(transp=transpose))
+        save('arc', slf._msarc[det-1], frametype='arc', **provenance('arc', transp=transpose))
     if 'wave'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
         # Wavelength image
-        arsave.save_master(slf, slf._mswave[det-1],
-                           filename=master_name('wave', setup),
-                           frametype='wave')
+        save('wave', slf._mswave[det-1], frametype='wave', **provenance('wave'))
         # Wavelength fit
         gddict = ltu.jsonify(slf._wvcalib[det-1])
         json_file = master_name('wave_calib', setup)
         if gddict is not None:
-            ltu.savejson(json_file, gddict, easy_to_read=True, overwrite=True)
+            gddict['provenance'] = master_provenance(slf, 'wave_calib', det)
+            if hdf5:
+                bundle.append(dict(ftype='wave_calib', json=json.dumps(gddict)))
+            else:
+                ltu.savejson(json_file, gddict, easy_to_read=True, overwrite=True)
         else:
             msgs.warn("The master wavelength solution has not been saved")
     if 'tilts'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
-        arsave.save_master(slf, slf._tilts[det-1],
-                           filename=master_name('tilts', setup),
-                           frametype='tilts')
+        save('tilts', slf._tilts[det-1], frametype='tilts', **provenance('tilts'))
 
     # Spatial slit profile
     if 'slitprof' + settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
-        arsave.save_master(slf, slf._slitprof[det - 1],
-                           filename=master_name('slitprof', setup),
-                           frametype='slit profile')
+        save('slitprof', slf._slitprof[det - 1], frametype='slit profile')
+
+    if len(bundle) > 0:
+        arsave.save_master_bundle(slf, bundle, master_name('bundle', setup))
+
+    # Once saved, the master frames can be released from memory and read again when they are needed
+    if slf._store is None:
+        return
+    for ftype in saved:
+        if ftype not in ['bias', 'trace', 'normpixelflat', 'pinhole', 'arc', 'wave']:
+            continue
+        filename = master_name(ftype, setup)
+        try:
+            head = arload.load_master_header(filename, frametype=ftype)
+        except IOError:
+            continue
+        if head.get('PYPKEY', None) == master_key(slf, ftype, det, provenance=True):
+            slf._store.register(master_key(slf, ftype, det), master_loader(filename, ftype))
 
 
 def user_master_name(mdir, input_name):
@@ -2,12 +2,14 @@ from __future__ import (print_function, absolute_import, division, unicode_liter
 
 import sys
 import os
+import multiprocessing
 import numpy as np
 import yaml
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 from pypit import arparse as settings
+from pypit import armasters
 from pypit import armsgs
 from pypit import arsort
 from pypit import arsciexp
@@ -19,7 +21,7 @@ msgs = armsgs.get_logger()
 from pypit import ardebug as debugger
 
 
-def SetupScience(fitsdict):
+def SetupScience(fitsdict, store=None):
     """ Create an exposure class for every science frame
     Also links to standard star frames and calibrations
 
@@ -27,6 +29,9 @@ def SetupScience(fitsdict):
     ----------
     fitsdict : dict
       Contains relevant information from fits header files
+    store : MasterStore, optional
+      Store of the master frames shared by the science exposures
+      (a new store by default)
 
     Returns
     -------
@@ -44,24 +49,39 @@ def SetupScience(fitsdict):
         skip_cset = True
     else:
         skip_cset = False
+    # Reuse the sorted files, calibration matches and setups of a previous run,
+    # if the raw files and settings are unchanged
+    cache_file = arsort.sort_cache_file()
+    cache = arsort.load_sort_cache(cache_file, fitsdict)
+    standards = {} if cache is None else cache['standards']
+    cached = cache is not None and 'filesort' in cache
     # Sort the data
     msgs.bug("Files and folders should not be deleted -- there should be an option to overwrite files automatically if they already exist, or choose to rename them if necessary")
-    filesort = arsort.sort_data(fitsdict, flag_unknown=bad_to_unknown)
+    if cached:
+        filesort = cache['filesort']
+    else:
+        filesort = arsort.sort_data(fitsdict, flag_unknown=bad_to_unknown, standards=standards)
     # Write out the details of the sorted files into a .lst file
     if settings.argflag['output']['sorted'] is not None:
         srt_tbl = arsort.sort_write(fitsdict, filesort)
     # Match calibration frames to science frames
-    arsort.match_science(fitsdict, filesort)
+    if cached:
+        for key, index in cache['index'].items():
+            settings.spect[key]['index'] = index
+    else:
+        arsort.match_science(fitsdict, filesort)
     # Make directory structure for different objects
     if do_qa:
         sci_targs = arsort.make_dirs(fitsdict, filesort)
-    # Create the list of science exposures
+    # Create the list of science exposures, which share their master frames through a single store
     numsci = np.size(settings.spect['science']['index'])
+    if store is None:
+        store = armasters.MasterStore()
     sciexp = []
     for i in range(numsci):
-        sciexp.append(arsciexp.ScienceExposure(i, fitsdict, do_qa=do_qa))
+        sciexp.append(arsciexp.ScienceExposure(i, fitsdict, do_qa=do_qa, store=store))
     # Generate setup and group dicts
-    setup_dict = {}
+    setup_dict = {} if not cached else cache['setup_dict']
     # Run through the setups to fill setup_dict
     setupIDs = []
     for sc in range(numsci):
@@ -71,9 +91,12 @@ def SetupScience(fitsdict):
                 cname = settings.argflag['setup']['name']
             except KeyError:
                 cname = None
-            setupID = arsort.instr_setup(sciexp[sc], kk+1, fitsdict, setup_dict, skip_cset=skip_cset, config_name=cname)
+            setupID = arsort.instr_setup(sciexp[sc], kk+1, fitsdict, setup_dict, skip_cset=skip_cset, config_name=cname,
+                                         must_exist=cached)
             if kk == 0: # Only save the first detector for run setup
                 setupIDs.append(setupID)
+    if cache_file is not None and not cached:
+        arsort.save_sort_cache(cache_file, fitsdict, filesort, setup_dict, standards)
 
     # Calib IDs
     group_dict = {}
@@ -139,10 +162,39 @@ def SetupScience(fitsdict):
     return sciexp, setup_dict
 
 
+def identical_master(slfa, slfb, ftype, det, idxa, idxb):
+    """ Will two science exposures use an identical master frame?
+
+    Frame types that are held in the master store are compared by their
+    content address (see armasters.master_key), which also accounts for
+    the settings and the master frames that they are built from. Other
+    frame types are compared by the indices of their raw frames.
+
+    Parameters
+    ----------
+    slfa, slfb : class
+      Science Exposure classes
+    ftype : str
+      Type of master frame
+    det : int
+      detector index (starting from 1)
+    idxa, idxb : ndarray
+      Indices of the raw frames used by each science exposure
+
+    Returns
+    -------
+    identical : bool
+    """
+    if ftype in armasters.master_inputs:
+        return armasters.master_key(slfa, ftype, det) == armasters.master_key(slfb, ftype, det)
+    return np.array_equal(idxa, idxb)
+
+
 def UpdateMasters(sciexp, sc, det, ftype=None, chktype=None):
     """ Update the master calibrations for other science targets
 
-    If they will use an identical master frame
+    If they will use an identical master frame. The master frame is
+    shared by reference (master frames are read-only once they are set).
 
     Parameters
     ----------
@@ -183,9 +235,11 @@ def UpdateMasters(sciexp, sc, det, ftype=None, chktype=None):
             else:
                 msgs.bug("I could not update frame of type {0:s} and subtype {1:s}".format(ftype, chktype))
                 return
-            if np.array_equal(chkarr, chkfarr) and sciexp[i].GetMasterFrame(chktype, det, mkcopy=False) is None:
+            if identical_master(sciexp[sc], sciexp[i], chktype, det, chkarr, chkfarr) and \
+                    sciexp[i].GetMasterFrame(chktype, det, mkcopy=False) is None:
                 msgs.info("Updating master {0:s} frame for science target {1:d}/{2:d}".format(chktype, i+1, numsci))
-                sciexp[i].SetMasterFrame(sciexp[sc].GetMasterFrame(chktype, det), chktype, det)
+                sciexp[i].SetMasterFrame(sciexp[sc].GetMasterFrame(chktype, det, mkcopy=False), chktype, det,
+                                         mkcopy=False)
         # Now check flats of a different type
         origtype = chktype
         if chktype == "trace": chktype = "pixelflat"
@@ -200,7 +254,8 @@ def UpdateMasters(sciexp, sc, det, ftype=None, chktype=None):
                 return
             if np.array_equal(chkarr, chkfarr) and sciexp[i].GetMasterFrame(chktype, det, mkcopy=False) is None:
                 msgs.info("Updating master {0:s} frame for science target {1:d}/{2:d}".format(chktype, i+1, numsci))
-                sciexp[i].SetMasterFrame(sciexp[sc].GetMasterFrame(origtype, det), chktype, det)
+                sciexp[i].SetMasterFrame(sciexp[sc].GetMasterFrame(origtype, det, mkcopy=False), chktype, det,
+                                         mkcopy=False)
     else:
         for i in range(sc+1, numsci):
             # Check if an *identical* master frame has already been produced
@@ -211,8 +266,271 @@ def UpdateMasters(sciexp, sc, det, ftype=None, chktype=None):
             else:
                 msgs.bug("I could not update frame of type: {0:s}".format(ftype))
                 return
-            if np.array_equal(chkarr, chkfarr) and sciexp[i].GetMasterFrame(ftype, det, mkcopy=False) is None:
+            if identical_master(sciexp[sc], sciexp[i], ftype, det, chkarr, chkfarr) and \
+                    sciexp[i].GetMasterFrame(ftype, det, mkcopy=False) is None:
                 msgs.info("Updating master {0:s} frame for science target {1:d}/{2:d}".format(ftype, i+1, numsci))
-                sciexp[i].SetMasterFrame(sciexp[sc].GetMasterFrame(ftype, det), ftype, det)
+                # Only the frames in the master store are read-only, and can be shared
+                mkcopy = ftype not in armasters.master_inputs
+                sciexp[i].SetMasterFrame(sciexp[sc].GetMasterFrame(ftype, det, mkcopy=mkcopy), ftype, det,
+                                         mkcopy=mkcopy)
+    return
+
+
+def detector_state(sciexp, det):
+    """ Collect the products of the reduction of one detector
+
+    All of the products of a detector are held by the science exposures
+    in lists indexed by the detector, and in the settings of the
+    detector. This is used to return the products of a detector that
+    was reduced in a separate process to the parent process (see
+    merge_detector_state).
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes
+    det : int
+      detector index (starting from 1)
+
+    Returns
+    -------
+    state : dict
+      The products of the detector (master frames held in a master store
+      are returned as the frame, with its key)
+    """
+    ndet = settings.spect['mosaic']['ndet']
+    frames, refs = [], []
+    for slf in sciexp:
+        sframes, srefs = {}, {}
+        if slf is not None:
+            for attr, value in vars(slf).items():
+                if not isinstance(value, list) or len(value) != ndet:
+                    continue
+                if isinstance(value, armasters.MasterSlots) and \
+                        isinstance(value.ref(det-1), armasters.MasterRef):
+                    srefs[attr] = (value.ref(det-1).key, np.asarray(value[det-1]))
+                else:
+                    sframes[attr] = value[det-1]
+        frames.append(sframes)
+        refs.append(srefs)
+    state = dict(frames=frames, refs=refs,
+                 spect=settings.spect[settings.get_dnum(det)],
+                 loaded=settings.argflag['reduce']['masters']['loaded'],
+                 setup=settings.argflag['reduce']['masters']['setup'],
+                 dispersion=settings.argflag['trace']['dispersion']['direction'])
+    return state
+
+
+def merge_detector_state(sciexp, det, state):
+    """ Set the products of a detector that was reduced in a separate process
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes
+    det : int
+      detector index (starting from 1)
+    state : dict
+      The products of the detector (see detector_state)
+    """
+    for slf, sframes, srefs in zip(sciexp, state['frames'], state['refs']):
+        if slf is None:
+            continue
+        for attr, value in sframes.items():
+            getattr(slf, attr)[det-1] = value
+        for attr, (key, frame) in srefs.items():
+            if slf._store is not None:
+                frame = slf._store.put(key, frame)
+            getattr(slf, attr)[det-1] = frame
+    settings.spect[settings.get_dnum(det)] = state['spect']
+    for name in state['loaded']:
+        if name not in settings.argflag['reduce']['masters']['loaded']:
+            settings.argflag['reduce']['masters']['loaded'].append(name)
+    settings.argflag['trace']['dispersion']['direction'] = state['dispersion']
+    return
+
+
+# Number of double precision frames, the size of a detector, that are
+# held in memory while the science frame of a detector is reduced
+_sciframes_inmem = 20
+
+
+def flush_messages():
+    """ Write out the buffered messages, before a process is forked
+
+    Otherwise, the messages would be written out by the parent
+    process and again by each child process.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if msgs._log:
+        msgs._log.flush()
+    return
+
+
+def exposure_memory(slf):
+    """ Estimate the memory needed to reduce the science frames of an
+    exposure, once its master calibration frames have been prepared
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+
+    Returns
+    -------
+    nbytes : int
+      Estimated memory (in bytes)
+    """
+    nbytes = 0
+    for nspec, nspat in zip(slf._nspec, slf._nspat):
+        if nspec is not None:
+            nbytes += _sciframes_inmem * nspec * nspat * 8
+    return nbytes
+
+
+def available_memory():
+    """ The physical memory that is available for the science exposures
+
+    Returns
+    -------
+    nbytes : int or None
+      Memory (in bytes), from 'run memory' if it is set,
+      or None if it cannot be determined
+    """
+    if settings.argflag['run']['memory'] > 0.0:
+        return int(settings.argflag['run']['memory'] * 1024**2)
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _run_exposure(reduce_exposure, sc):
+    """ Reduce a science exposure in a worker process
+    (see schedule_exposures)
+    """
+    try:
+        reduce_exposure(sc)
+    except SystemExit:
+        # msgs.error exits with a status of 0
+        sys.exit(1)
     return
 
+
+def _serial_exposures(sciexp, reduce_exposure, status, pending):
+    """ Reduce the science exposures one at a time, in this process
+    (see schedule_exposures)
+    """
+    numsci = len(sciexp)
+    ntodo, ndone = len(pending), 0
+    while len(pending) > 0:
+        sc = pending.popleft()
+        status[sc]['attempts'] += 1
+        try:
+            reduce_exposure(sc)
+        except SystemExit:
+            # msgs.error has closed the log
+            msgs.reopen()
+            if status[sc]['attempts'] <= settings.argflag['run']['retries']:
+                pending.append(sc)
+                msgs.warn("Science exposure {0:d}/{1:d} failed -- retrying".format(sc+1, numsci))
+            else:
+                status[sc]['state'] = 'failed'
+                msgs.warn("Science exposure {0:d}/{1:d} failed after {2:d} attempts".format(
+                    sc+1, numsci, status[sc]['attempts']))
+        else:
+            status[sc]['state'] = 'done'
+            ndone += 1
+            sciexp[sc] = None
+            msgs.info("Reduced science exposure {0:d}/{1:d} ({2:d} of {3:d} done)".format(
+                sc+1, numsci, ndone, ntodo))
+    return status
+
+
+def schedule_exposures(sciexp, reduce_exposure):
+    """ Reduce the science exposures on a pool of up to 'run ncpus'
+    worker processes, once their master calibration frames have been
+    prepared
+
+    An exposure is only started if the memory that it is expected to
+    need (see exposure_memory) fits within the available memory, along
+    with the exposures that are running. An exposure that fails is
+    retried up to 'run retries' times.
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes. Each exposure is
+      replaced by None once it has been reduced.
+    reduce_exposure : function
+      reduce_exposure(sc) reduces the science frames of sciexp[sc], and
+      writes out the results. It is run in a forked process (or in this
+      process, one exposure at a time, where processes cannot be forked).
+
+    Returns
+    -------
+    status : list
+      A dict for each science exposure, with the 'state' of its reduction
+      ('done', 'failed' or 'skipped') and the number of 'attempts'
+    """
+    numsci = len(sciexp)
+    status = [dict(state='pending', attempts=0) for sc in range(numsci)]
+    pending = deque()
+    for sc in range(numsci):
+        if sciexp[sc] is None:
+            status[sc]['state'] = 'skipped'
+        else:
+            pending.append(sc)
+    if not hasattr(multiprocessing, 'get_context'):
+        # Python 2.7 has no process contexts (or multiprocessing.connection.wait)
+        msgs.warn("Cannot fork the reductions on this version of Python -- reducing the exposures serially")
+        return _serial_exposures(sciexp, reduce_exposure, status, pending)
+    from multiprocessing.connection import wait
+    ctx = multiprocessing.get_context('fork')
+    ncpus = max(1, settings.argflag['run']['ncpus'])
+    memory = available_memory()
+    running = {}
+    ntodo, ndone = len(pending), 0
+    while len(pending) > 0 or len(running) > 0:
+        # Start as many exposures as the cores and the memory allow
+        while len(pending) > 0 and len(running) < ncpus:
+            sc = pending[0]
+            nbytes = exposure_memory(sciexp[sc])
+            if memory is not None:
+                inuse = sum([running[key][1] for key in running])
+                if inuse + nbytes > memory:
+                    if len(running) > 0:
+                        break
+                    msgs.warn("Science exposure {0:d}/{1:d} may not fit in memory".format(sc+1, numsci))
+            pending.popleft()
+            flush_messages()
+            proc = ctx.Process(target=_run_exposure, args=(reduce_exposure, sc))
+            proc.start()
+            running[sc] = (proc, nbytes)
+            status[sc]['state'] = 'running'
+            status[sc]['attempts'] += 1
+            msgs.info("Started science exposure {0:d}/{1:d} ({2:d} running, {3:.0f} MB)".format(
+                sc+1, numsci, len(running), nbytes/1024.0**2))
+        # Wait for an exposure to finish
+        sentinels = dict([(running[sc][0].sentinel, sc) for sc in running])
+        for sentinel in wait(list(sentinels.keys())):
+            sc = sentinels[sentinel]
+            proc = running.pop(sc)[0]
+            proc.join()
+            if proc.exitcode == 0:
+                status[sc]['state'] = 'done'
+                ndone += 1
+                # Free up some memory by replacing the reduced ScienceExposure class
+                sciexp[sc] = None
+                msgs.info("Reduced science exposure {0:d}/{1:d} ({2:d} of {3:d} done)".format(
+                    sc+1, numsci, ndone, ntodo))
+            elif status[sc]['attempts'] <= settings.argflag['run']['retries']:
+                status[sc]['state'] = 'pending'
+                pending.append(sc)
+                msgs.warn("Science exposure {0:d}/{1:d} failed -- retrying".format(sc+1, numsci))
+            else:
+                status[sc]['state'] = 'failed'
+                msgs.warn("Science exposure {0:d}/{1:d} failed after {2:d} attempts".format(
+                    sc+1, numsci, status[sc]['attempts']))
+    return status
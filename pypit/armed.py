@@ -180,8 +180,9 @@ def ARMED(fitsdict, reuseMaster=False, reloadMaster=True):
                     except IOError:
                         pass
                     else:
-                        slf.SetFrame(slf._tilts, tilts, det)
-                        settings.argflag['reduce']['masters']['loaded'].append('tilts'+settings.argflag['reduce']['masters']['setup'])
+                        if armasters.master_uptodate(slf, 'tilts', det, head):
+                            slf.SetFrame(slf._tilts, tilts, det)
+                            settings.argflag['reduce']['masters']['loaded'].append('tilts'+settings.argflag['reduce']['masters']['setup'])
                 if 'tilts'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
                     # First time tilts are derived for this arc frame --> derive the order tilts
                     tilts, satmask, outpar = artrace.echelle_tilt(slf, slf._msarc[det-1], det)
@@ -245,7 +246,7 @@ def ARMED(fitsdict, reuseMaster=False, reloadMaster=True):
             msgs.info("Loading science frame")
             sciframe = arload.load_frames(fitsdict, [scidx], det,
                                           frametype='science',
-                                          msbias=slf._msbias[det - 1])
+                                          msbias=slf._msbias[det - 1], gain=True)
             sciframe = sciframe[:, :, 0]
             # Extract
             msgs.info("Processing science frame")
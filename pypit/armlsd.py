@@ -2,8 +2,11 @@
 """
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 
+import multiprocessing
 import numpy as np
+from matplotlib.backends.backend_pdf import PdfPages
 from pypit import arparse as settings
+from pypit import archeckpoint
 from pypit import arflux
 from pypit import arload
 from pypit import armasters
@@ -22,8 +25,11 @@ from pypit import ardebug as debugger
 # Logging
 msgs = armsgs.get_logger()
 
+# Arguments of the detectors reduced by a pool of worker processes
+_pool_args = None
 
-def ARMLSD(fitsdict, reuseMaster=False, reloadMaster=True):
+
+def ARMLSD(fitsdict, reuseMaster=False, reloadMaster=True, store=None):
     """
     Automatic Reduction and Modeling of Long Slit Data
 
@@ -37,6 +43,9 @@ def ARMLSD(fitsdict, reuseMaster=False, reloadMaster=True):
       This setting comes with a price, and if a large number of science frames are
       being generated, it may be more efficient to simply regenerate the master
       calibrations on the fly.
+    store : MasterStore, optional
+      Store of the master frames to use (e.g. one that is kept between the
+      reductions of the observing mode)
 
     Returns
     -------
@@ -44,11 +53,12 @@ def ARMLSD(fitsdict, reuseMaster=False, reloadMaster=True):
       Status of the reduction procedure
       0 = Successful full execution
       1 = Successful processing of setup or calcheck
+      3 = One or more science exposures could not be reduced (run batch)
     """
     status = 0
 
     # Create a list of science exposure classes
-    sciexp, setup_dict = armbase.SetupScience(fitsdict)
+    sciexp, setup_dict = armbase.SetupScience(fitsdict, store=store)
     if sciexp == 'setup':
         status = 1
         return status
@@ -64,150 +74,24 @@ def ARMLSD(fitsdict, reuseMaster=False, reloadMaster=True):
     # Masters
     #settings.argflag['reduce']['masters']['file'] = setup_file
 
+    if settings.argflag['run']['batch']:
+        return reduce_batch(sciexp, fitsdict, setup_dict, reuseMaster=reuseMaster,
+                            reloadMaster=reloadMaster)
+
     # Start reducing the data
     for sc in range(numsci):
         slf = sciexp[sc]
         scidx = slf._idx_sci[0]
+        if archeckpoint.exposure_done(slf):
+            msgs.info("File {0:s} has already been reduced".format(fitsdict['filename'][scidx]))
+            sciexp[sc] = None
+            continue
         msgs.info("Reducing file {0:s}, target {1:s}".format(fitsdict['filename'][scidx], slf._target_name))
         msgs.sciexp = slf  # For QA writing on exit, if nothing else.  Could write Masters too
         if reloadMaster and (sc > 0):
             settings.argflag['reduce']['masters']['reuse'] = True
         # Loop on Detectors
-        for kk in range(settings.spect['mosaic']['ndet']):
-            det = kk + 1  # Detectors indexed from 1
-            slf.det = det
-            ###############
-            # Get data sections
-            arproc.get_datasec_trimmed(slf, fitsdict, det, scidx)
-            # Setup
-            setup = arsort.instr_setup(slf, det, fitsdict, setup_dict, must_exist=True)
-            settings.argflag['reduce']['masters']['setup'] = setup
-            ###############
-            # Generate master bias frame
-            update = slf.MasterBias(fitsdict, det)
-            if update and reuseMaster:
-                armbase.UpdateMasters(sciexp, sc, det, ftype="bias")
-            ###############
-            # Generate a bad pixel mask (should not repeat)
-            update = slf.BadPixelMask(fitsdict, det)
-            if update and reuseMaster:
-                armbase.UpdateMasters(sciexp, sc, det, ftype="arc")
-            ###############
-            # Generate a master arc frame
-            update = slf.MasterArc(fitsdict, det)
-            if update and reuseMaster:
-                armbase.UpdateMasters(sciexp, sc, det, ftype="arc")
-            ###############
-            # Set the number of spectral and spatial pixels, and the bad pixel mask is it does not exist
-            slf._nspec[det-1], slf._nspat[det-1] = slf._msarc[det-1].shape
-            if slf._bpix[det-1] is None:
-                slf.SetFrame(slf._bpix, np.zeros((slf._nspec[det-1], slf._nspat[det-1])), det)
-            '''
-            ###############
-            # Estimate gain and readout noise for the amplifiers
-            msgs.work("Estimate Gain and Readout noise from the raw frames...")
-            update = slf.MasterRN(fitsdict, det)
-            if update and reuseMaster:
-                armbase.UpdateMasters(sciexp, sc, det, ftype="readnoise")
-            '''
-            ###############
-            # Generate a master trace frame
-            update = slf.MasterTrace(fitsdict, det)
-            if update and reuseMaster:
-                armbase.UpdateMasters(sciexp, sc, det, ftype="flat", chktype="trace")
-            ###############
-            # Generate an array that provides the physical pixel locations on the detector
-            slf.GetPixelLocations(det)
-            # Determine the edges of the spectrum (spatial)
-            if ('trace'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']):
-                ###############
-                # Determine the edges of the spectrum (spatial)
-                lordloc, rordloc, extord = artrace.trace_slits(slf, slf._mstrace[det-1], det, pcadesc="PCA trace of the slit edges")
-                slf.SetFrame(slf._lordloc, lordloc, det)
-                slf.SetFrame(slf._rordloc, rordloc, det)
-
-                # Convert physical trace into a pixel trace
-                msgs.info("Converting physical trace locations to nearest pixel")
-                pixcen = artrace.phys_to_pix(0.5*(slf._lordloc[det-1]+slf._rordloc[det-1]), slf._pixlocn[det-1], 1)
-                pixwid = (slf._rordloc[det-1]-slf._lordloc[det-1]).mean(0).astype(np.int)
-                lordpix = artrace.phys_to_pix(slf._lordloc[det-1], slf._pixlocn[det-1], 1)
-                rordpix = artrace.phys_to_pix(slf._rordloc[det-1], slf._pixlocn[det-1], 1)
-                slf.SetFrame(slf._pixcen, pixcen, det)
-                slf.SetFrame(slf._pixwid, pixwid, det)
-                slf.SetFrame(slf._lordpix, lordpix, det)
-                slf.SetFrame(slf._rordpix, rordpix, det)
-                msgs.info("Identifying the pixels belonging to each slit")
-                slitpix = arproc.slit_pixels(slf, slf._mstrace[det-1].shape, det)
-                slf.SetFrame(slf._slitpix, slitpix, det)
-
-                # Save QA for slit traces
-                if not msgs._debug['no_qa']:
-                    arqa.slit_trace_qa(slf, slf._mstrace[det-1], slf._lordpix[det-1], slf._rordpix[det-1], extord, desc="Trace of the slit edges D{:02d}".format(det), use_slitid=det)
-                armbase.UpdateMasters(sciexp, sc, det, ftype="flat", chktype="trace")
-
-            ###############
-            # Generate the 1D wavelength solution
-            update = slf.MasterWaveCalib(fitsdict, sc, det)
-            if update and reuseMaster:
-                armbase.UpdateMasters(sciexp, sc, det, ftype="arc", chktype="trace")
-
-            ###############
-            # Derive the spectral tilt
-            if slf._tilts[det-1] is None:
-                if settings.argflag['reduce']['masters']['reuse']:
-                    mstilt_name = armasters.master_name('tilts', settings.argflag['reduce']['masters']['setup'])
-                    try:
-                        tilts, head = arload.load_master(mstilt_name, frametype="tilts")
-                    except IOError:
-                        pass
-                    else:
-                        slf.SetFrame(slf._tilts, tilts, det)
-                        settings.argflag['reduce']['masters']['loaded'].append('tilts'+settings.argflag['reduce']['masters']['setup'])
-                if 'tilts'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
-                    # First time tilts are derived for this arc frame --> derive the order tilts
-                    tilts, satmask, outpar = artrace.multislit_tilt(slf, slf._msarc[det-1], det)
-                    slf.SetFrame(slf._tilts, tilts, det)
-                    slf.SetFrame(slf._satmask, satmask, det)
-                    slf.SetFrame(slf._tiltpar, outpar, det)
-
-            ###############
-            # Prepare the pixel flat field frame
-            update = slf.MasterFlatField(fitsdict, det)
-            if update and reuseMaster: armbase.UpdateMasters(sciexp, sc, det, ftype="flat", chktype="pixelflat")
-
-            ###############
-            # Generate/load a master wave frame
-            update = slf.MasterWave(fitsdict, sc, det)
-            if update and reuseMaster:
-                armbase.UpdateMasters(sciexp, sc, det, ftype="arc", chktype="wave")
-
-            ###############
-            # Check if the user only wants to prepare the calibrations only
-            msgs.info("All calibration frames have been prepared")
-            if settings.argflag['run']['preponly']:
-                msgs.info("If you would like to continue with the reduction, disable the command:" + msgs.newline() +
-                          "run preponly False")
-                continue
-
-            ###############
-            # Write setup
-            #setup = arsort.calib_setup(sc, det, fitsdict, setup_dict, write=True)
-            # Write MasterFrames (currently per detector)
-            armasters.save_masters(slf, det, setup)
-
-            ###############
-            # Load the science frame and from this generate a Poisson error frame
-            msgs.info("Loading science frame")
-            sciframe = arload.load_frames(fitsdict, [scidx], det,
-                                          frametype='science',
-                                          msbias=slf._msbias[det-1])
-            sciframe = sciframe[:, :, 0]
-            # Extract
-            msgs.info("Processing science frame")
-            arproc.reduce_multislit(slf, sciframe, scidx, fitsdict, det)
-
-            ###############
-            # Using model sky, calculate a flexure correction
+        reduced = reduce_detectors(sciexp, sc, fitsdict, setup_dict, reuseMaster)
 
         # Close the QA for this object
         if not msgs._debug['no_qa']:
@@ -216,36 +100,478 @@ def ARMLSD(fitsdict, reuseMaster=False, reloadMaster=True):
         ###############
         # Flux
         ###############
-        # Standard star (is this a calibration, e.g. goes above?)
-        msgs.info("Processing standard star")
-        msgs.info("Assuming one star per detector mosaic")
-        msgs.info("Waited until last detector to process")
-
-        msgs.work("Need to check for existing sensfunc")
-        update = slf.MasterStandard(scidx, fitsdict)
-        if update and reuseMaster:
-            armbase.UpdateMasters(sciexp, sc, 0, ftype="standard")
-        #
-        msgs.work("Consider using archived sensitivity if not found")
-        msgs.info("Fluxing with {:s}".format(slf._sensfunc['std']['name']))
-        for kk in range(settings.spect['mosaic']['ndet']):
-            det = kk + 1  # Detectors indexed from 1
-            if slf._specobjs[det-1] is not None:
-                arflux.apply_sensfunc(slf, det, scidx, fitsdict)
-            else:
-                msgs.info("There are no objects on detector {0:d} to apply a flux calibration".format(det))
-
-        # Write 1D spectra
-        save_format = 'fits'
-        if save_format == 'fits':
-            arsave.save_1d_spectra_fits(slf)
-        elif save_format == 'hdf5':
-            arsave.save_1d_spectra_hdf5(slf)
-        else:
-            msgs.error(save_format + ' is not a recognized output format!')
-        arsave.save_obj_info(slf, fitsdict)
-        # Write 2D images for the Science Frame
-        arsave.save_2d_images(slf, fitsdict)
+        standard_star(sciexp, sc, fitsdict, reuseMaster)
+        flux_and_save(slf, fitsdict)
+        if reduced:
+            archeckpoint.mark_exposure_done(slf)
         # Free up some memory by replacing the reduced ScienceExposure class
         sciexp[sc] = None
     return status
+
+
+def reduce_batch(sciexp, fitsdict, setup_dict, reuseMaster=False, reloadMaster=True):
+    """ Prepare the master calibration frames of all of the science
+    exposures, and then reduce the science exposures in parallel
+    (see armbase.schedule_exposures)
+
+    The master calibration frames, and the sensitivity function, are
+    built once, in this process, and are shared with the worker
+    processes when they are forked.
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes
+    fitsdict : dict
+      Contains relevant information from fits header files
+    setup_dict : dict
+    reuseMaster : bool
+      Update the master frames of the other science exposures?
+    reloadMaster : bool
+      Reuse the master frames saved to disk, after the first science exposure?
+
+    Returns
+    -------
+    status : int
+      Status of the reduction procedure
+      0 = Successful full execution
+      3 = One or more science exposures could not be reduced
+    """
+    numsci = len(sciexp)
+    ndet = settings.spect['mosaic']['ndet']
+    for sc in range(numsci):
+        slf = sciexp[sc]
+        scidx = slf._idx_sci[0]
+        if archeckpoint.exposure_done(slf):
+            msgs.info("File {0:s} has already been reduced".format(fitsdict['filename'][scidx]))
+            sciexp[sc] = None
+            continue
+        msgs.info("Preparing the calibrations of file {0:s}, target {1:s}".format(
+            fitsdict['filename'][scidx], slf._target_name))
+        msgs.sciexp = slf
+        if reloadMaster and (sc > 0):
+            settings.argflag['reduce']['masters']['reuse'] = True
+        for kk in range(ndet):
+            det = kk + 1  # Detectors indexed from 1
+            calibrate_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster)
+        # Close the calibration QA for this object
+        if not msgs._debug['no_qa']:
+            slf._qa.close()
+        if not settings.argflag['run']['preponly']:
+            standard_star(sciexp, sc, fitsdict, reuseMaster)
+    if settings.argflag['run']['preponly']:
+        return 0
+    msgs.sciexp = None
+
+    def reduce_exposure(sc):
+        slf = sciexp[sc]
+        scidx = slf._idx_sci[0]
+        msgs.info("Reducing file {0:s}, target {1:s}".format(fitsdict['filename'][scidx], slf._target_name))
+        msgs.sciexp = slf
+        if not msgs._debug['no_qa']:
+            slf._qa = PdfPages("{0:s}/QA_{1:s}_science.pdf".format(settings.argflag['run']['directory']['qa'],
+                                                                   slf._basename))
+        for kk in range(ndet):
+            det = kk + 1
+            slf.det = det
+            arproc.get_datasec_trimmed(slf, fitsdict, det, scidx)
+            settings.argflag['reduce']['masters']['setup'] = arsort.instr_setup(slf, det, fitsdict, setup_dict,
+                                                                                must_exist=True)
+            reduce_science(slf, det, fitsdict)
+        if not msgs._debug['no_qa']:
+            slf._qa.close()
+        flux_and_save(slf, fitsdict)
+        archeckpoint.mark_exposure_done(slf)
+
+    msgs.info("All calibration frames have been prepared")
+    status = armbase.schedule_exposures(sciexp, reduce_exposure)
+    failed = [sc for sc in range(numsci) if status[sc]['state'] == 'failed']
+    if len(failed) > 0:
+        msgs.warn("The following science exposures could not be reduced:" + msgs.newline() +
+                  msgs.newline().join([fitsdict['filename'][settings.spect['science']['index'][sc][0]]
+                                       for sc in failed]))
+        return 3
+    return 0
+
+
+def standard_star(sciexp, sc, fitsdict, reuseMaster):
+    """ Process the standard star of a science exposure, and generate
+    its sensitivity function
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes
+    sc : int
+      Index of sciexp for the science exposure being reduced
+    fitsdict : dict
+      Contains relevant information from fits header files
+    reuseMaster : bool
+      Update the standard star of the other science exposures?
+    """
+    # Standard star (is this a calibration, e.g. goes above?)
+    msgs.info("Processing standard star")
+    msgs.info("Assuming one star per detector mosaic")
+    msgs.info("Waited until last detector to process")
+
+    msgs.work("Need to check for existing sensfunc")
+    slf = sciexp[sc]
+    # Resume from the sensitivity function of a previous reduction?
+    sens = archeckpoint.load_checkpoint(slf, 'sensfunc', None)
+    if sens is not None and len(slf._msstd[0]) == 0:
+        slf._msstd = sens['msstd']
+        slf.SetMasterFrame(sens['sensfunc'], "sensfunc", None, mkcopy=False)
+        update = True
+    else:
+        update = slf.MasterStandard(fitsdict)
+        if update:
+            archeckpoint.save_checkpoint(slf, 'sensfunc', None,
+                                         dict(msstd=slf._msstd, sensfunc=slf._sensfunc))
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, 0, ftype="standard")
+    return
+
+
+def flux_and_save(slf, fitsdict):
+    """ Flux calibrate the extracted spectra of a science exposure,
+    and write out the 1D spectra and the 2D images
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    fitsdict : dict
+      Contains relevant information from fits header files
+    """
+    scidx = slf._idx_sci[0]
+    msgs.work("Consider using archived sensitivity if not found")
+    msgs.info("Fluxing with {:s}".format(slf._sensfunc['std']['name']))
+    for kk in range(settings.spect['mosaic']['ndet']):
+        det = kk + 1  # Detectors indexed from 1
+        if slf._specobjs[det-1] is not None:
+            arflux.apply_sensfunc(slf, det, scidx, fitsdict)
+        else:
+            msgs.info("There are no objects on detector {0:d} to apply a flux calibration".format(det))
+
+    # Write 1D spectra
+    save_format = 'fits'
+    if save_format == 'fits':
+        arsave.save_1d_spectra_fits(slf)
+    elif save_format == 'hdf5':
+        arsave.save_1d_spectra_hdf5(slf)
+    else:
+        msgs.error(save_format + ' is not a recognized output format!')
+    arsave.save_obj_info(slf, fitsdict)
+    # Write 2D images for the Science Frame
+    arsave.save_2d_images(slf, fitsdict)
+    return
+
+
+def reduce_detectors(sciexp, sc, fitsdict, setup_dict, reuseMaster):
+    """ Reduce a science exposure on every detector
+
+    The detectors are reduced in turn or, with 'run detpool True', in
+    parallel on a pool of up to 'run ncpus' processes. The products of
+    each detector are then returned to the science exposures of this
+    process, before the standard star is processed and the science
+    frames are flux calibrated.
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes
+    sc : int
+      Index of sciexp for the science exposure being reduced
+    fitsdict : dict
+      Contains relevant information from fits header files
+    setup_dict : dict
+    reuseMaster : bool
+      Update the master frames of the other science exposures?
+
+    Returns
+    -------
+    reduced : bool
+      Was the science frame reduced on every detector (False if only the
+      calibrations were prepared)?
+    """
+    global _pool_args
+    ndet = settings.spect['mosaic']['ndet']
+    nproc = min(settings.argflag['run']['ncpus'], ndet)
+    parallel = settings.argflag['run']['detpool'] and nproc > 1
+    if parallel and (not hasattr(multiprocessing, 'get_context') or
+                     'fork' not in multiprocessing.get_all_start_methods()):
+        # Python 2.7 has no process contexts, and Windows cannot fork
+        msgs.warn("Cannot reduce the detectors in parallel on this platform")
+        parallel = False
+    if not parallel:
+        reduced = True
+        for kk in range(ndet):
+            det = kk + 1  # Detectors indexed from 1
+            reduced &= reduce_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster)
+        return reduced
+    msgs.info("Reducing {0:d} detectors on {1:d} processes".format(ndet, nproc))
+    # The worker processes inherit the science exposures when they are forked,
+    # and share the cores between the threads of the processes
+    _pool_args = (sciexp, sc, fitsdict, setup_dict, reuseMaster,
+                  max(1, settings.argflag['run']['ncpus'] // nproc))
+    armbase.flush_messages()
+    pool = multiprocessing.get_context('fork').Pool(processes=nproc)
+    try:
+        states = pool.map(_reduce_detector_pool, range(1, ndet+1), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _pool_args = None
+    for kk, state in enumerate(states):
+        det = kk + 1
+        if state is None:
+            msgs.error("The reduction of detector {0:d} failed".format(det))
+        armbase.merge_detector_state(sciexp, det, state)
+    sciexp[sc].det = ndet
+    settings.argflag['reduce']['masters']['setup'] = states[-1]['setup']
+    return all([state['reduced'] for state in states])
+
+
+def _reduce_detector_pool(det):
+    """ Reduce a single detector in a worker process (see reduce_detectors)
+
+    Returns
+    -------
+    state : dict or None
+      The products of the detector (see armbase.detector_state) and
+      whether its science frame was reduced, or None if the reduction failed
+    """
+    sciexp, sc, fitsdict, setup_dict, reuseMaster, nthread = _pool_args
+    settings.argflag['run']['ncpus'] = nthread
+    slf = sciexp[sc]
+    msgs.sciexp = slf
+    if not msgs._debug['no_qa']:
+        # Each process writes the QA of its detector to a separate file
+        slf._qa = PdfPages("{0:s}/QA_{1:s}_{2:s}.pdf".format(settings.argflag['run']['directory']['qa'],
+                                                             slf._basename, settings.get_dnum(det)))
+    try:
+        reduced = reduce_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster)
+    except SystemExit:
+        # msgs.error has already closed the QA file
+        return None
+    if not msgs._debug['no_qa']:
+        slf._qa.close()
+    state = armbase.detector_state(sciexp, det)
+    state['reduced'] = reduced
+    return state
+
+
+def reduce_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster):
+    """ Prepare the master calibration frames, and reduce the
+    science frame, of a science exposure on a single detector
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes
+    sc : int
+      Index of sciexp for the science exposure being reduced
+    det : int
+      detector index (starting from 1)
+    fitsdict : dict
+      Contains relevant information from fits header files
+    setup_dict : dict
+    reuseMaster : bool
+      Update the master frames of the other science exposures?
+
+    Returns
+    -------
+    reduced : bool
+      Was the science frame reduced (False if only the calibrations
+      were prepared)?
+    """
+    if not calibrate_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster):
+        return False
+    reduce_science(sciexp[sc], det, fitsdict)
+    return True
+
+
+def calibrate_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster):
+    """ Prepare the master calibration frames of a science exposure
+    on a single detector
+
+    Parameters
+    ----------
+    sciexp : list
+      A list containing all science exposure classes
+    sc : int
+      Index of sciexp for the science exposure being reduced
+    det : int
+      detector index (starting from 1)
+    fitsdict : dict
+      Contains relevant information from fits header files
+    setup_dict : dict
+    reuseMaster : bool
+      Update the master frames of the other science exposures?
+
+    Returns
+    -------
+    prepared : bool
+      False if only the calibrations are to be prepared (run preponly)
+    """
+    slf = sciexp[sc]
+    scidx = slf._idx_sci[0]
+    slf.det = det
+    ###############
+    # Get data sections
+    arproc.get_datasec_trimmed(slf, fitsdict, det, scidx)
+    # Setup
+    setup = arsort.instr_setup(slf, det, fitsdict, setup_dict, must_exist=True)
+    settings.argflag['reduce']['masters']['setup'] = setup
+    ###############
+    # Generate master bias frame
+    update = slf.MasterBias(fitsdict, det)
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, det, ftype="bias")
+    ###############
+    # Generate a bad pixel mask (should not repeat)
+    update = slf.BadPixelMask(fitsdict, det)
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, det, ftype="arc")
+    ###############
+    # Generate a master arc frame
+    update = slf.MasterArc(fitsdict, det)
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, det, ftype="arc")
+    ###############
+    # Set the number of spectral and spatial pixels, and the bad pixel mask is it does not exist
+    slf._nspec[det-1], slf._nspat[det-1] = slf._msarc[det-1].shape
+    if slf._bpix[det-1] is None:
+        slf.SetFrame(slf._bpix, np.zeros((slf._nspec[det-1], slf._nspat[det-1])), det)
+    '''
+    ###############
+    # Estimate gain and readout noise for the amplifiers
+    msgs.work("Estimate Gain and Readout noise from the raw frames...")
+    update = slf.MasterRN(fitsdict, det)
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, det, ftype="readnoise")
+    '''
+    ###############
+    # Generate a master trace frame
+    update = slf.MasterTrace(fitsdict, det)
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, det, ftype="flat", chktype="trace")
+    ###############
+    # Generate an array that provides the physical pixel locations on the detector
+    slf.GetPixelLocations(det)
+    # Determine the edges of the spectrum (spatial)
+    if ('trace'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']):
+        ###############
+        # Determine the edges of the spectrum (spatial)
+        lordloc, rordloc, extord = artrace.trace_slits(slf, slf._mstrace[det-1], det, pcadesc="PCA trace of the slit edges")
+        slf.SetFrame(slf._lordloc, lordloc, det)
+        slf.SetFrame(slf._rordloc, rordloc, det)
+
+        # Convert physical trace into a pixel trace
+        msgs.info("Converting physical trace locations to nearest pixel")
+        pixcen = artrace.phys_to_pix(0.5*(slf._lordloc[det-1]+slf._rordloc[det-1]), slf._pixlocn[det-1], 1)
+        pixwid = (slf._rordloc[det-1]-slf._lordloc[det-1]).mean(0).astype(np.int)
+        lordpix = artrace.phys_to_pix(slf._lordloc[det-1], slf._pixlocn[det-1], 1)
+        rordpix = artrace.phys_to_pix(slf._rordloc[det-1], slf._pixlocn[det-1], 1)
+        slf.SetFrame(slf._pixcen, pixcen, det)
+        slf.SetFrame(slf._pixwid, pixwid, det)
+        slf.SetFrame(slf._lordpix, lordpix, det)
+        slf.SetFrame(slf._rordpix, rordpix, det)
+        msgs.info("Identifying the pixels belonging to each slit")
+        slitpix = arproc.slit_pixels(slf, slf._mstrace[det-1].shape, det)
+        slf.SetFrame(slf._slitpix, slitpix, det)
+
+        # Save QA for slit traces
+        if not msgs._debug['no_qa']:
+            arqa.slit_trace_qa(slf, slf._mstrace[det-1], slf._lordpix[det-1], slf._rordpix[det-1], extord, desc="Trace of the slit edges D{:02d}".format(det), use_slitid=det)
+        armbase.UpdateMasters(sciexp, sc, det, ftype="flat", chktype="trace")
+
+    ###############
+    # Generate the 1D wavelength solution
+    update = slf.MasterWaveCalib(fitsdict, sc, det)
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, det, ftype="arc", chktype="trace")
+
+    ###############
+    # Derive the spectral tilt
+    if slf._tilts[det-1] is None:
+        if settings.argflag['reduce']['masters']['reuse']:
+            mstilt_name = armasters.master_name('tilts', settings.argflag['reduce']['masters']['setup'])
+            try:
+                tilts, head = arload.load_master(mstilt_name, frametype="tilts")
+            except IOError:
+                pass
+            else:
+                if armasters.master_uptodate(slf, 'tilts', det, head):
+                    slf.SetFrame(slf._tilts, tilts, det)
+                    settings.argflag['reduce']['masters']['loaded'].append('tilts'+settings.argflag['reduce']['masters']['setup'])
+        if 'tilts'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
+            # First time tilts are derived for this arc frame --> derive the order tilts
+            tilts, satmask, outpar = artrace.multislit_tilt(slf, slf._msarc[det-1], det)
+            slf.SetFrame(slf._tilts, tilts, det)
+            slf.SetFrame(slf._satmask, satmask, det)
+            slf.SetFrame(slf._tiltpar, outpar, det)
+
+    ###############
+    # Prepare the pixel flat field frame
+    update = slf.MasterFlatField(fitsdict, det)
+    if update and reuseMaster: armbase.UpdateMasters(sciexp, sc, det, ftype="flat", chktype="pixelflat")
+
+    ###############
+    # Generate/load a master wave frame
+    update = slf.MasterWave(fitsdict, sc, det)
+    if update and reuseMaster:
+        armbase.UpdateMasters(sciexp, sc, det, ftype="arc", chktype="wave")
+
+    ###############
+    # Check if the user only wants to prepare the calibrations only
+    msgs.info("All calibration frames have been prepared")
+    if settings.argflag['run']['preponly']:
+        msgs.info("If you would like to continue with the reduction, disable the command:" + msgs.newline() +
+                  "run preponly False")
+        return False
+
+    ###############
+    # Write setup
+    #setup = arsort.calib_setup(sc, det, fitsdict, setup_dict, write=True)
+    # Write MasterFrames (currently per detector)
+    armasters.save_masters(slf, det, setup)
+    return True
+
+
+def reduce_science(slf, det, fitsdict):
+    """ Reduce the science frame of a science exposure on a single
+    detector, once its master calibration frames have been prepared
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    det : int
+      detector index (starting from 1)
+    fitsdict : dict
+      Contains relevant information from fits header files
+    """
+    scidx = slf._idx_sci[0]
+    # Resume from the extractions of a previous reduction?
+    products = archeckpoint.load_checkpoint(slf, 'extraction', det)
+    if products is not None:
+        for attr, value in products.items():
+            getattr(slf, attr)[det-1] = value
+        return
+    ###############
+    # Load the science frame and from this generate a Poisson error frame
+    msgs.info("Loading science frame")
+    sciframe = arload.load_frames(fitsdict, [scidx], det,
+                                  frametype='science',
+                                  msbias=slf._msbias[det-1], gain=True)
+    sciframe = sciframe[:, :, 0]
+    # Extract
+    msgs.info("Processing science frame")
+    arproc.reduce_multislit(slf, sciframe, scidx, fitsdict, det)
+    archeckpoint.save_checkpoint(slf, 'extraction', det,
+                                 dict([(attr, getattr(slf, attr)[det-1]) for attr in archeckpoint.science_products]))
+
+    ###############
+    # Using model sky, calculate a flexure correction
+    return
@@ -45,6 +45,7 @@ class Messages:
         import astropy
 
         # Initialize the log
+        self._logname = log
         if log is not None:
             self._log = open(log, 'w')
         else:
@@ -169,6 +170,15 @@ class Messages:
             self._log.close()
         return
 
+    def reopen(self):
+        """
+        Reopen the log file (in append mode) after msgs.error has closed it,
+        when the code carries on (e.g. in observing mode)
+        """
+        if self._log and self._log.closed:
+            self._log = open(self._logname, 'a')
+        return
+
     def signal_handler(self, signalnum, handler):
         """
         Handle signals sent by the keyboard during code execution
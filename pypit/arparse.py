@@ -1,14 +1,22 @@
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 from future.utils import iteritems
 
-import collections
+import hashlib
 import inspect
+import json
+import os
 from os.path import exists as pathexists
 from multiprocessing import cpu_count
 from os.path import dirname, basename, isfile
 from astropy.time import Time
 from textwrap import wrap as wraptext
 from glob import glob
+import numpy as np
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # For Python 2
+    from collections import Mapping
 
 # Logging
 from pypit import ardebug
@@ -18,6 +26,8 @@ msgs = armsgs.get_logger()
 
 # Initialize the settings variables
 argflag, spect = None, None
+# A frozen copy of the spectrograph settings, as they were loaded (see init)
+spect_loaded = None
 
 try:
     basestring
@@ -42,6 +52,120 @@ class NestedDict(dict):
             return value
 
 
+# The keyword functions of each settings class, by name (see dispatch_table)
+_dispatch_tables = {}
+
+# The parsed lines of each settings file, with the modification time of the file
+_settings_lines = {}
+
+
+def dispatch_table(cls):
+    """ The functions of a settings class, by name, so that a keyword
+    (e.g. 'run ncpus') is dispatched straight to its function (run_ncpus).
+    The table of each class is only built once.
+
+    Parameters
+    ----------
+    cls : class
+      A settings class (e.g. ARMLSD or ARMLSD_spect)
+
+    Returns
+    -------
+    table : dict
+    """
+    if cls not in _dispatch_tables:
+        _dispatch_tables[cls] = dict([(name, func) for name, func in inspect.getmembers(cls)
+                                      if inspect.isfunction(func) or inspect.ismethod(func)])
+    return _dispatch_tables[cls]
+
+
+def freeze_value(value):
+    """ An immutable copy of a settings value (see FrozenSettings)
+    """
+    if isinstance(value, dict):
+        return FrozenSettings(value)
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        return tuple([freeze_value(vv) for vv in value])
+    return value
+
+
+def thaw_value(value):
+    """ A mutable copy of a frozen settings value (see FrozenSettings)
+    """
+    if isinstance(value, FrozenSettings):
+        return value.thaw()
+    elif isinstance(value, tuple):
+        return [thaw_value(vv) for vv in value]
+    return value
+
+
+class FrozenSettings(Mapping):
+    """ An immutable copy of a settings dict (e.g. argflag or spect)
+
+    Nested dicts are frozen too, and lists become tuples. A frozen copy
+    can be hashed, and two copies of identical settings are equal, so
+    that it can be used as the key of a cache.
+
+    Parameters
+    ----------
+    dct : dict
+      The settings
+    """
+    def __init__(self, dct):
+        self._dict = dict([(key, freeze_value(value)) for key, value in iteritems(dct)])
+        self._key = None
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenSettings) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "FrozenSettings({0:s})".format(repr(self._dict))
+
+    @property
+    def key(self):
+        """ The md5 hash of the settings
+        """
+        if self._key is None:
+            text = json.dumps(self.thaw(), sort_keys=True, default=str)
+            self._key = hashlib.md5(text.encode('utf-8')).hexdigest()
+        return self._key
+
+    def thaw(self):
+        """ A mutable copy of the settings
+
+        Returns
+        -------
+        dct : dict
+        """
+        return dict([(key, thaw_value(value)) for key, value in iteritems(self._dict)])
+
+
+def freeze():
+    """ Freeze the current settings
+
+    Returns
+    -------
+    frozen : FrozenSettings
+      The arguments and flags ('argflag') and spectrograph settings ('spect')
+    """
+    return FrozenSettings(dict(argflag=argflag, spect=spect))
+
+
 class BaseFunctions(object):
     def __init__(self, defname, savname):
         """ Initialise a settings class. These base functions are used by both spect and argflag settings.
@@ -73,29 +197,33 @@ class BaseFunctions(object):
             msgs.info("Loading default settings")
         else:
             msgs.info("Loading settings")
-        try:
-            if filename is None:
-                if base:
-                    if isinstance(self, BaseArgFlag):
-                        basefile = glob(dirname(__file__))[0] + "/data/settings/settings.baseargflag"
-                    elif isinstance(self, BaseSpect):
-                        basefile = glob(dirname(__file__))[0] + "/data/settings/settings.basespect"
-                    else:
-                        msgs.error("No base for this class")
-                    msgs.info("Loading base settings from {:s}".format(basefile.split('/')[-1]))
-                    lines = open(basefile, 'r').readlines()
+        if filename is None:
+            if base:
+                if isinstance(self, BaseArgFlag):
+                    fname = glob(dirname(__file__))[0] + "/data/settings/settings.baseargflag"
+                elif isinstance(self, BaseSpect):
+                    fname = glob(dirname(__file__))[0] + "/data/settings/settings.basespect"
                 else:
-                    lines = open(self._defname, 'r').readlines()
+                    msgs.error("No base for this class")
+                msgs.info("Loading base settings from {:s}".format(fname.split('/')[-1]))
             else:
-                lines = open(filename, 'r').readlines()
-        except IOError:
+                fname = self._defname
+        else:
+            fname = filename
+        try:
+            # Each settings file is only parsed once, unless it changes
+            mtime = os.stat(fname).st_mtime
+            if _settings_lines.get(fname, (None, None))[0] != mtime:
+                lines = open(fname, 'r').readlines()
+                _settings_lines[fname] = (mtime, self.load_lines(lines))
+        except (IOError, OSError):
             if filename is None:
                 msgs.error("Default settings file does not exist:" + msgs.newline() +
                            self._defname)
             else:
                 msgs.error("Settings file does not exist:" + msgs.newline() +
                            self._defname)
-        linesarr = self.load_lines(lines)
+        linesarr = [list(ll) for ll in _settings_lines[fname][1]]
         return linesarr
 
     def load_lines(self, lines):
@@ -195,7 +323,7 @@ class BaseArgFlag(BaseFunctions):
         value : any type
           The value of the keyword argument provided by lst (when lst is of type list).
         """
-        members = [x for x, y in inspect.getmembers(self, predicate=inspect.ismethod)]
+        members = dispatch_table(type(self))
         if type(lst) is str:
             lst = lst.split()
             value = None  # Force the value to be None
@@ -209,8 +337,7 @@ class BaseArgFlag(BaseFunctions):
         else:
             func = "_".join(lst)
         if func in members:
-            func = "self." + func + "('{0:s}')".format(value)
-            eval(func)
+            members[func](self, value)
         else:
             msgs.error("There appears to be an error on the following parameter:" + msgs.newline() +
                        " ".join(lst) + " {0:s}".format(str(value)))
@@ -224,15 +351,15 @@ class BaseArgFlag(BaseFunctions):
           Each element of the lstall is a list containing a full line of a setting
           (e.g. a single element of lstall might look like ['run', 'redname', 'ARMLSD'])
         """
+        members = dispatch_table(type(self))
         for ll in range(len(lstall)):
             lst = lstall[ll]
             cnt = 1
             succeed = False
-            members = [x for x, y in inspect.getmembers(self, predicate=inspect.ismethod)]
             while cnt < len(lst):
                 func = "_".join(lst[:-cnt])
                 # Determine if there are options that need to be passed to this function
-                options = ""
+                options = dict({})
                 nmbr = [[],   # Suffix on 1st arg
                         [],    # Suffix on 2nd arg
                         ["manual"]]    # Suffix on 3rd arg
@@ -253,16 +380,13 @@ class BaseArgFlag(BaseFunctions):
                         if aa in aatmp:
                             try:
                                 aanum = int(aatmp.lstrip(aa))
-                                options += ", {0:s}nmbr={1:d}".format(ltr, aanum)
+                                options[ltr+'nmbr'] = aanum
                             except ValueError:
                                 msgs.error("There must be an integer suffix on the {0:s} keyword argument:".format(aa) +
                                            msgs.newline() + " ".join(lst))
                             func = func.replace(aatmp, aa)
                 if func in members:
-                    func = "self." + func + "('{0:s}'".format(" ".join(lst[-cnt:]))
-                    func += options
-                    func += ")"
-                    eval(func)
+                    members[func](self, " ".join(lst[-cnt:]), **options)
                     succeed = True
                     break
                 else:
@@ -289,7 +413,7 @@ class BaseArgFlag(BaseFunctions):
             Ingest the upd dictionary into dct
             """
             for (kk, vv) in iteritems(upd):
-                if isinstance(vv, collections.Mapping):
+                if isinstance(vv, Mapping):
                     r = ingest(dct.get(kk, {}), vv)
                     dct[kk] = r
                 else:
@@ -994,6 +1118,31 @@ class BaseArgFlag(BaseFunctions):
         v = key_allowed(v, allowed)
         self.update(v)
 
+    def reduce_combine_tilesize(self, v):
+        """ The approximate memory (in MB) of each strip of rows that is
+        combined at a time when combining a stack of frames. A value <= 0
+        combines the whole stack at once.
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_float(v)
+        self.update(v)
+
+    def reduce_crmask_slitonly(self, v):
+        """ Only search the rows and columns of the detector that contain
+        the slits (and the pixels around them) for cosmic rays?
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
     def reduce_flatfield_method(self, v):
         """ Specify the method that should be used to normalize the flat field
 
@@ -1085,6 +1234,20 @@ class BaseArgFlag(BaseFunctions):
         v = key_allowed_filename(v, allowed)
         self.update(v)
 
+    def reduce_masters_cachesize(self, v):
+        """ The memory (in MB) of the master calibration frames that are
+        held in memory and shared between the science exposures. When
+        this is exceeded, the least recently used master frames are
+        spilled to disk. A value <= 0 means no limit.
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_float(v)
+        self.update(v)
+
     def reduce_masters_file(self, v):
         """
 
@@ -1097,6 +1260,21 @@ class BaseArgFlag(BaseFunctions):
             v = ''
         self.update(v)
 
+    def reduce_masters_format(self, v):
+        """ The format of the master calibration files. With fits, each
+        master frame is saved to its own file. With hdf5, all of the
+        master frames of a setup are saved to a single (chunked and
+        compressed) file.
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        allowed = ['fits', 'hdf5']
+        v = key_allowed(v, allowed)
+        self.update(v)
+
     def reduce_masters_loaded(self, v):
         """
 
@@ -1131,6 +1309,19 @@ class BaseArgFlag(BaseFunctions):
             v = ''
         self.update(v)
 
+    def reduce_memmap(self, v):
+        """ Memory-map the uncompressed raw frames and combine the calibration
+        frames in spatial tiles? This keeps the peak memory independent of the
+        number of frames being combined.
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
     def reduce_overscan_method(self, v):
         """ Specify the method that should be used to fit the overscan
 
@@ -1189,6 +1380,24 @@ class BaseArgFlag(BaseFunctions):
         v = key_float(v)
         self.update(v)
 
+    def reduce_precision(self, v):
+        """ Floating point precision used to load and combine the calibration
+        frames. With 'single', the raw calibration frames are converted from
+        their native (integer) type straight to float32, the frames are
+        combined in float32 (the sums are still accumulated in double
+        precision), and the master bias and normalised pixel flat are kept
+        in float32. This halves the memory of these images. The science
+        frames, and all the other master frames, are always double precision.
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        allowed = ['double', 'single']
+        v = key_allowed(v, allowed)
+        self.update(v)
+
     def reduce_skysub_bspline_everyn(self, v):
         """ bspline fitting parameters
 
@@ -1247,6 +1456,19 @@ class BaseArgFlag(BaseFunctions):
         v = key_bool(v)
         self.update(v)
 
+    def run_batch(self, v):
+        """ Prepare all of the master calibration frames first, and then
+        reduce the science exposures in parallel on a pool of up to
+        'run ncpus' processes?
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
     def run_calcheck(self, v):
         """ If True, PYPIT will not reduce the data, it will just check to
         make sure all calibration data are present
@@ -1259,6 +1481,31 @@ class BaseArgFlag(BaseFunctions):
         v = key_bool(v)
         self.update(v)
 
+    def run_checkpoint(self, v):
+        """ Save checkpoints of the stages of the reduction of each science
+        exposure (sky model, object traces, extractions and sensitivity
+        function), so that an interrupted reduction can be resumed?
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
+    def run_detpool(self, v):
+        """ Reduce the detectors of each science exposure in parallel,
+        on a pool of up to 'run ncpus' processes?
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
     def run_directory_master(self, v):
         """ Child Directory name for master calibration frames
 
@@ -1289,6 +1536,19 @@ class BaseArgFlag(BaseFunctions):
         """
         self.update(v)
 
+    def run_headindex(self, v):
+        """ Keep a persistent index of the values read from the headers
+        of the raw files (<redname>.hindex), so that only the headers of
+        new or modified files are read when PYPIT is rerun?
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
     def run_load_settings(self, v):
         """ Load a reduction settings file (Note: this command overwrites all default settings)
 
@@ -1323,6 +1583,20 @@ class BaseArgFlag(BaseFunctions):
                         msgs.newline() + "file or 'None'. The following file does not exist:" + msgs.newline() + v)
         self.update(v)
 
+    def run_memory(self, v):
+        """ The memory (in MB) that can be used by the science exposures
+        that are reduced in parallel (see run batch). A value <= 0 means
+        the physical memory that is available when the science exposures
+        are reduced.
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_float(v)
+        self.update(v)
+
     def run_ncpus(self, v):
         """ Number of CPUs to use (-1 means all bar one CPU available,
         -2 means all bar two CPUs available)
@@ -1432,6 +1706,31 @@ class BaseArgFlag(BaseFunctions):
         """
         self.update(v)
 
+    def run_resume(self, v):
+        """ Resume a reduction: skip the science exposures that have already
+        been reduced, and the stages that have been checkpointed (see
+        run checkpoint)?
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
+    def run_retries(self, v):
+        """ The number of times that the reduction of a science exposure
+        is retried, if it fails (see run batch)
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_int(v)
+        self.update(v)
+
     def run_setup(self, v):
         """ If True, run in setup mode.  Useful to parse files when starting
         reduction on a large set of data
@@ -1443,6 +1742,20 @@ class BaseArgFlag(BaseFunctions):
         v = key_bool(v)
         self.update(v)
 
+    def run_sortcache(self, v):
+        """ Keep a persistent cache of the sorted files, the calibration
+        frames matched to each science frame and the setups
+        (<redname>.scache), so that they are reused when PYPIT is rerun
+        on the same files with the same settings?
+
+        Parameters
+        ----------
+        v : str
+          value of the keyword argument given by the name of this function
+        """
+        v = key_bool(v)
+        self.update(v)
+
     def run_spectrograph(self, v):
         """ The name of the spectrograph data that should be reduced.
         A corresponding settings file must be available.
@@ -2097,7 +2410,7 @@ class BaseSpect(BaseFunctions):
         return
 
     def set_param(self, lst, value=None):
-        members = [x for x, y in inspect.getmembers(self, predicate=inspect.ismethod)]
+        members = dispatch_table(type(self))
         if type(lst) is str:
             lst = lst.split()
         if value is None:
@@ -2106,8 +2419,7 @@ class BaseSpect(BaseFunctions):
         else:
             func = "_".join(lst)
         if func in members:
-            func = "self." + func + "('{0:s}')".format(value)
-            eval(func)
+            members[func](self, value)
         else:
             msgs.error("There appears to be an error on the following parameter:" + msgs.newline() +
                        " ".join(lst) + " {0:s}".format(str(value)))
@@ -2115,15 +2427,15 @@ class BaseSpect(BaseFunctions):
 
     def set_paramlist(self, lstall):
         frmtyp = ["standard", "bias", "pixelflat", "trace", "pinhole", "arc", "dark"]
+        members = dispatch_table(type(self))
         for ll in range(len(lstall)):
             lst = lstall[ll]
             cnt = 1
             succeed = False
-            members = [x for x, y in inspect.getmembers(self, predicate=inspect.ismethod)]
             while cnt < len(lst):
                 func = "_".join(lst[:-cnt])
                 # Determine if there are options that need to be passed to this function
-                options = ""
+                options = dict({})
                 nmbr = [["det"],   # Suffix on 1st arg
                         ["dataext", "datasec", "oscansec", "lampname", "lampstat", "headext"],    # Suffix on 2nd arg
                         ["condition"]]    # Suffix on 3rd arg
@@ -2144,17 +2456,14 @@ class BaseSpect(BaseFunctions):
                         if aa in aatmp:
                             try:
                                 aanum = int(aatmp.lstrip(aa))
-                                options += ", {0:s}nmbr={1:d}".format(ltr, aanum)
+                                options[ltr+'nmbr'] = aanum
                             except ValueError:
                                 msgs.error("There must be an integer suffix on the {0:s} keyword argument:".format(aa) +
                                            msgs.newline() + " ".join(lst))
                             func = func.replace(aatmp, aa)
                 # Now test if this is a function
                 if func in members:
-                    func = "self." + func + "('{0:s}'".format(" ".join(lst[-cnt:]))
-                    func += options
-                    func += ")"
-                    eval(func)
+                    members[func](self, " ".join(lst[-cnt:]), **options)
                     succeed = True
                     break
                 else:
@@ -2193,7 +2502,7 @@ class BaseSpect(BaseFunctions):
             Ingest the upd dictionary into dct
             """
             for (kk, vv) in iteritems(upd):
-                if isinstance(vv, collections.Mapping):
+                if isinstance(vv, Mapping):
                     r = ingest(dct.get(kk, {}), vv)
                     dct[kk] = r
                 else:
@@ -3622,9 +3931,12 @@ def init(afclass, spclass):
     """
     global argflag
     global spect
+    global spect_loaded
     global ftdict
     argflag = afclass.__dict__['_argflag']
     spect = spclass.__dict__['_spect']
+    # spect is updated during the reduction (e.g. with the trimmed data sections)
+    spect_loaded = FrozenSettings(spect)
     if '_ftdict' in spclass.__dict__.keys():
         ftdict = spclass.__dict__['_ftdict']
     else:
@@ -1,11 +1,14 @@
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 
+import time
 import numpy as np
 from scipy.signal import savgol_filter
 import scipy.signal as signal
 import scipy.ndimage as ndimage
 import scipy.interpolate as interp
 from matplotlib import pyplot as plt
+from pypit import archeckpoint
+from pypit import arcosmic
 from pypit import arextract
 from pypit import arlris
 from pypit import armsgs
@@ -354,7 +357,7 @@ def flatfield(slf, sciframe, flatframe, det, snframe=None,
     if (varframe is not None) & (snframe is not None):
         msgs.error("Cannot set both varframe and snframe")
     if slitprofile is not None:
-        flatframe *= slitprofile
+        flatframe = flatframe * slitprofile
     # New image
     retframe = np.zeros_like(sciframe)
     w = np.where(flatframe > 0.0)
@@ -703,7 +706,7 @@ def reduce_prepare(slf, sciframe, scidx, fitsdict, det, standard=False):
     Parameters
     ----------
     sciframe : image
-      Bias subtracted image (using arload.load_frame)
+      Bias subtracted and gain corrected image (using arload.load_frames with gain=True)
     scidx : int
       Index of the frame
     fitsdict : dict
@@ -716,8 +719,6 @@ def reduce_prepare(slf, sciframe, scidx, fitsdict, det, standard=False):
     # Check inputs
     if not isinstance(scidx, (int,np.integer)):
         raise IOError("scidx needs to be an int")
-    # Convert ADUs to electrons
-    sciframe *= gain_frame(slf, det)
     # Mask
     slf._scimask[det-1] = np.zeros_like(sciframe).astype(int)
     msgs.info("Masking bad pixels")
@@ -756,7 +757,7 @@ def reduce_echelle(slf, sciframe, scidx, fitsdict, det,
     Parameters
     ----------
     sciframe : image
-      Bias subtracted image (using arload.load_frame)
+      Bias subtracted and gain corrected image (using arload.load_frames with gain=True)
     scidx : int
       Index of the frame
     fitsdict : dict
@@ -911,7 +912,7 @@ def reduce_multislit(slf, sciframe, scidx, fitsdict, det, standard=False):
     Parameters
     ----------
     sciframe : image
-      Bias subtracted image (using arload.load_frame)
+      Bias subtracted and gain corrected image (using arload.load_frames with gain=True)
     scidx : int
       Index of the frame
     fitsdict : dict
@@ -921,65 +922,83 @@ def reduce_multislit(slf, sciframe, scidx, fitsdict, det, standard=False):
     standard : bool, optional
       Standard star frame?
     """
-    sciframe, rawvarframe, crmask = reduce_prepare(slf, sciframe, scidx, fitsdict, det, standard=standard)
-
-    ###############
-    # Estimate Sky Background
-    if settings.argflag['reduce']['skysub']['perform']:
-        # Perform an iterative background/science extraction
-        if msgs._debug['obj_profile'] and False:
-            msgs.warn("Reading background from 2D image on disk")
-            from astropy.io import fits
-            datfil = settings.argflag['run']['directory']['science']+'/spec2d_{:s}.fits'.format(slf._basename.replace(":","_"))
-            hdu = fits.open(datfil)
-            bgframe = hdu[1].data - hdu[2].data
-        else:
-            msgs.info("First estimate of the sky background")
-            bgframe = bg_subtraction(slf, det, sciframe, rawvarframe, crmask)
-        #bgframe = bg_subtraction(slf, det, sciframe, varframe, crmask)
-        modelvarframe = variance_frame(slf, det, sciframe, scidx, fitsdict, skyframe=bgframe)
+    # Resume from the sky model of a previous reduction?
+    sky = None
+    if not standard:
+        sky = archeckpoint.load_checkpoint(slf, 'skymodel', det)
+    if sky is not None:
+        sciframe, rawvarframe, crmask = sky['sciframe'], sky['rawvarframe'], sky['crmask']
+        modelvarframe, bgframe = sky['modelvarframe'], sky['bgframe']
+        slf._sciframe[det-1] = sciframe
+        slf._rawvarframe[det-1] = rawvarframe
+        slf._scimask[det-1] = sky['scimask']
+        slf._modelvarframe[det-1] = modelvarframe
+        slf._bgframe[det-1] = bgframe
     else:
-        modelvarframe = rawvarframe.copy()
-        bgframe = np.zeros_like(sciframe)
-    if not standard:  # Need to save
-        slf._modelvarframe[det - 1] = modelvarframe
-        slf._bgframe[det - 1] = bgframe
-
-    ###############
-    # Estimate trace of science objects
-    scitrace = artrace.trace_object(slf, det, sciframe-bgframe, modelvarframe, crmask,
-                                    bgreg=20, doqa=False)
-    if scitrace is None:
-        msgs.info("Not performing extraction for science frame"+msgs.newline()+fitsdict['filename'][scidx[0]])
-        debugger.set_trace()
-        #continue
-
-    # Make sure that there are objects
-    noobj = True
-    for sl in range(len(scitrace)):
-        if scitrace[sl]['nobj'] != 0:
-            noobj = False
-    if noobj is True:
-        msgs.warn("No objects to extract for science frame" + msgs.newline() + fitsdict['filename'][scidx])
-        return True
+        sciframe, rawvarframe, crmask = reduce_prepare(slf, sciframe, scidx, fitsdict, det, standard=standard)
+
+        ###############
+        # Estimate Sky Background
+        if settings.argflag['reduce']['skysub']['perform']:
+            # Perform an iterative background/science extraction
+            if msgs._debug['obj_profile'] and False:
+                msgs.warn("Reading background from 2D image on disk")
+                from astropy.io import fits
+                datfil = settings.argflag['run']['directory']['science']+'/spec2d_{:s}.fits'.format(slf._basename.replace(":","_"))
+                hdu = fits.open(datfil)
+                bgframe = hdu[1].data - hdu[2].data
+            else:
+                msgs.info("First estimate of the sky background")
+                bgframe = bg_subtraction(slf, det, sciframe, rawvarframe, crmask)
+            #bgframe = bg_subtraction(slf, det, sciframe, varframe, crmask)
+            modelvarframe = variance_frame(slf, det, sciframe, scidx, fitsdict, skyframe=bgframe)
+        else:
+            modelvarframe = rawvarframe.copy()
+            bgframe = np.zeros_like(sciframe)
+        if not standard:  # Need to save
+            slf._modelvarframe[det - 1] = modelvarframe
+            slf._bgframe[det - 1] = bgframe
+
+        ###############
+        # Estimate trace of science objects
+        scitrace = artrace.trace_object(slf, det, sciframe-bgframe, modelvarframe, crmask,
+                                        bgreg=20, doqa=False)
+        if scitrace is None:
+            msgs.info("Not performing extraction for science frame"+msgs.newline()+fitsdict['filename'][scidx[0]])
+            debugger.set_trace()
+            #continue
 
-    ###############
-    # Finalize the Sky Background image
-    if settings.argflag['reduce']['skysub']['perform']:
-        # Perform an iterative background/science extraction
-        msgs.info("Finalizing the sky background image")
-        # Create a trace mask of the object
-        trcmask = np.zeros_like(sciframe)
+        # Make sure that there are objects
+        noobj = True
         for sl in range(len(scitrace)):
-            trcmask += scitrace[sl]['object'].sum(axis=2)
-        trcmask[np.where(trcmask > 0.0)] = 1.0
-        bgframe = bg_subtraction(slf, det, sciframe, modelvarframe, crmask, tracemask=trcmask)
-        # Redetermine the variance frame based on the new sky model
-        modelvarframe = variance_frame(slf, det, sciframe, scidx, fitsdict, skyframe=bgframe)
-        # Save
+            if scitrace[sl]['nobj'] != 0:
+                noobj = False
+        if noobj is True:
+            msgs.warn("No objects to extract for science frame" + msgs.newline() + fitsdict['filename'][scidx])
+            return True
+
+        ###############
+        # Finalize the Sky Background image
+        if settings.argflag['reduce']['skysub']['perform']:
+            # Perform an iterative background/science extraction
+            msgs.info("Finalizing the sky background image")
+            # Create a trace mask of the object
+            trcmask = np.zeros_like(sciframe)
+            for sl in range(len(scitrace)):
+                trcmask += scitrace[sl]['object'].sum(axis=2)
+            trcmask[np.where(trcmask > 0.0)] = 1.0
+            bgframe = bg_subtraction(slf, det, sciframe, modelvarframe, crmask, tracemask=trcmask)
+            # Redetermine the variance frame based on the new sky model
+            modelvarframe = variance_frame(slf, det, sciframe, scidx, fitsdict, skyframe=bgframe)
+            # Save
+            if not standard:
+                slf._modelvarframe[det-1] = modelvarframe
+                slf._bgframe[det-1] = bgframe
         if not standard:
-            slf._modelvarframe[det-1] = modelvarframe
-            slf._bgframe[det-1] = bgframe
+            archeckpoint.save_checkpoint(slf, 'skymodel', det,
+                                         dict(sciframe=sciframe, rawvarframe=rawvarframe, crmask=crmask,
+                                              scimask=slf._scimask[det-1], modelvarframe=modelvarframe,
+                                              bgframe=bgframe))
 
     ###############
     # Flexure down the slit? -- Not currently recommended
@@ -1021,10 +1040,15 @@ def reduce_frame(slf, sciframe, rawvarframe, modelvarframe, bgframe, scidx, fits
 
     ###############
     # Determine the final trace of the science objects
+    if scitrace is None and not standard:
+        # Resume from the object traces of a previous reduction?
+        scitrace = archeckpoint.load_checkpoint(slf, 'objtrace', det)
     if scitrace is None:
         msgs.info("Performing final object trace")
         scitrace = artrace.trace_object(slf, det, sciframe-bgframe, modelvarframe, crmask,
                                         bgreg=20, doqa=(not standard))
+        if not standard:
+            archeckpoint.save_checkpoint(slf, 'objtrace', det, scitrace)
     if standard:
         slf._msstd[det-1]['trace'] = scitrace
         specobjs = arspecobj.init_exp(slf, scidx, det, fitsdict, scitrace, objtype='standard')
@@ -1160,7 +1184,7 @@ def slit_profile(slf, mstrace, det, ntcky=None):
     if (settings.spect[dnum]['numamplifiers'] > 1) & (nslits > 1):
         sclframe = get_ampscale(slf, det, mstrace)
         # Divide the master flat by the relative scale frame
-        mstrace /= sclframe
+        mstrace = mstrace / sclframe
 
     mstracenrm = mstrace.copy()
     msblaze = np.ones_like(slf._lordloc[det - 1])
@@ -1295,11 +1319,13 @@ def lacosmic(slf, fitsdict, det, sciframe, scidx, maxiter=1, grow=1.5, maskval=-
     (article : U{http://arxiv.org/abs/astro-ph/0108003})
     This routine is mostly courtesy of Malte Tewes
 
+    The detection is carried out by arcosmic.detect, with the median filters
+    run on 'run ncpus' threads. With 'reduce crmask slitonly True', only the
+    rows and columns that contain the slits are searched.
+
     :param grow: Once CRs are identified, grow each CR detection by all pixels within this radius
     :return: mask of cosmic rays (0=no CR, 1=CR)
     """
-    from pypit import arcyutils
-    from pypit import arcyproc
     dnum = settings.get_dnum(det)
 
     msgs.info("Detecting cosmic rays with the L.A.Cosmic algorithm")
@@ -1307,126 +1333,51 @@ def lacosmic(slf, fitsdict, det, sciframe, scidx, maxiter=1, grow=1.5, maskval=-
     sigclip = 5.0
     sigfrac = 0.3
     objlim  = 5.0
-    # Set the settings
-    scicopy = sciframe.copy()
-    crmask = np.cast['bool'](np.zeros(sciframe.shape))
-    sigcliplow = sigclip * sigfrac
+    nthreads = max(1, settings.argflag['run']['ncpus'])
 
     # Determine if there are saturated pixels
-    satpix = np.zeros_like(sciframe)
     satlev = settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear']
-    wsat = np.where(sciframe >= satlev)
-    if wsat[0].size == 0: satpix = None
-    else:
-        satpix[wsat] = 1.0
-        satpix = np.cast['bool'](satpix)
-
-    # Define the kernels
-    laplkernel = np.array([[0.0, -1.0, 0.0], [-1.0, 4.0, -1.0], [0.0, -1.0, 0.0]])  # Laplacian kernal
-    growkernel = np.ones((3,3))
-    for i in range(1, maxiter+1):
-        msgs.info("Convolving image with Laplacian kernel")
-        # Subsample, convolve, clip negative values, and rebin to original size
-        #set_trace()
-        subsam = arutils.subsample(scicopy)
-        conved = signal.convolve2d(subsam, laplkernel, mode="same", boundary="symm")
-        cliped = conved.clip(min=0.0)
-        lplus = arutils.rebin(cliped, np.array(cliped.shape)/2.0)
-
-        msgs.info("Creating noise model")
-        # Build a custom noise map, and compare  this to the laplacian
-        m5 = ndimage.filters.median_filter(scicopy, size=5, mode='mirror')
-        if simple_var:
-            noise = np.sqrt(np.abs(m5)) #variance_frame(slf, det, m5, scidx, fitsdict))
+    satpix = sciframe >= satlev
+    if not np.any(satpix):
+        satpix = None
+
+    # Limit the search to the slits?
+    region = None
+    if settings.argflag['reduce']['crmask']['slitonly']:
+        if slf._slitpix[det-1] is None:
+            msgs.warn("The slits are not known -- searching the full frame for cosmic rays")
         else:
-            noise = np.sqrt(variance_frame(slf, det, m5, scidx, fitsdict))
-        msgs.info("Calculating Laplacian signal to noise ratio")
-
-        # Laplacian S/N
-        s = lplus / (2.0 * noise)  # Note that the 2.0 is from the 2x2 subsampling
-
-        # Remove the large structures
-        sp = s - ndimage.filters.median_filter(s, size=5, mode='mirror')
-
-        msgs.info("Selecting candidate cosmic rays")
-        # Candidate cosmic rays (this will include HII regions)
-        candidates = sp > sigclip
-        nbcandidates = np.sum(candidates)
-
-        msgs.info("{0:5d} candidate pixels".format(nbcandidates))
-
-        # At this stage we use the saturated stars to mask the candidates, if available :
-        if satpix is not None:
-            msgs.info("Masking saturated pixels")
-            candidates = np.logical_and(np.logical_not(satpix), candidates)
-            nbcandidates = np.sum(candidates)
-
-            msgs.info("{0:5d} candidate pixels not part of saturated stars".format(nbcandidates))
-
-        msgs.info("Building fine structure image")
-
-        # We build the fine structure image :
-        m3 = ndimage.filters.median_filter(scicopy, size=3, mode='mirror')
-        m37 = ndimage.filters.median_filter(m3, size=7, mode='mirror')
-        f = m3 - m37
-        f /= noise
-        f = f.clip(min=0.01)
-
-        msgs.info("Removing suspected compact bright objects")
-
-        # Now we have our better selection of cosmics :
-        cosmics = np.logical_and(candidates, sp/f > objlim)
-        nbcosmics = np.sum(cosmics)
-
-        msgs.info("{0:5d} remaining candidate pixels".format(nbcosmics))
-
-        # What follows is a special treatment for neighbors, with more relaxed constains.
-
-        msgs.info("Finding neighboring pixels affected by cosmic rays")
-
-        # We grow these cosmics a first time to determine the immediate neighborhod  :
-        growcosmics = np.cast['bool'](signal.convolve2d(np.cast['float32'](cosmics), growkernel, mode="same", boundary="symm"))
-
-        # From this grown set, we keep those that have sp > sigmalim
-        # so obviously not requiring sp/f > objlim, otherwise it would be pointless
-        growcosmics = np.logical_and(sp > sigclip, growcosmics)
-
-        # Now we repeat this procedure, but lower the detection limit to sigmalimlow :
-
-        finalsel = np.cast['bool'](signal.convolve2d(np.cast['float32'](growcosmics), growkernel, mode="same", boundary="symm"))
-        finalsel = np.logical_and(sp > sigcliplow, finalsel)
-
-        # Unmask saturated pixels:
-        if satpix != None:
-            msgs.info("Masking saturated stars")
-            finalsel = np.logical_and(np.logical_not(satpix), finalsel)
-
-        ncrp = np.sum(finalsel)
-
-        msgs.info("{0:5d} pixels detected as cosmics".format(ncrp))
-
-        # We find how many cosmics are not yet known :
-        newmask = np.logical_and(np.logical_not(crmask), finalsel)
-        nnew = np.sum(newmask)
-
-        # We update the mask with the cosmics we have found :
-        crmask = np.logical_or(crmask, finalsel)
+            region = arcosmic.slit_region(slf._slitpix[det-1])
+    if region is None:
+        region = (slice(None), slice(None))
+    else:
+        msgs.info("Searching rows {0:d}-{1:d} and columns {2:d}-{3:d} for cosmic rays".format(
+            region[0].start, region[0].stop-1, region[1].start, region[1].stop-1))
 
-        msgs.info("Iteration {0:d} -- {1:d} pixels identified as cosmic rays ({2:d} new)".format(i, ncrp, nnew))
-        if ncrp == 0: break
+    def noise_model(m5):
+        if simple_var:
+            return np.sqrt(np.abs(m5))
+        # The variance frame needs the full frame
+        m5full = np.zeros_like(sciframe)
+        m5full[region] = m5
+        return np.sqrt(variance_frame(slf, det, m5full, scidx, fitsdict)[region])
+
+    crmask = np.zeros(sciframe.shape, dtype=bool)
+    crmask[region] = arcosmic.detect(sciframe[region], noise_model,
+                                     satpix=None if satpix is None else satpix[region],
+                                     sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
+                                     maxiter=maxiter, nthreads=nthreads)
     # Additional algorithms (not traditionally implemented by LA cosmic) to remove some false positives.
     msgs.work("The following algorithm would be better on the rectified, tilts-corrected image")
     filt  = ndimage.sobel(sciframe, axis=1, mode='constant')
     filty = ndimage.sobel(filt/np.sqrt(np.abs(sciframe)), axis=0, mode='constant')
     filty[np.where(np.isnan(filty))]=0.0
-    sigimg  = arcyproc.cr_screen(filty,0.0)
+    sigimg  = arcosmic.cr_screen(filty, 0.0)
     sigsmth = ndimage.filters.gaussian_filter(sigimg,1.5)
     sigsmth[np.where(np.isnan(sigsmth))]=0.0
-    sigmask = np.cast['bool'](np.zeros(sciframe.shape))
-    sigmask[np.where(sigsmth>sigclip)] = True
-    crmask = np.logical_and(crmask, sigmask)
+    crmask &= sigsmth > sigclip
     msgs.info("Growing cosmic ray mask by 1 pixel")
-    crmask = arcyutils.grow_masked(crmask.astype(np.float), grow, 1.0)
+    crmask = arcosmic.grow_mask(crmask, grow).astype(np.float)
     return crmask
 
 
@@ -1484,106 +1435,344 @@ def rn_frame(slf, det):
     return rnimg
 
 
-def sub_overscan(frame, det):
+def overscan_model(frame, det):
     """
-    Subtract overscan
+    Model the overscan region of each amplifier
 
     Parameters
     ----------
     frame : ndarray
-      frame which should have the overscan region subtracted
+      frame (or memory-mapped frame) containing the overscan regions
     det : int
       Detector Index
 
     Returns
     -------
-    frame : ndarray
-      The input frame with the overscan region subtracted
+    model : list
+      One (xds, yds, ossub) tuple per amplifier, where xds and yds
+      are the rows and columns of the data section, and ossub is
+      the overscan level that can be broadcast to frame[np.ix_(xds, yds)]
     """
-    dnum = settings.get_dnum(det)
+    return overscan_models([frame], det)[0]
+
 
+def overscan_models(frames, det, timing=None):
+    """
+    Model the overscan region of each amplifier of a stack of frames
+
+    For each amplifier, the overscan regions of all frames are collapsed
+    with a single median, and the overscan vectors of all frames are
+    modelled together (see fit_overscan), rather than with one small
+    fit per amplifier per frame.
+
+    Parameters
+    ----------
+    frames : list of ndarray
+      frames (or memory-mapped frames) containing the overscan regions.
+      All of the frames must have the same shape.
+    det : int
+      Detector Index
+    timing : list, optional
+      If a list is given, one dict per amplifier is appended to it, with
+      the time spent extracting ('extract') and fitting ('fit') the overscan
+
+    Returns
+    -------
+    models : list
+      The model of each frame, as returned by overscan_model()
+    """
+    dnum = settings.get_dnum(det)
+    method = settings.argflag['reduce']['overscan']['method'].lower()
+    shape = frames[0].shape
+    models = [[] for frame in frames]
     for i in range(settings.spect[dnum]['numamplifiers']):
+        tstart = time.time()
         # Determine the section of the chip that contains data
-        datasec = "datasec{0:02d}".format(i+1)
-        dx0, dx1 = settings.spect[dnum][datasec][0][0], settings.spect[dnum][datasec][0][1]
-        dy0, dy1 = settings.spect[dnum][datasec][1][0], settings.spect[dnum][datasec][1][1]
-        if dx0 < 0: dx0 += frame.shape[0]
-        if dx1 <= 0: dx1 += frame.shape[0]
-        if dy0 < 0: dy0 += frame.shape[1]
-        if dy1 <= 0: dy1 += frame.shape[1]
+        dx0, dx1, dy0, dy1 = datasec_range(shape, det, i+1)
         xds = np.arange(dx0, dx1)
         yds = np.arange(dy0, dy1)
         # Determine the section of the chip that contains the overscan region
         oscansec = "oscansec{0:02d}".format(i+1)
         ox0, ox1 = settings.spect[dnum][oscansec][0][0], settings.spect[dnum][oscansec][0][1]
         oy0, oy1 = settings.spect[dnum][oscansec][1][0], settings.spect[dnum][oscansec][1][1]
-        if ox0 < 0: ox0 += frame.shape[0]
-        if ox1 <= 0: ox1 += min(frame.shape[0], dx1)  # Truncate to datasec
-        if oy0 < 0: oy0 += frame.shape[1]
-        if oy1 <= 0: oy1 += min(frame.shape[1], dy1)  # Truncate to datasec
+        if ox0 < 0: ox0 += shape[0]
+        if ox1 <= 0: ox1 += min(shape[0], dx1)  # Truncate to datasec
+        if oy0 < 0: oy0 += shape[1]
+        if oy1 <= 0: oy1 += min(shape[1], dy1)  # Truncate to datasec
         xos = np.arange(ox0, ox1)
         yos = np.arange(oy0, oy1)
         w = np.ix_(xos, yos)
-        oscan = frame[w]
+        oscan = np.array([frame[w] for frame in frames])
         # Make sure the overscan section has at least one side consistent with datasec
         if dx1-dx0 == ox1-ox0:
-            osfit = np.median(oscan, axis=1)  # Mean was hit by CRs
+            osfit = np.median(oscan, axis=2)  # Mean was hit by CRs
         elif dy1-dy0 == oy1-oy0:
-            osfit = np.median(oscan, axis=0)
-        elif settings.argflag['reduce']['overscan']['method'].lower() == "median":
-            osfit = np.median(oscan)
+            osfit = np.median(oscan, axis=1)
+        elif method == "median":
+            osfit = np.median(oscan.reshape(len(frames), -1), axis=1).reshape(len(frames), 1)
         else:
             msgs.error("Overscan sections do not match amplifier sections for amplifier {0:d}".format(i+1))
-        # Fit/Model the overscan region
-        if settings.argflag['reduce']['overscan']['method'].lower() == "polynomial":
-            c = np.polyfit(np.arange(osfit.size), osfit, settings.argflag['reduce']['overscan']['params'][0])
-            ossub = np.polyval(c, np.arange(osfit.size))#.reshape(osfit.size,1)
-        elif settings.argflag['reduce']['overscan']['method'].lower() == "savgol":
-            ossub = savgol_filter(osfit, settings.argflag['reduce']['overscan']['params'][1], settings.argflag['reduce']['overscan']['params'][0])
-        elif settings.argflag['reduce']['overscan']['method'].lower() == "median":  # One simple value
-            ossub = osfit * np.ones(1)
-        else:
-            msgs.warn("Overscan subtraction method {0:s} is not implemented".format(settings.argflag['reduce']['overscan']['method']))
-            msgs.info("Using a linear fit to the overscan region")
-            c = np.polyfit(np.arange(osfit.size), osfit, 1)
-            ossub = np.polyval(c, np.arange(osfit.size))#.reshape(osfit.size,1)
-        # Determine the section of the chip that contains data for this amplifier
-        wd = np.ix_(xds, yds)
-        ossub = ossub.reshape(osfit.size, 1)
-        if wd[0].shape[0] == ossub.shape[0]:
-            frame[wd] -= ossub
-        elif wd[1].shape[1] == ossub.shape[0]:
-            frame[wd] -= ossub.T
-        elif settings.argflag['reduce']['overscan']['method'].lower() == "median":
-            frame[wd] -= osfit
-        else:
-            msgs.error("Could not subtract bias from overscan region --"+msgs.newline()+"size of extracted regions does not match")
+        del oscan
+        # Fit/Model the overscan region of all frames
+        tfit = time.time()
+        ossub = fit_overscan(osfit)
+        for k in range(len(frames)):
+            # Determine the section of the chip that contains data for this amplifier
+            ksub = ossub[k].reshape(ossub.shape[1], 1)
+            if xds.size == ksub.shape[0]:
+                models[k].append((xds, yds, ksub))
+            elif yds.size == ksub.shape[0]:
+                models[k].append((xds, yds, ksub.T))
+            elif method == "median":
+                models[k].append((xds, yds, osfit[k, 0]))
+            else:
+                msgs.error("Could not subtract bias from overscan region --"+msgs.newline()+"size of extracted regions does not match")
+        tend = time.time()
+        if timing is not None:
+            timing.append(dict(amp=i+1, extract=tfit-tstart, fit=tend-tfit))
+        if len(frames) > 1:
+            msgs.info("Overscan of amplifier {0:d} in {1:d} frames: {2:.3f}s extracting, {3:.3f}s fitting".format(
+                i+1, len(frames), tfit-tstart, tend-tfit))
+    # Return
+    return models
+
+
+def fit_overscan(osfit):
+    """
+    Model overscan vectors with the 'reduce overscan method'
+
+    All of the vectors are fitted together: the polynomial fits are
+    solved with one least-squares call, and the Savitzky-Golay filter
+    is applied to all vectors at once. The model of each vector is the
+    same (to within rounding errors) as fitting each vector on its own.
+
+    Parameters
+    ----------
+    osfit : ndarray (2 dimensional)
+      One overscan vector per row
+
+    Returns
+    -------
+    ossub : ndarray (2 dimensional)
+      The model of each overscan vector
+    """
+    method = settings.argflag['reduce']['overscan']['method'].lower()
+    params = settings.argflag['reduce']['overscan']['params']
+    if method == "polynomial":
+        order = params[0]
+    elif method == "savgol":
+        return savgol_filter(osfit, params[1], params[0], axis=-1)
+    elif method == "median":  # One simple value
+        return osfit * np.ones(1)
+    else:
+        msgs.warn("Overscan subtraction method {0:s} is not implemented".format(method))
+        msgs.info("Using a linear fit to the overscan region")
+        order = 1
+    xfit = np.arange(osfit.shape[1])
+    coeff = np.polyfit(xfit, osfit.T, order)
+    # Evaluate the polynomials as np.polyval
+    ossub = np.zeros(osfit.shape)
+    for c in coeff:
+        ossub = ossub * xfit + c[:, np.newaxis]
+    return ossub
+
+
+def sub_overscan(frame, det):
+    """
+    Subtract overscan
+
+    Parameters
+    ----------
+    frame : ndarray
+      frame which should have the overscan region subtracted
+    det : int
+      Detector Index
+
+    Returns
+    -------
+    frame : ndarray
+      The input frame with the overscan region subtracted
+    """
+    for xds, yds, ossub in overscan_model(frame, det):
+        frame[np.ix_(xds, yds)] -= ossub
     # Return
-    del xds, yds, xos, yos, oscan
     return frame
 
 
-def trim(frame, det):
+def datasec_range(shape, det, amp):
+    """ The rows and columns of the data section of an amplifier
+
+    Parameters
+    ----------
+    shape : tuple
+      Shape of the untrimmed frame
+    det : int
+      Detector Index
+    amp : int
+      Amplifier index, starts at 1
+
+    Returns
+    -------
+    x0, x1, y0, y1 : int
+      The data section is frame[x0:x1, y0:y1]
+    """
+    dnum = settings.get_dnum(det)
+    datasec = "datasec{0:02d}".format(amp)
+    x0, x1 = settings.spect[dnum][datasec][0][0], settings.spect[dnum][datasec][0][1]
+    y0, y1 = settings.spect[dnum][datasec][1][0], settings.spect[dnum][datasec][1][1]
+    if x0 < 0:
+        x0 += shape[0]
+    if x1 <= 0:
+        x1 += shape[0]
+    if y0 < 0:
+        y0 += shape[1]
+    if y1 <= 0:
+        y1 += shape[1]
+    return x0, x1, y0, y1
+
+
+def trim_indices(shape, det):
+    """ Rows and columns of a frame that are retained by trim()
+
+    Parameters
+    ----------
+    shape : tuple
+      Shape of the untrimmed frame
+    det : int
+      Detector Index
+
+    Returns
+    -------
+    xv : ndarray
+      Rows of the data sections
+    yv : ndarray
+      Columns of the data sections
+    """
     dnum = settings.get_dnum(det)
     for i in range(settings.spect[dnum]['numamplifiers']):
-        datasec = "datasec{0:02d}".format(i+1)
-        x0, x1 = settings.spect[dnum][datasec][0][0], settings.spect[dnum][datasec][0][1]
-        y0, y1 = settings.spect[dnum][datasec][1][0], settings.spect[dnum][datasec][1][1]
-        if x0 < 0:
-            x0 += frame.shape[0]
-        if x1 <= 0:
-            x1 += frame.shape[0]
-        if y0 < 0:
-            y0 += frame.shape[1]
-        if y1 <= 0:
-            y1 += frame.shape[1]
+        x0, x1, y0, y1 = datasec_range(shape, det, i+1)
         if i == 0:
             xv = np.arange(x0, x1)
             yv = np.arange(y0, y1)
         else:
             xv = np.unique(np.append(xv, np.arange(x0, x1)))
             yv = np.unique(np.append(yv, np.arange(y0, y1)))
+    return xv, yv
+
+
+def preprocess_frame(frame, det, msbias=None, trim=True, gain=False, oscan=None, rows=None, out=None,
+                     dtype=np.float64):
+    """
+    Bias subtract, trim and gain correct a raw frame in a single pass per amplifier
+
+    The data section of each amplifier is converted to dtype, has the
+    bias level (a master bias frame, or the model of the overscan region)
+    subtracted and the gain applied, in blocks of rows that fit in the
+    cache, and is written straight into its place in the trimmed frame.
+    Each pixel of the raw frame is therefore only read once.
+
+    Parameters
+    ----------
+    frame : ndarray (2 dimensional)
+      The raw frame in its native type, with the dispersion direction along
+      the first axis (e.g. a transposed view of the raw data), or an object
+      that can be sliced in the same way (e.g. arload.CompressedSection)
+    det : int
+      Detector Index
+    msbias : ndarray or str, optional
+      Master bias frame, or 'overscan' to subtract the overscan region
+    trim : bool, optional
+      Trim the frame to the data sections (only when msbias is not None)
+    gain : bool, optional
+      Multiply the data section of each amplifier by its gain
+    oscan : list, optional
+      Model of the overscan regions (see overscan_model). This is
+      calculated from the frame if msbias is 'overscan' and oscan is None.
+    rows : tuple, optional
+      (x0, x1) Only return the rows x0:x1 of the output frame
+    out : ndarray, optional
+      Array in which the output frame is stored
+    dtype : numpy type, optional
+      Type of the output frame
+
+    Returns
+    -------
+    out : ndarray (2 dimensional)
+      The processed frame
+    """
+    dnum = settings.get_dnum(det)
+    if type(msbias) is np.ndarray:
+        if msbias.shape != frame.shape:
+            msgs.error("The master bias frame does not have the same shape as the raw frame")
+    elif msbias is not None:
+        if msbias != "overscan":
+            msgs.error("Could not subtract the bias level with {0:s}".format(msbias))
+        if oscan is None:
+            oscan = overscan_model(frame, det)
+    # Rows and columns of the raw frame retained in the output frame
+    if msbias is not None and trim:
+        xv, yv = trim_indices(frame.shape, det)
+    else:
+        xv, yv = np.arange(frame.shape[0]), np.arange(frame.shape[1])
+    x0, x1 = (0, xv.size) if rows is None else rows
+    if out is None:
+        out = np.empty((x1-x0, yv.size), dtype=dtype)
+    # Number of rows processed at a time (~256kB of output)
+    nchunk = max(1, 2**18 // (out.itemsize*yv.size))
+    npix = 0
+    for i in range(settings.spect[dnum]['numamplifiers']):
+        dx0, dx1, dy0, dy1 = datasec_range(frame.shape, det, i+1)
+        # Position of the data section in the output frame, restricted to the requested rows
+        px0 = np.searchsorted(xv, dx0)
+        py0 = np.searchsorted(yv, dy0)
+        r0, r1 = max(px0, x0), min(px0+dx1-dx0, x1)
+        if r1 <= r0:
+            continue
+        rx0, rx1 = dx0+r0-px0, dx0+r1-px0
+        outsec = out[r0-x0:r1-x0, py0:py0+dy1-dy0]
+        rawsec = frame[rx0:rx1, dy0:dy1]
+        # Bias level
+        if type(msbias) is np.ndarray:
+            level = msbias[rx0:rx1, dy0:dy1]
+        elif oscan is not None:
+            level = oscan[i][2]
+            if np.size(level) > 1 and level.shape[0] == dx1-dx0:
+                level = level[rx0-dx0:rx1-dx0]
+        else:
+            level = None
+        ctype = out.dtype if level is None else np.result_type(out.dtype, level)
+        for c0 in range(0, r1-r0, nchunk):
+            c1 = min(c0+nchunk, r1-r0)
+            if level is None:
+                np.copyto(outsec[c0:c1], rawsec[c0:c1], casting='unsafe')
+            elif np.ndim(level) == 2 and level.shape[0] == r1-r0:
+                np.subtract(rawsec[c0:c1], level[c0:c1], out=outsec[c0:c1], dtype=ctype, casting='unsafe')
+            else:
+                np.subtract(rawsec[c0:c1], level, out=outsec[c0:c1], dtype=ctype, casting='unsafe')
+            if gain:
+                outsec[c0:c1] *= settings.spect[dnum]['gain'][i]
+        npix += outsec.size
+    if npix != out.size:
+        # Some pixels of the output frame are not in a data section
+        covered = np.zeros(out.shape, dtype=np.bool_)
+        for i in range(settings.spect[dnum]['numamplifiers']):
+            dx0, dx1, dy0, dy1 = datasec_range(frame.shape, det, i+1)
+            covered[np.ix_((xv[x0:x1] >= dx0) & (xv[x0:x1] < dx1), (yv >= dy0) & (yv < dy1))] = True
+        ww = np.where(~covered)
+        w = np.ix_(xv[x0:x1], yv)
+        if gain:
+            # As gain_frame(), these pixels are set to zero
+            out[ww] = 0.0
+        elif type(msbias) is np.ndarray:
+            out[ww] = frame[w][ww] - msbias[w][ww]
+        else:
+            out[ww] = frame[w][ww]
+    return out
+
+
+def trim(frame, det):
     # Construct and array with the rows and columns to be extracted
+    xv, yv = trim_indices(frame.shape, det)
     w = np.ix_(xv, yv)
 #	if len(file.shape) == 2:
 #		trimfile = file[w]
@@ -2,6 +2,7 @@
 """
 from __future__ import (print_function, absolute_import, division,
                         unicode_literals)
+import json
 import numpy as np
 import os
 
@@ -302,6 +303,70 @@ def save_tilts(slf, fname):
     return
 
 
+def save_master_bundle(slf, masters, filename):
+    """ Write master frames to a single HDF5 file
+
+    Each master frame is a group of the file (named by its frame type),
+    holding the frame and its extensions as chunked, compressed datasets
+    ('0', '1', ...), and its header keywords as attributes. A section of a
+    frame can then be read without reading the rest of the file (see
+    arload.load_master). The master frames that are already in the file,
+    and are not being written, are kept.
+
+    The file is first written to a temporary file in the same directory,
+    which then replaces the original file. Other jobs that read the
+    master frames therefore never see a partly written file.
+
+    Parameters
+    ----------
+    slf : class
+      Science Exposure class
+    masters : list of dict
+      The master frames to write. Each dict has the keys ftype and
+      either data (with optional frametype, extensions, names, keywds
+      and ind, as for save_master) or json (a JSON string)
+    filename : str
+    """
+    tmpname = "{0:s}.{1:d}.tmp".format(filename, os.getpid())
+    ftypes = [master['ftype'] for master in masters]
+    msgs.info("Saving master frames ({0:s}) as:".format(', '.join(ftypes))+msgs.newline()+filename)
+    with h5py.File(tmpname, 'w') as hdf:
+        if os.path.exists(filename):
+            with h5py.File(filename, 'r') as old:
+                for key in old.keys():
+                    if key not in ftypes:
+                        old.copy(key, hdf)
+        for master in masters:
+            grp = hdf.create_group(master['ftype'])
+            if 'json' in master:
+                grp.create_dataset('json', data=np.bytes_(master['json'].encode('utf-8')))
+                continue
+            images = [master['data']]
+            if master.get('extensions', None) is not None:
+                images += master['extensions']
+            for kk, image in enumerate(images):
+                if image is None:
+                    continue
+                image = np.asarray(image)
+                if image.ndim == 0:
+                    grp.create_dataset(str(kk), data=image)
+                else:
+                    grp.create_dataset(str(kk), data=image, chunks=True, compression='gzip', shuffle=True)
+            if master.get('names', None) is not None:
+                grp.attrs['names'] = json.dumps(master['names'])
+            # Header
+            grp.attrs['FRAMETYP'] = master.get('frametype', master['ftype'])
+            for i, idx in enumerate(master.get('ind', [])):
+                grp.attrs["FRAME{0:03d}".format(i+1)] = slf._fitsdict['filename'][idx]
+            keywds = master.get('keywds', None)
+            if keywds is not None:
+                for key in keywds.keys():
+                    grp.attrs[key] = keywds[key]
+    # Atomic on POSIX
+    os.rename(tmpname, filename)
+    msgs.info("Master frames saved successfully:"+msgs.newline()+filename)
+
+
 def save_1d_spectra_hdf5(slf, fitsdict, clobber=True):
     """ Write 1D spectra to an HDF5 file
 
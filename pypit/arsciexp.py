@@ -30,7 +30,7 @@ class ScienceExposure:
     A Science Exposure class that carries all information for a given science exposure
     """
 
-    def __init__(self, snum, fitsdict, do_qa=True):
+    def __init__(self, snum, fitsdict, do_qa=True, store=None):
 
         # Set indices used for frame combination
         self._idx_sci = settings.spect['science']['index'][snum]
@@ -48,6 +48,9 @@ class ScienceExposure:
         elif settings.argflag['reduce']['slitcen']['useframe'] == 'pinhole': self._idx_cent = settings.spect['pinhole']['index'][snum]
         else: self._idx_cent = []
         self.sc = snum
+        self._fitsdict = fitsdict
+        # Master frames shared with the other science exposures
+        self._store = store
 
         # Set the base name and extract other names that will be used for output files
         #  Also parses the time input
@@ -82,14 +85,14 @@ class ScienceExposure:
         self._resnarr  = [None for all in range(ndet)]   # Resolution array
         # Initialize the Master Calibration frames
         self._bpix = [None for all in range(ndet)]          # Bad Pixel Mask
-        self._msarc = [None for all in range(ndet)]         # Master Arc
-        self._mswave = [None for all in range(ndet)]         # Master Wavelength image
-        self._msbias = [None for all in range(ndet)]        # Master Bias
+        self._msarc = armasters.MasterSlots([None for all in range(ndet)])         # Master Arc
+        self._mswave = armasters.MasterSlots([None for all in range(ndet)])         # Master Wavelength image
+        self._msbias = armasters.MasterSlots([None for all in range(ndet)])        # Master Bias
         self._msrn = [None for all in range(ndet)]          # Master ReadNoise image
-        self._mstrace = [None for all in range(ndet)]       # Master Trace
-        self._mspinhole = [None for all in range(ndet)]       # Master Pinhole
-        self._mspixelflat = [None for all in range(ndet)]     # Master Pixel Flat
-        self._mspixelflatnrm = [None for all in range(ndet)]  # Normalized Master pixel flat
+        self._mstrace = armasters.MasterSlots([None for all in range(ndet)])       # Master Trace
+        self._mspinhole = armasters.MasterSlots([None for all in range(ndet)])       # Master Pinhole
+        self._mspixelflat = armasters.MasterSlots([None for all in range(ndet)])     # Master Pixel Flat
+        self._mspixelflatnrm = armasters.MasterSlots([None for all in range(ndet)])  # Normalized Master pixel flat
         self._msblaze = [None for all in range(ndet)]       # Blaze function
         self._msstd = [{} for all in range(ndet)]           # Master Standard dict
         # Initialize the Master Calibration frame names
@@ -249,18 +252,14 @@ class ScienceExposure:
         """
         dnum = settings.get_dnum(det)
 
-        if self._msarc[det-1] is not None:
+        if self._msarc[det-1] is not None or self.FindMasterFrame("arc", det):
             msgs.info("An identical master arc frame already exists")
             return False
         if settings.argflag['arc']['useframe'] in ['arc']:
             # Attempt to load the Master Frame
             if settings.argflag['reduce']['masters']['reuse']:
-                msarc_name = armasters.master_name('arc', settings.argflag['reduce']['masters']['setup'])
-                try:
-                    msarc, head = arload.load_master(msarc_name, frametype="arc")
-                except IOError:
-                    msgs.warn("No MasterArc frame found {:s}".format(msarc_name))
-                else:
+                head = self.LoadMasterFrame("arc", det)
+                if head is not None:
                     self._transpose = head['transp']
                     if self._transpose:  # Need to setup for flipping
                         settings.argflag['trace']['dispersion']['direction'] = 1
@@ -268,11 +267,13 @@ class ScienceExposure:
                         settings.argflag['trace']['dispersion']['direction'] = 0
                     # Append as loaded
                     settings.argflag['reduce']['masters']['loaded'].append('arc'+settings.argflag['reduce']['masters']['setup'])
+                    return True
             if 'arc'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
                 msgs.info("Preparing a master arc frame")
                 ind = self._idx_arcs
                 # Load the arc frames
-                frames = arload.load_frames(fitsdict, ind, det, frametype='arc', msbias=self._msbias[det-1])
+                frames = arload.load_frames(fitsdict, ind, det, frametype='arc', msbias=self._msbias[det-1],
+                                            memmap=settings.argflag['arc']['combine']['match'] <= 0.0)
                 if settings.argflag['arc']['combine']['match'] > 0.0:
                     sframes = arsort.match_frames(frames, settings.argflag['arc']['combine']['match'], frametype='arc',
                                                   satlevel=settings.spect[dnum]['saturation']*settings.spect[dnum]['nonlinear'])
@@ -324,27 +325,26 @@ class ScienceExposure:
         """
 
         # If the master bias is already made, use it
-        if self._msbias[det-1] is not None:
+        if self._msbias[det-1] is not None or (settings.argflag['bias']['useframe'] in ['bias', 'dark'] and
+                                               self.FindMasterFrame("bias", det)):
             msgs.info("An identical master {0:s} frame already exists".format(settings.argflag['bias']['useframe']))
             return False
         elif settings.argflag['bias']['useframe'] in ['bias', 'dark']:
             # Load from hard-drive?
             if settings.argflag['reduce']['masters']['reuse']:
                 # Attempt to load the Master Frame
-                msbias_name = armasters.master_name('bias', settings.argflag['reduce']['masters']['setup'])
-                try:
-                    msbias, head = arload.load_master(msbias_name, frametype="bias")
-                except IOError:
-                    msgs.warn("No MasterBias frame found {:s}".format(msbias_name))
-                else:
+                if self.LoadMasterFrame("bias", det) is not None:
                     settings.argflag['reduce']['masters']['loaded'].append('bias'+settings.argflag['reduce']['masters']['setup'])
+                    return True
             if 'bias'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
                 msgs.info("Preparing a master {0:s} frame".format(settings.argflag['bias']['useframe']))
                 # Get all of the bias frames for this science frame
                 ind = self._idx_bias
                 # Load the Bias/Dark frames
-                frames = arload.load_frames(fitsdict, ind, det, frametype=settings.argflag['bias']['useframe'])
-                msbias = arcomb.comb_frames(frames, det, 'bias', printtype=settings.argflag['bias']['useframe'])
+                frames = arload.load_frames(fitsdict, ind, det, frametype=settings.argflag['bias']['useframe'],
+                                            memmap=True)
+                msbias = arcomb.comb_frames(frames, det, 'bias', printtype=settings.argflag['bias']['useframe'],
+                                            dtype=arload.frame_dtype('bias'))
                 del frames
         elif settings.argflag['bias']['useframe'] == 'overscan':
             self.SetMasterFrame('overscan', "bias", det, mkcopy=False)
@@ -416,7 +416,7 @@ class ScienceExposure:
 
         if settings.argflag['reduce']['flatfield']['perform']:  # Only do it if the user wants to flat field
             # If the master pixelflat is already made, use it
-            if self._mspixelflat[det-1] is not None:
+            if self._mspixelflat[det-1] is not None or self.FindMasterFrame("pixelflat", det):
                 msgs.info("An identical master pixelflat frame already exists")
                 if self._mspixelflatnrm[det-1] is None:
                     # Normalize the flat field
@@ -447,21 +447,19 @@ class ScienceExposure:
             if settings.argflag['reduce']['flatfield']['useframe'] in ['pixelflat', 'trace']:
                 if settings.argflag['reduce']['masters']['reuse']:
                     # Attempt to load the Master Frame
-                    msflat_name = armasters.master_name('normpixelflat', settings.argflag['reduce']['masters']['setup'])
-                    try:
-                        mspixelflatnrm, head = arload.load_master(msflat_name, frametype="normpixelflat")
-                    except IOError:
-                        msgs.warn("No MasterFlatField frame found {:s}".format(msflat_name))
-                    else:
+                    if self.LoadMasterFrame("normpixelflat", det) is not None:
                         settings.argflag['reduce']['masters']['loaded'].append('normpixelflat'+settings.argflag['reduce']['masters']['setup'])
-                        mspixelflat = mspixelflatnrm
+                        # The normalized flat field also stands in for the pixel flat
+                        self._mspixelflat[det-1] = self._mspixelflatnrm.ref(det-1)
+                        return True
                 if 'normpixelflat'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
                     msgs.info("Preparing a master pixel flat frame with {0:s}".format(settings.argflag['reduce']['flatfield']['useframe']))
                     # Get all of the pixel flat frames for this science frame
                     ind = self._idx_flat
                     # Load the frames for tracing
                     frames = arload.load_frames(fitsdict, ind, det, frametype='pixel flat',
-                                                msbias=self._msbias[det-1])
+                                                msbias=self._msbias[det-1],
+                                                memmap=settings.argflag['pixelflat']['combine']['match'] <= 0.0)
                     if settings.argflag['pixelflat']['combine']['match'] > 0.0:
                         sframes = arsort.match_frames(frames, settings.argflag['pixelflat']['combine']['match'],
                                                       frametype='pixel flat', satlevel=self._nonlinear)
@@ -535,20 +533,16 @@ class ScienceExposure:
         """
         dnum = settings.get_dnum(det)
         # If the master pinhole is already made, use it
-        if self._mspinhole[det - 1] is not None:
+        if self._mspinhole[det - 1] is not None or self.FindMasterFrame("pinhole", det):
             msgs.info("An identical master pinhole frame already exists")
             return False
         if settings.argflag['reduce']['slitcen']['useframe'] in ['trace', 'pinhole']:
             if settings.argflag['reduce']['masters']['reuse']:
                 # Attempt to load the Master Frame
-                mspinhole_name = armasters.master_name('pinhole', settings.argflag['reduce']['masters']['setup'])
-                try:
-                    mspinhole, head = arload.load_master(mspinhole_name, frametype="pinhole")
-                except IOError:
-                    msgs.warn("No MasterPinhole frame found {:s}".format(mspinhole_name))
-                else:
+                if self.LoadMasterFrame("pinhole", det) is not None:
                     settings.argflag['reduce']['masters']['loaded'].append(
                         'pinhole' + settings.argflag['reduce']['masters']['setup'])
+                    return True
             if 'pinhole' + settings.argflag['reduce']['masters']['setup'] not in \
                     settings.argflag['reduce']['masters']['loaded']:
                 msgs.info("Preparing a master pinhole frame with {0:s}".format(
@@ -556,7 +550,8 @@ class ScienceExposure:
                 ind = self._idx_cent
                 # Load the pinhole frames
                 frames = arload.load_frames(fitsdict, ind, det, frametype='pinhole', msbias=self._msbias[det - 1],
-                                            trim=settings.argflag['reduce']['trim'])
+                                            trim=settings.argflag['reduce']['trim'],
+                                            memmap=settings.argflag['pinhole']['combine']['match'] <= 0.0)
                 if settings.argflag['pinhole']['combine']['match'] > 0.0:
                     sframes = arsort.match_frames(frames, settings.argflag['pinhole']['combine']['match'],
                                                   frametype='pinhole', satlevel=settings.spect[dnum]['saturation'] *
@@ -602,18 +597,14 @@ class ScienceExposure:
         """
         dnum = settings.get_dnum(det)
         # If the master trace is already made, use it
-        if self._mstrace[det-1] is not None:
+        if self._mstrace[det-1] is not None or self.FindMasterFrame("trace", det):
             msgs.info("An identical master trace frame already exists")
             return False
         if settings.argflag['reduce']['trace']['useframe'] in ['trace']:
             if settings.argflag['reduce']['masters']['reuse']:
                 # Attempt to load the Master Frame
                 mstrace_name = armasters.master_name('trace', settings.argflag['reduce']['masters']['setup'])
-                try:
-                    mstrace, head = arload.load_master(mstrace_name, frametype="trace")
-                except IOError:
-                    msgs.warn("No MasterTrace frame found {:s}".format(mstrace_name))
-                else:
+                if self.LoadMasterFrame("trace", det, name=mstrace_name) is not None:
                     # Extras
                     lordloc, _ = arload.load_master(mstrace_name, frametype="trace", exten=1)
                     rordloc, _ = arload.load_master(mstrace_name, frametype="trace", exten=2)
@@ -631,12 +622,14 @@ class ScienceExposure:
                     self.SetFrame(self._slitpix, slitpix.astype(np.int), det)
                     #
                     settings.argflag['reduce']['masters']['loaded'].append('trace'+settings.argflag['reduce']['masters']['setup'])
+                    return True
             if 'trace'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
                 msgs.info("Preparing a master trace frame with {0:s}".format(settings.argflag['reduce']['trace']['useframe']))
                 ind = self._idx_trace
                 # Load the frames for tracing
                 frames = arload.load_frames(fitsdict, ind, det, frametype='trace', msbias=self._msbias[det-1],
-                                            trim=settings.argflag['reduce']['trim'])
+                                            trim=settings.argflag['reduce']['trim'],
+                                            memmap=settings.argflag['trace']['combine']['match'] <= 0.0)
                 if settings.argflag['trace']['combine']['match'] > 0.0:
                     sframes = arsort.match_frames(frames, settings.argflag['trace']['combine']['match'], frametype='trace', satlevel=settings.spect[dnum]['saturation']*settings.spect['det'][det-1]['nonlinear'])
                     subframes = np.zeros((frames.shape[0], frames.shape[1], len(sframes)))
@@ -677,18 +670,14 @@ class ScienceExposure:
         boolean : bool
           Should other ScienceExposure classes be updated?
         """
-        if self._mswave[det-1] is not None:
-            msgs.info("An identical master arc frame already exists")
+        if self._mswave[det-1] is not None or self.FindMasterFrame("wave", det):
+            msgs.info("An identical master wave frame already exists")
             return False
         # Attempt to load the Master Frame
         if settings.argflag['reduce']['masters']['reuse']:
-            mswave_name = armasters.master_name('wave', settings.argflag['reduce']['masters']['setup'])
-            try:
-                mswave, head = arload.load_master(mswave_name, frametype="arc")
-            except IOError:
-                msgs.warn("No MasterWave frame found {:s}".format(mswave_name))
-            else:
+            if self.LoadMasterFrame("wave", det) is not None:
                 settings.argflag['reduce']['masters']['loaded'].append('wave'+settings.argflag['reduce']['masters']['setup'])
+                return True
         if 'wave'+settings.argflag['reduce']['masters']['setup'] not in settings.argflag['reduce']['masters']['loaded']:
             msgs.info("Preparing a master wave frame")
             if settings.argflag["reduce"]["calibrate"]["wavelength"] == "pixel":
@@ -733,7 +722,11 @@ class ScienceExposure:
             except (IOError, ValueError):
                 msgs.warn("No MasterWave1D data found {:s}".format(mswv_calib_name))
             else:
-                settings.argflag['reduce']['masters']['loaded'].append('wave_calib'+settings.argflag['reduce']['masters']['setup'])
+                head = wv_calib.pop('provenance', {})
+                if armasters.master_uptodate(self, 'wave_calib', det, head):
+                    settings.argflag['reduce']['masters']['loaded'].append('wave_calib'+settings.argflag['reduce']['masters']['setup'])
+                else:
+                    wv_calib = None
         if settings.argflag["reduce"]["calibrate"]["wavelength"] == "pixel":
             msgs.info("A wavelength calibration will not be performed")
         else:
@@ -787,7 +780,7 @@ class ScienceExposure:
             # Load the frame(s)
 #            set_trace()
             frame = arload.load_frames(fitsdict, ind, det, frametype='standard',
-                                       msbias=self._msbias[det-1])
+                                       msbias=self._msbias[det-1], gain=True)
 #            msgs.warn("Taking only the first standard frame for now")
 #            ind = ind[0]
             sciframe = frame[:, :, 0]
@@ -855,7 +848,10 @@ class ScienceExposure:
           frame type
         det : int
           Detector index
-        mkcopy
+        mkcopy : bool
+          Set a copy of the frame. Without a copy, the frame may be shared
+          (as a read-only view) with the master store, so it should not be
+          modified afterwards.
 
         Returns
         -------
@@ -867,6 +863,12 @@ class ScienceExposure:
             cpf = frame.copy()
         else:
             cpf = frame
+        if ftype in ["bias", "normpixelflat"] and isinstance(cpf, np.ndarray):
+            # These master frames are stored in the precision of the calibration frames
+            cpf = cpf.astype(arload.frame_dtype(ftype), copy=False)
+        if self._store is not None and ftype in armasters.master_inputs and isinstance(cpf, np.ndarray):
+            # Hold a reference to the (read-only) frame in the master store
+            cpf = self._store.put(armasters.master_key(self, ftype, det+1), cpf)
         # Set the frame
         if ftype == "arc": self._msarc[det] = cpf
         elif ftype == "wave": self._mswave[det] = cpf
@@ -883,6 +885,69 @@ class ScienceExposure:
             msgs.error("Please contact the authors")
         return
 
+    def FindMasterFrame(self, ftype, det):
+        """ Use an identical master frame that has already been
+        built for another science exposure, if there is one
+
+        Parameters
+        ----------
+        ftype : str
+          frame type
+        det : int
+          Detector index
+
+        Returns
+        -------
+        found : bool
+          Was an identical master frame found?
+        """
+        if self._store is None:
+            return False
+        key = armasters.master_key(self, ftype, det)
+        if key not in self._store:
+            return False
+        self.SetMasterFrame(self._store.get(key), ftype, det, mkcopy=False)
+        return True
+
+    def LoadMasterFrame(self, ftype, det, name=None):
+        """ Use a master frame from the MasterFrames directory,
+        if it is up to date (see armasters.master_uptodate)
+
+        Only the header is read here. With a master store, the frame is
+        read when it is first used, and is released from memory (and read
+        again when needed) when the store is full.
+
+        Parameters
+        ----------
+        ftype : str
+          frame type
+        det : int
+          Detector index
+        name : str, optional
+          Name of the master frame file
+
+        Returns
+        -------
+        head : Header or None
+          Header of the master frame, or None if there is no up to date master frame
+        """
+        if name is None:
+            name = armasters.master_name(ftype, settings.argflag['reduce']['masters']['setup'])
+        try:
+            head = arload.load_master_header(name, frametype=ftype)
+        except IOError:
+            msgs.warn("No master {0:s} frame found {1:s}".format(ftype, name))
+            return None
+        if not armasters.master_uptodate(self, ftype, det, head):
+            return None
+        loader = armasters.master_loader(name, ftype)
+        if self._store is None:
+            self.SetMasterFrame(loader(), ftype, det, mkcopy=False)
+        else:
+            self.SetMasterFrame(self._store.register(armasters.master_key(self, ftype, det), loader),
+                                ftype, det, mkcopy=False)
+        return head
+
     # Getters
     @staticmethod
     def GetFrame(getarray, det, mkcopy=True):
@@ -11,7 +11,7 @@ import yaml
 from pypit import armsgs
 from pypit import arparse as settings
 from pypit import arutils
-from pypit.arflux import find_standard_file
+from pypit.arflux import find_standard_files
 from astropy.io.votable.tree import VOTableFile, Resource, Table, Field
 from astropy.table import Table as tTable, Column
 from astropy import units as u
@@ -32,7 +32,7 @@ except NameError: pass
 msgs = armsgs.get_logger()
 
 
-def sort_data(fitsdict, flag_unknown=False):
+def sort_data(fitsdict, flag_unknown=False, standards=None):
     """ Generate a dict of filetypes from the input fitsdict object
 
     Parameters
@@ -42,6 +42,10 @@ def sort_data(fitsdict, flag_unknown=False):
     flag_unknown : bool, optional
       Instead of crashing out if there are unidentified files,
       set to 'unknown' and continue
+    standards : dict, optional
+      Whether each raw file (given by its path) is near an archived
+      standard star (see arflux.find_standard_file). Only the files that are
+      not in this dict are checked, and they are added to it.
 
     Returns
     -------
@@ -61,9 +65,13 @@ def sort_data(fitsdict, flag_unknown=False):
                 trace=np.array([], dtype=np.int),
                 unknown=np.array([], dtype=np.int),
                 arc=np.array([], dtype=np.int))
+    # Indices of the files with each file name
+    fileidx = dict({})
+    for i, fname in enumerate(fitsdict['filename']):
+        fileidx.setdefault(fname, []).append(i)
     if len(settings.ftdict) > 0:
         for ifile,ftypes in settings.ftdict.items():
-            idx = np.where(fitsdict['filename'] == ifile)[0]
+            idx = np.array(fileidx.get(ifile, []), dtype=np.int)
             sptypes = ftypes.split(',')
             for iftype in sptypes:
                 ftag[iftype] = np.concatenate([ftag[iftype], idx])
@@ -79,36 +87,8 @@ def sort_data(fitsdict, flag_unknown=False):
     for i in range(len(fkey)):
         if fkey[i] == 'unknown':
             continue
-        # Self identification
-        if settings.argflag['run']['useIDname']:
-            w = np.where(fitsdict['idname'] == settings.spect[fkey[i]]['idname'])[0]
-        else:
-            w = np.arange(numfiles)
-        n = np.arange(numfiles)
-        n = np.intersect1d(n, w)
-        # Perform additional checks in order to make sure this identification is true
-        if 'check' in settings.spect[fkey[i]].keys():
-            chkk = settings.spect[fkey[i]]['check'].keys()
-            for ch in chkk:
-                if ch[0:9] == 'condition':
-                    # Deal with a conditional argument
-                    conds = re.split("(\||\&)", settings.spect[fkey[i]]['check'][ch])
-                    ntmp = chk_condition(fitsdict, conds[0])
-                    # And more
-                    for cn in range((len(conds)-1)//2):
-                        if conds[2*cn+1] == "|":
-                            ntmp = ntmp | chk_condition(fitsdict, conds[2*cn+2])
-                        elif conds[2*cn+1] == "&":
-                            ntmp = ntmp & chk_condition(fitsdict, conds[2*cn+2])
-                    w = np.where(ntmp)[0]
-                else:
-                    if fitsdict[ch].dtype.char == 'S':  # Numpy string array
-                        # Strip numpy string array of all whitespace
-                        w = np.where(np.char.strip(fitsdict[ch]) == settings.spect[fkey[i]]['check'][ch])[0]
-                    else:
-                        w = np.where(fitsdict[ch] == settings.spect[fkey[i]]['check'][ch])[0]
-                n = np.intersect1d(n, w)
         # Assign these filetypes
+        n = frametype_mask(fitsdict, fkey[i])
         filarr[i, :][n] = 1
         # Check if these files can also be another type
         if settings.spect[fkey[i]]['canbe'] is not None:
@@ -140,26 +120,36 @@ def sort_data(fitsdict, flag_unknown=False):
     # Identify the standard stars
     # Find the nearest standard star to each science frame
     wscistd = np.where(filarr[np.where(fkey == 'standard')[0], :].flatten() == 1)[0]
+    foundstd = dict({})
     for i in range(wscistd.size):
-        radec = (fitsdict['ra'][wscistd[i]], fitsdict['dec'][wscistd[i]])
         if fitsdict['ra'][wscistd[i]] == 'None':
             msgs.warn("No RA and DEC information for file:" + msgs.newline() + fitsdict['filename'][wscistd[i]])
             msgs.warn("The above file could be a twilight flat frame that was" + msgs.newline() +
                       "missed by the automatic identification.")
-            filarr[np.where(fkey == 'standard')[0], wscistd[i]] = 0
+            foundstd[wscistd[i]] = None
             continue
-        # If an object exists within 20 arcmins of a listed standard, then it is probably a standard star
-        foundstd = find_standard_file(radec, toler=20.*u.arcmin, check=True)
-        if foundstd:
-            filarr[np.where(fkey == 'science')[0], wscistd[i]] = 0
+        path = fitsdict['directory'][wscistd[i]]+fitsdict['filename'][wscistd[i]]
+        if standards is not None and path in standards:
+            foundstd[wscistd[i]] = standards[path]
+    # If an object exists within 20 arcmins of a listed standard, then it is probably a standard star
+    wcheck = [idx for idx in wscistd if idx not in foundstd]
+    found = find_standard_files([(fitsdict['ra'][idx], fitsdict['dec'][idx]) for idx in wcheck],
+                                toler=20.*u.arcmin, check=True)
+    for idx, fstd in zip(wcheck, found):
+        foundstd[idx] = fstd
+        if standards is not None:
+            standards[fitsdict['directory'][idx]+fitsdict['filename'][idx]] = fstd
+    for idx in wscistd:
+        if foundstd[idx]:
+            filarr[np.where(fkey == 'science')[0], idx] = 0
         else:
-            filarr[np.where(fkey == 'standard')[0], wscistd[i]] = 0
+            filarr[np.where(fkey == 'standard')[0], idx] = 0
     # Make any forced changes
     msgs.info("Making forced file identification changes")
     skeys = settings.spect['set'].keys()
     for sk in skeys:
         for j in settings.spect['set'][sk]:
-            w = np.where(fitsdict['filename']==j)[0]
+            w = fileidx.get(j, [])
             filarr[:,w]=0
             setarr[np.where(fkey==sk)[0],w]=1
             del w
@@ -194,6 +184,190 @@ def sort_data(fitsdict, flag_unknown=False):
     return ftag
 
 
+# Version of the format of the sorting cache
+_sort_cache_version = 1
+
+# The settings (paths into argflag) that determine how the files are sorted,
+# matched to the science frames, and grouped into setups
+_sort_settings = ['run.spectrograph', 'run.setup', 'run.calcheck', 'run.useIDname', 'setup', 'bias.useframe',
+                  'reduce.badpix', 'reduce.flatfield', 'reduce.calibrate']
+
+
+def sort_cache_file():
+    """ The name of the persistent sorting cache of this reduction
+
+    Returns
+    -------
+    cache_file : str or None
+      None if 'run sortcache' is False, or there is no reduction file name
+    """
+    if not settings.argflag['run']['sortcache']:
+        return None
+    redname = settings.argflag['run'].get('redname')
+    if not isinstance(redname, basestring):
+        return None
+    return redname.replace('.pypit', '') + '.scache'
+
+
+def sort_cache_hash():
+    """ A hash of the settings that determine the sorting of the files,
+    their matching to the science frames, and the setups
+
+    The spectrograph settings are hashed as they were loaded, since some
+    of them (e.g. the data sections) are updated during a reduction.
+
+    Returns
+    -------
+    hash : str
+    """
+    from pypit import pyputils
+    spect = dict([(key, dict([(k, v) for k, v in value.items() if k != 'index']) if isinstance(value, dict) else value)
+                  for key, value in settings.spect_loaded.thaw().items()])
+    pars = dict(spect=spect, ftdict=settings.ftdict, version=pyputils.get_version()[0])
+    for path in _sort_settings:
+        value = settings.argflag
+        for key in path.split('.'):
+            # Not all of the settings are always set (e.g. setup name)
+            value = value.get(key) if isinstance(value, dict) else None
+        pars[path] = value
+    return settings.FrozenSettings(pars).key
+
+
+def sort_cache_files(fitsdict):
+    """ Identify the raw files by their path, size and modification time
+
+    Parameters
+    ----------
+    fitsdict : dict
+      Contains relevant information from fits header files
+
+    Returns
+    -------
+    files : list of tuple
+    """
+    files = []
+    for directory, filename in zip(fitsdict['directory'], fitsdict['filename']):
+        path = directory + filename
+        try:
+            stat = os.stat(path)
+        except OSError:
+            files.append((path, None, None))
+        else:
+            files.append((path, stat.st_size, stat.st_mtime))
+    return files
+
+
+def load_sort_cache(cache_file, fitsdict):
+    """ Load the persistent sorting cache
+
+    The cache holds the sorted files, the indices of the calibration
+    frames matched to each science frame, and the setup dict, and also
+    whether each raw file is near an archived standard star.
+
+    Parameters
+    ----------
+    cache_file : str or None
+    fitsdict : dict
+      Contains relevant information from fits header files
+
+    Returns
+    -------
+    cache : dict or None
+      'standards' holds the standard star checks of the files that are
+      unchanged. 'filesort', 'index' and 'setup_dict' are only set if
+      the raw files and the settings are unchanged.
+      None if there is no (readable) cache for this version of the cache.
+    """
+    import pickle
+    if cache_file is None or not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+    except Exception:
+        msgs.warn("Could not read the sorting cache {0:s}".format(cache_file))
+        return None
+    if cache.get('cache_version') != _sort_cache_version:
+        return None
+    files = sort_cache_files(fitsdict)
+    # Keep the standard star checks of the files that are unchanged
+    stats = dict([(path, (size, mtime)) for path, size, mtime in cache['files']])
+    current = dict([(path, (size, mtime)) for path, size, mtime in files])
+    standards = dict([(path, found) for path, found in cache['standards'].items()
+                      if path in current and current[path] == stats.get(path)])
+    if files != cache['files'] or cache['hash'] != sort_cache_hash():
+        msgs.info("The sorting cache {0:s} is out of date -- the files will be sorted again".format(cache_file))
+        return dict(standards=standards)
+    msgs.info("Loaded the sorting cache {0:s}".format(cache_file))
+    cache['standards'] = standards
+    return cache
+
+
+def save_sort_cache(cache_file, fitsdict, filesort, setup_dict, standards):
+    """ Save the persistent sorting cache (see load_sort_cache)
+
+    Parameters
+    ----------
+    cache_file : str
+    fitsdict : dict
+      Contains relevant information from fits header files
+    filesort : dict
+      Details of the sorted files
+    setup_dict : dict
+    standards : dict
+      Whether each raw file is near an archived standard star
+    """
+    import pickle
+    index = dict([(key, settings.spect[key]['index']) for key in filesort.keys()
+                  if key in settings.spect and 'index' in settings.spect[key]])
+    cache = dict(cache_version=_sort_cache_version, hash=sort_cache_hash(), files=sort_cache_files(fitsdict),
+                 standards=standards, filesort=filesort, index=index, setup_dict=setup_dict)
+    tmpname = cache_file + '.tmp'
+    try:
+        with open(tmpname, 'wb') as f:
+            pickle.dump(cache, f, protocol=2)
+        os.rename(tmpname, cache_file)
+    except (IOError, OSError):
+        msgs.warn("Could not save the sorting cache {0:s}".format(cache_file))
+        if os.path.isfile(tmpname):
+            os.remove(tmpname)
+        return
+    msgs.info("Saved the sorting cache {0:s}".format(cache_file))
+    return
+
+
+# The conditions of the settings files, parsed into their keyword, operator and value
+_conditions = {}
+
+
+def parse_condition(cond):
+    """ Parse a condition used to identify filetypes (see chk_condition)
+
+    The parsed conditions are kept, so that each condition is only
+    parsed once.
+
+    Parameters
+    ----------
+    cond : str
+      A user-specified condition, e.g. 'exptime=0'
+
+    Returns
+    -------
+    parsed : tuple
+      The keyword, operator and value of the condition, or None if the
+      condition has no operator
+    """
+    if cond not in _conditions:
+        parsed = None
+        for op in ["<=", ">=", "!=", "<", ">", "="]:
+            if op in cond:
+                tcond = cond.split(op)
+                parsed = (tcond[0], op, tcond[1])
+                break
+        _conditions[cond] = parsed
+    return _conditions[cond]
+
+
 def chk_condition(fitsdict, cond):
     """
     Code to perform condition.  A bit messy so a separate definition
@@ -216,34 +390,73 @@ def chk_condition(fitsdict, cond):
     ntmp: bool array
       A boolean array of all frames that satisfy the input condition
     """
-    if "<=" in cond:
-        tcond = cond.split("<=")
-        ntmp = fitsdict[tcond[0]] <= float(tcond[1])
-    elif ">=" in cond:
-        tcond = cond.split(">=")
-        ntmp = fitsdict[tcond[0]] >= float(tcond[1])
-    elif "!=" in cond:
-        tcond = cond.split("!=")
-        ntmp = fitsdict[tcond[0]] != tcond[1]
-    elif "<" in cond:
-        tcond = cond.split("<")
-        ntmp = fitsdict[tcond[0]] < float(tcond[1])
-    elif ">" in cond:
-        tcond = cond.split(">")
-        ntmp = fitsdict[tcond[0]] > float(tcond[1])
-    elif "=" in cond:
-        tcond = cond.split("=")
-        if 'int' in fitsdict[tcond[0]].dtype.name:
-            ntmp = fitsdict[tcond[0]] == int(tcond[1])
-        elif 'float' in fitsdict[tcond[0]].dtype.name:
-            ntmp = fitsdict[tcond[0]] == float(tcond[1])
-        else:
-            ntmp = fitsdict[tcond[0]] == tcond[1]
+    parsed = parse_condition(cond)
+    if parsed is None:
+        return None
+    key, op, value = parsed
+    if op == "<=":
+        ntmp = fitsdict[key] <= float(value)
+    elif op == ">=":
+        ntmp = fitsdict[key] >= float(value)
+    elif op == "!=":
+        ntmp = fitsdict[key] != value
+    elif op == "<":
+        ntmp = fitsdict[key] < float(value)
+    elif op == ">":
+        ntmp = fitsdict[key] > float(value)
     else:
-        ntmp = None
+        if 'int' in fitsdict[key].dtype.name:
+            ntmp = fitsdict[key] == int(value)
+        elif 'float' in fitsdict[key].dtype.name:
+            ntmp = fitsdict[key] == float(value)
+        else:
+            ntmp = fitsdict[key] == value
     return ntmp
 
 
+def frametype_mask(fitsdict, ftype):
+    """ Identify the frames of a given type, with the checks of the
+    settings file (e.g. 'bias check condition1 exptime=0')
+
+    Parameters
+    ----------
+    fitsdict : dict
+      Contains relevant information from fits header files
+    ftype : str
+      Frame type
+
+    Returns
+    -------
+    mask : bool array
+      True for the frames that pass all of the checks
+    """
+    numfiles = fitsdict['filename'].size
+    mask = np.ones(numfiles, dtype=np.bool)
+    # Self identification
+    if settings.argflag['run']['useIDname']:
+        mask &= fitsdict['idname'] == settings.spect[ftype]['idname']
+    # Perform additional checks in order to make sure this identification is true
+    if 'check' in settings.spect[ftype].keys():
+        for ch, value in settings.spect[ftype]['check'].items():
+            if ch[0:9] == 'condition':
+                # Deal with a conditional argument
+                conds = re.split("(\||\&)", value)
+                ntmp = chk_condition(fitsdict, conds[0])
+                # And more
+                for cn in range((len(conds)-1)//2):
+                    if conds[2*cn+1] == "|":
+                        ntmp = ntmp | chk_condition(fitsdict, conds[2*cn+2])
+                    elif conds[2*cn+1] == "&":
+                        ntmp = ntmp & chk_condition(fitsdict, conds[2*cn+2])
+                mask &= ntmp
+            elif fitsdict[ch].dtype.char == 'S':  # Numpy string array
+                # Strip numpy string array of all whitespace
+                mask &= np.char.strip(fitsdict[ch]) == value
+            else:
+                mask &= fitsdict[ch] == value
+    return mask
+
+
 def sort_write(fitsdict, filesort, space=3):
     """
     Write out an xml and ascii file that contains the details of the file sorting.
@@ -378,6 +591,8 @@ def match_science(fitsdict, filesort):
     filesort['failures'] = []
     iARR = [iARC, iSTD, iBIA, iDRK, iPFL, iBFL, iTRC]
     nSCI = iSCI.size
+    # The calibration frames of each type, indexed by their setup (see calib_match_index)
+    match_indices = dict({})
     i = 0
     while i < nSCI:
         msgs.info("Matching calibrations to {:s}: {:s}".format(
@@ -402,105 +617,16 @@ def match_science(fitsdict, filesort):
                 msgs.info("No {0:s} frames are required".format(ftag[ft]))
                 continue
             # Now go ahead and match the frames
-            n = np.arange(nfiles)
             if 'match' not in settings.spect[ftag[ft]].keys() and (not settings.argflag['run']['setup']):
                 debugger.set_trace()
             #if not settings.argflag['run']['setup']:
             if 'match' not in settings.spect[ftag[ft]].keys():
                 msgs.info("No matching criteria for {0:s} frames with this instrument".format(ftag[ft]))
-            else:
-                chkk = settings.spect[ftag[ft]]['match'].keys()
-                for ch in chkk:
-                    tmtch = settings.spect[ftag[ft]]['match'][ch]
-                    if tmtch == "any":
-                        w = np.arange(len(fitsdict['filename'])).astype(int)
-                    elif tmtch == "''":
-                        w = np.where(fitsdict[ch] == fitsdict[ch][iSCI[i]])[0]
-                    elif tmtch[0] == '=':
-                        mtch = np.float64(fitsdict[ch][iSCI[i]]) + np.float64(tmtch[1:])
-                        w = np.where((fitsdict[ch]).astype(np.float64) == mtch)[0]
-                    elif tmtch[0] == '<':
-                        if tmtch[1] == '=':
-                            mtch = np.float64(fitsdict[ch][iSCI[i]]) + np.float64(tmtch[2:])
-                            w = np.where((fitsdict[ch]).astype(np.float64) <= mtch)[0]
-                        else:
-                            mtch = np.float64(fitsdict[ch][iSCI[i]]) + np.float64(tmtch[1:])
-                            w = np.where((fitsdict[ch]).astype(np.float64) < mtch)[0]
-                    elif tmtch[0] == '>':
-                        if tmtch[1] == '=':
-                            mtch = np.float64(fitsdict[ch][iSCI[i]]) + np.float64(tmtch[2:])
-                            w = np.where((fitsdict[ch]).astype(np.float64) >= mtch)[0]
-                        else:
-                            mtch = np.float64(fitsdict[ch][iSCI[i]]) + np.float64(tmtch[1:])
-                            w = np.where((fitsdict[ch]).astype(np.float64) > mtch)[0]
-                    elif tmtch[0] == '|':
-                        if tmtch[1] == '=':
-                            mtch = np.float64(tmtch[2:])
-                            w = np.where(np.abs((fitsdict[ch]).astype(np.float64)-np.float64(fitsdict[ch][iSCI[i]])) == mtch)[0]
-                        elif tmtch[1] == '<':
-                            if tmtch[2] == '=':
-                                mtch = np.float64(tmtch[3:])
-                                w = np.where(np.abs((fitsdict[ch]).astype(np.float64)-np.float64(fitsdict[ch][iSCI[i]])) <= mtch)[0]
-                            else:
-                                mtch = np.float64(tmtch[2:])
-                                w = np.where(np.abs((fitsdict[ch]).astype(np.float64)-np.float64(fitsdict[ch][iSCI[i]])) < mtch)[0]
-                        elif tmtch[1] == '>':
-                            if tmtch[2] == '=':
-                                mtch = np.float64(tmtch[3:])
-                                w = np.where(np.abs((fitsdict[ch]).astype(np.float64)-np.float64(fitsdict[ch][iSCI[i]])) >= mtch)[0]
-                            else:
-                                mtch = np.float64(tmtch[2:])
-                                w = np.where(np.abs((fitsdict[ch]).astype(np.float64)-np.float64(fitsdict[ch][iSCI[i]])) > mtch)[0]
-                    elif tmtch[0:2] == '%,':  # Splitting a header keyword
-                        splcom = tmtch.split(',')
-                        try:
-                            spltxt, argtxt, valtxt = splcom[1], np.int(splcom[2]), splcom[3]
-                            tspl = []
-                            for sp in fitsdict[ch]:
-                                tmpspl = str(re.escape(spltxt)).replace("\\|", "|")
-                                tmpspl = re.split(tmpspl, sp)
-                                if len(tmpspl) < argtxt+1:
-                                    tspl.append("-9999999")
-                                else:
-                                    tspl.append(tmpspl[argtxt])
-                            tspl = np.array(tspl)
-    #                        debugger.set_trace()
-                            tmpspl = str(re.escape(spltxt)).replace("\\|", "|")
-                            tmpspl = re.split(tmpspl, fitsdict[ch][iSCI[i]])
-                            if len(tmpspl) < argtxt + 1:
-                                continue
-                            else:
-                                scispl = tmpspl[argtxt]
-                            if valtxt == "''":
-                                w = np.where(tspl == scispl)[0]
-                            elif valtxt[0] == '=':
-                                mtch = np.float64(scispl) + np.float64(valtxt[1:])
-                                w = np.where(tspl.astype(np.float64) == mtch)[0]
-                            elif valtxt[0] == '<':
-                                if valtxt[1] == '=':
-                                    mtch = np.float64(scispl) + np.float64(valtxt[2:])
-                                    w = np.where(tspl.astype(np.float64) <= mtch)[0]
-                                else:
-                                    mtch = np.float64(scispl) + np.float64(valtxt[1:])
-                                    w = np.where(tspl.astype(np.float64) < mtch)[0]
-                            elif valtxt[0] == '>':
-                                if valtxt[1] == '=':
-                                    mtch = np.float64(scispl) + np.float64(valtxt[2:])
-                                    w = np.where(tspl.astype(np.float64) >= mtch)[0]
-                                else:
-                                    mtch = np.float64(scispl) + np.float64(valtxt[1:])
-                                    w = np.where(tspl.astype(np.float64) > mtch)[0]
-                        except:
-                            debugger.set_trace()
-                            continue
-                    n = np.intersect1d(n, w)  # n corresponds to all frames with matching instrument setup to science frames
-            # Find the time difference between the calibrations and science frames
-            if settings.spect['fits']['calwin'] > 0.0:
-                tdiff = np.abs(fitsdict['time'][n].astype(np.float64)-np.float64(fitsdict['time'][iSCI[i]]))
-                w = np.where(tdiff <= settings.spect['fits']['calwin'])[0]
-                n = n[w] # n corresponds to all frames within a set time difference of the science target frame
-            # Now find which of the remaining n are the appropriate calibration frames
-            n = np.intersect1d(n, iARR[ft])
+            if ftag[ft] not in match_indices:
+                match_indices[ftag[ft]] = calib_match_index(fitsdict, ftag[ft], iARR[ft])
+            # n corresponds to all frames with matching instrument setup to science frames,
+            # and within a set time difference of the science target frame
+            n = match_calibs(fitsdict, match_indices[ftag[ft]], iSCI[i])
             if settings.argflag['output']['verbosity'] == 2:
                 if numfr == 1: areis = "is"
                 else: areis = "are"
@@ -563,6 +689,143 @@ def match_science(fitsdict, filesort):
     return
 
 
+def match_mask(values, scival, tmtch):
+    """ Which frames satisfy a match criterion of the settings file
+    (e.g. 'arc match dispname ""' or 'arc match decker <=0.5')
+
+    Parameters
+    ----------
+    values : ndarray
+      Values of the header keyword for the candidate frames
+    scival : str, int or float
+      Value of the header keyword for the science frame
+    tmtch : str
+      The match criterion: '' (the same value), =X, <X, <=X, >X, >=X
+      (compared to the science value plus X), or |=X, |<X, |<=X, |>X,
+      |>=X (the absolute difference with the science value compared to X)
+
+    Returns
+    -------
+    mask : bool array
+    """
+    if tmtch == "''":
+        return values == scival
+    if tmtch[0] == '|':
+        tmtch = tmtch[1:]
+        values = np.abs(values.astype(np.float64)-np.float64(scival))
+        scival = 0.0
+    else:
+        values = values.astype(np.float64)
+    for op, func in [('<=', np.less_equal), ('>=', np.greater_equal), ('=', np.equal),
+                     ('<', np.less), ('>', np.greater)]:
+        if tmtch[:len(op)] == op:
+            return func(values, np.float64(scival) + np.float64(tmtch[len(op):]))
+    msgs.error("Unknown match criterion: {0:s}".format(tmtch))
+
+
+def split_keyword(value, spltxt, argtxt):
+    """ Split the value of a header keyword, for a match criterion of the
+    form %,<split>,<element>,<criterion>
+
+    Returns
+    -------
+    element : str or None
+      None if the value has too few elements
+    """
+    tmpspl = str(re.escape(spltxt)).replace("\\|", "|")
+    tmpspl = re.split(tmpspl, value)
+    if len(tmpspl) < argtxt+1:
+        return None
+    return tmpspl[argtxt]
+
+
+def calib_match_index(fitsdict, ftype, cand):
+    """ Index the calibration frames of a given type by the values of the
+    header keywords that must be identical to those of the science frame
+    (match criterion ''), so that the calibration frames of a science
+    frame are found without checking all of the files (see match_calibs)
+
+    Parameters
+    ----------
+    fitsdict : dict
+      Contains relevant information from fits header files
+    ftype : str
+      Calibration frame type
+    cand : ndarray
+      Indices of the frames of this type
+
+    Returns
+    -------
+    index : dict
+      'exact' lists the keywords to be matched exactly, 'groups' holds the
+      indices of the frames (in ascending order) for each set of values of
+      these keywords, 'other' lists the remaining (keyword, criterion)
+      pairs, and 'split' holds the split values of the keywords with a
+      '%,' criterion.
+    """
+    cand = np.unique(np.asarray(cand, dtype=np.int))
+    criteria = settings.spect[ftype].get('match', {})
+    exact = [ch for ch in criteria.keys() if criteria[ch] == "''"]
+    other = [(ch, criteria[ch]) for ch in criteria.keys() if criteria[ch] not in ["''", "any"]]
+    groups = dict({})
+    for idx in cand:
+        groups.setdefault(tuple([fitsdict[ch][idx] for ch in exact]), []).append(idx)
+    for key in groups.keys():
+        groups[key] = np.array(groups[key], dtype=np.int)
+    split = dict({})
+    for ch, tmtch in other:
+        if tmtch[0:2] == '%,':  # Splitting a header keyword
+            splcom = tmtch.split(',')
+            spltxt, argtxt = splcom[1], np.int(splcom[2])
+            split[ch] = dict({})
+            for idx in cand:
+                tspl = split_keyword(fitsdict[ch][idx], spltxt, argtxt)
+                split[ch][idx] = "-9999999" if tspl is None else tspl
+    return dict(exact=exact, groups=groups, other=other, split=split)
+
+
+def match_calibs(fitsdict, index, sci):
+    """ Find the calibration frames that match a science frame
+
+    Parameters
+    ----------
+    fitsdict : dict
+      Contains relevant information from fits header files
+    index : dict
+      The calibration frames of a given type (see calib_match_index)
+    sci : int
+      Index of the science frame
+
+    Returns
+    -------
+    n : ndarray
+      Indices of the matching calibration frames, in ascending order
+    """
+    n = index['groups'].get(tuple([fitsdict[ch][sci] for ch in index['exact']]), np.array([], dtype=np.int))
+    for ch, tmtch in index['other']:
+        if n.size == 0:
+            break
+        if tmtch[0:2] == '%,':  # Splitting a header keyword
+            splcom = tmtch.split(',')
+            try:
+                spltxt, argtxt, valtxt = splcom[1], np.int(splcom[2]), splcom[3]
+                scispl = split_keyword(fitsdict[ch][sci], spltxt, argtxt)
+                if scispl is None:
+                    continue
+                tspl = np.array([index['split'][ch][idx] for idx in n])
+                n = n[match_mask(tspl, scispl, valtxt)]
+            except (IndexError, KeyError, ValueError):
+                msgs.warn("Could not apply the {0:s} condition '{1:s}' -- it will be ignored".format(ch, tmtch))
+                continue
+        else:
+            n = n[match_mask(fitsdict[ch][n], fitsdict[ch][sci], tmtch)]
+    # Find the time difference between the calibrations and science frames
+    if settings.spect['fits']['calwin'] > 0.0:
+        tdiff = np.abs(fitsdict['time'][n].astype(np.float64)-np.float64(fitsdict['time'][sci]))
+        n = n[tdiff <= settings.spect['fits']['calwin']]
+    return n
+
+
 def match_frames(frames, criteria, frametype='<None>', satlevel=None):
     """
     identify frames with a similar appearance (i.e. one frame appears to be a scaled version of another).
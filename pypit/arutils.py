@@ -1072,6 +1072,48 @@ def subsample(frame):
     return frame[tuple(indices)]
 
 
+def thread_map(func, items, nthreads):
+    """ Apply a function to each item of a list on a pool of threads
+
+    Exceptions raised by func in a worker thread (including the SystemExit
+    raised by msgs.error) are re-raised in the calling thread.
+
+    Parameters
+    ----------
+    func : callable
+    items : list
+    nthreads : int
+      Maximum number of threads. If 1, the items are processed in serial.
+
+    Returns
+    -------
+    results : list
+      func(item) for each item
+    """
+    from multiprocessing.pool import ThreadPool
+    items = list(items)
+    nthreads = max(1, min(nthreads, len(items)))
+    if nthreads == 1:
+        return [func(item) for item in items]
+
+    def call(item):
+        try:
+            return True, func(item)
+        except BaseException as err:
+            return False, err
+
+    pool = ThreadPool(processes=nthreads)
+    try:
+        results = pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+    for success, result in results:
+        if not success:
+            raise result
+    return [result for success, result in results]
+
+
 def trace_gweight(fimage, xcen, ycen, sigma, invvar=None, maskval=-999999.9):
     """ Determines the trace centroid by weighting the flux by the integral
     of a Gaussian over a pixel
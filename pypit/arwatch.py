@@ -0,0 +1,149 @@
+""" Observing mode: watch the raw data directories, and reduce the new
+science frames as they arrive (run_pypit --watch)
+"""
+from __future__ import (print_function, absolute_import, division, unicode_literals)
+
+import glob
+import os
+import time
+
+from pypit import armsgs
+
+# Logging
+msgs = armsgs.get_logger()
+
+
+def list_files(patterns, skip_files=None):
+    """ List the raw files that match the paths (with wild cards) given
+    in the data block of a .pypit file
+
+    Parameters
+    ----------
+    patterns : list
+      Full data paths, which may include wild cards
+    skip_files : list, optional
+      Files to be ignored (see 'skip' in the data block)
+
+    Returns
+    -------
+    files : list
+      The matching files, sorted by name for each path
+    """
+    if skip_files is None:
+        skip_files = []
+    files = []
+    for pattern in patterns:
+        for name in sorted(glob.glob(pattern)):
+            if name in files or any([skip in name for skip in skip_files]):
+                continue
+            files.append(name)
+    return files
+
+
+class FileWatcher(object):
+    """ Keep track of the raw files, in their order of arrival
+
+    A new file is only accepted once its size and modification time are
+    unchanged between two polls, so that a file is not read while it is
+    still being written. The accepted files keep their order, so that the
+    files that were already reduced keep their index in the fitsdict
+    (and the master frames held in memory remain valid).
+
+    Parameters
+    ----------
+    patterns : list
+      Full data paths, which may include wild cards
+    skip_files : list, optional
+      Files to be ignored
+    initial : list, optional
+      Files that are accepted straight away (e.g. the files listed when
+      the .pypit file was loaded)
+    """
+
+    def __init__(self, patterns, skip_files=None, initial=None):
+        self._patterns = patterns
+        self._skip_files = skip_files
+        self._pending = {}    # Size and modification time of the new files, and when they were first seen
+        self.files = []
+        self.arrival = {}
+        tnow = time.time()
+        for name in ([] if initial is None else initial):
+            if name not in self.arrival:
+                self.files.append(name)
+                self.arrival[name] = tnow
+
+    def poll(self):
+        """ Look for new files
+
+        Returns
+        -------
+        new : list
+          The files that have been accepted since the last poll
+        """
+        tnow = time.time()
+        new = []
+        for name in list_files(self._patterns, self._skip_files):
+            if name in self.arrival:
+                continue
+            try:
+                stat = os.stat(name)
+            except OSError:
+                continue
+            filestat = (stat.st_size, stat.st_mtime)
+            if name in self._pending and self._pending[name][0] == filestat:
+                new.append(name)
+                self.arrival[name] = self._pending.pop(name)[1]
+            else:
+                tfirst = self._pending[name][1] if name in self._pending else tnow
+                self._pending[name] = (filestat, tfirst)
+        self.files += new
+        return new
+
+
+def watch(watcher, reduce_files, interval, npass=None):
+    """ Reduce the files accepted by a FileWatcher, and then the new files
+    whenever they arrive
+
+    Parameters
+    ----------
+    watcher : FileWatcher
+    reduce_files : function
+      Called as reduce_files(files, new) with all of the accepted files and
+      the new ones. Returns the new science frames that were reduced.
+    interval : float
+      Time (in seconds) between two polls of the raw data directories
+    npass : int, optional
+      Stop after this number of polls (by default, watch until interrupted)
+
+    Returns
+    -------
+    latency : dict
+      Time (in seconds) from the arrival of each reduced science frame
+      until the end of its reduction
+    """
+    latency = dict({})
+    new = list(watcher.files)
+    ipass = 0
+    msgs.info("Watching for new frames every {0:.1f}s -- press Ctrl+C to stop".format(interval))
+    while True:
+        if len(new) > 0:
+            msgs.info("Reducing {0:d} new frames".format(len(new)))
+            tstart = time.time()
+            try:
+                reduced = reduce_files(watcher.files, new)
+            except SystemExit:
+                # msgs.error closed the log file
+                msgs.reopen()
+                msgs.warn("The new frames could not be reduced -- waiting for more frames")
+                reduced = []
+            tend = time.time()
+            for name in reduced:
+                latency[name] = tend - watcher.arrival[name]
+                msgs.info("Reduced {0:s} {1:.1f}s after it arrived ({2:.1f}s to reduce)".format(
+                    os.path.basename(name), latency[name], tend-tstart))
+        ipass += 1
+        if npass is not None and ipass >= npass:
+            break
+        time.sleep(interval)
+        new = watcher.poll()
+    return latency
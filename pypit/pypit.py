@@ -19,7 +19,7 @@ from pypit import ardebug as debugger
 
 
 def PYPIT(redname, debug=None, progname=__file__, quick=False, ncpus=1, verbosity=1,
-          use_masters=False, logname=None):
+          use_masters=False, logname=None, resume=False, watch=None):
     """ Main driver of the PYPIT code. Default settings and
     user-specified changes are made, and passed to the
     appropriate code for data reduction.
@@ -47,6 +47,14 @@ def PYPIT(redname, debug=None, progname=__file__, quick=False, ncpus=1, verbosit
         2 = All output
     use_masters : bool, optional
       Load calibration files from MasterFrames directory, if they exist
+    resume : bool, optional
+      Resume a previous reduction, skipping the science exposures and
+      the stages that have been completed (this also loads the master
+      frames from the MasterFrames directory)
+    watch : float, optional
+      Observing mode: after the reduction, watch the raw data directories,
+      and reduce the new science frames as they arrive, polling every
+      watch seconds (see watch_reduction)
     logname : str or None
           The name of an ascii log file which is used to
           save the output details of the reduction
@@ -169,6 +177,9 @@ def PYPIT(redname, debug=None, progname=__file__, quick=False, ncpus=1, verbosit
     argf.set_param('output verbosity {0:d}'.format(verbosity))
     if use_masters:
         argf.set_param('reduce masters reuse True')
+    if resume:
+        argf.set_param('run resume True')
+        argf.set_param('reduce masters reuse True')
     msgs.work("Make appropriate changes to quick reduction")
     if quick:
         # If a quick reduction has been requested, make sure the requested pipeline
@@ -193,17 +204,8 @@ def PYPIT(redname, debug=None, progname=__file__, quick=False, ncpus=1, verbosit
         msgs.info("Will use this to guide the data reduction.")
     '''
 
-    # Load the important information from the fits headers
-    from pypit import arload
-    fitsdict = arload.load_headers(datlines)
-
     # If the dispersion direction is 1, flip the axes
     if arparse.argflag['trace']['dispersion']['direction'] == 1:
-        # Update the keywords of all fits files
-        for ff in range(len(fitsdict['naxis0'])):
-            temp = fitsdict['naxis0'][ff]
-            fitsdict['naxis0'][ff] = fitsdict['naxis1'][ff]
-            fitsdict['naxis1'][ff] = temp
         # Update the spectrograph settings for all detectors in the mosaic
         for dd in range(arparse.spect['mosaic']['ndet']):
             ddnum = arparse.get_dnum(dd+1)
@@ -219,17 +221,14 @@ def PYPIT(redname, debug=None, progname=__file__, quick=False, ncpus=1, verbosit
                                                                             'datasec{0:02d}'.format(i + 1)][::-1]
                 arparse.spect[ddnum]['oscansec{0:02d}'.format(i + 1)] = arparse.spect[ddnum][
                                                                              'oscansec{0:02d}'.format(i + 1)][::-1]
-    # Reduce the data!
-    status = 0
-    # Send the data away to be reduced
-    if spect.__dict__['_spect']['mosaic']['reduction'] == 'ARMLSD':
-        msgs.info("Data reduction will be performed using PYPIT-ARMLSD")
-        from pypit import armlsd
-        status = armlsd.ARMLSD(fitsdict)
-    elif spect.__dict__['_spect']['mosaic']['reduction'] == 'ARMED':
-        msgs.info("Data reduction will be performed using PYPIT-ARMED")
-        from pypit import armed
-        status = armed.ARMED(fitsdict)
+
+    if watch is not None:
+        # Observing mode
+        status = watch_reduction(argf, spect, pyp_dict, watch)
+    else:
+        # Reduce the data!
+        fitsdict = load_fitsdict(datlines)
+        status = reduce_data(fitsdict, spect)
     # Check for successful reduction
     if status == 0:
         msgs.info("Data reduction complete")
@@ -256,6 +255,128 @@ def PYPIT(redname, debug=None, progname=__file__, quick=False, ncpus=1, verbosit
     return
 
 
+def load_fitsdict(datlines):
+    """ Load the important information from the fits headers of the raw files
+
+    Parameters
+    ----------
+    datlines : list
+      Full data path to every raw exposure
+
+    Returns
+    -------
+    fitsdict : dict
+      Contains relevant information from fits header files
+    """
+    from pypit import arparse
+    from pypit import arload
+    fitsdict = arload.load_headers(datlines)
+    # If the dispersion direction is 1, flip the axes
+    if arparse.argflag['trace']['dispersion']['direction'] == 1:
+        # Update the keywords of all fits files
+        for ff in range(len(fitsdict['naxis0'])):
+            temp = fitsdict['naxis0'][ff]
+            fitsdict['naxis0'][ff] = fitsdict['naxis1'][ff]
+            fitsdict['naxis1'][ff] = temp
+    return fitsdict
+
+
+def reduce_data(fitsdict, spect, store=None):
+    """ Send the data away to be reduced
+
+    Parameters
+    ----------
+    fitsdict : dict
+      Contains relevant information from fits header files
+    spect : class
+      Spectrograph settings class
+    store : MasterStore, optional
+      Store of the master frames, that is kept between reductions
+      (observing mode)
+
+    Returns
+    -------
+    status : int
+      Status of the reduction procedure
+    """
+    msgs = armsgs.get_logger()
+    status = 0
+    # Send the data away to be reduced
+    if spect.__dict__['_spect']['mosaic']['reduction'] == 'ARMLSD':
+        msgs.info("Data reduction will be performed using PYPIT-ARMLSD")
+        from pypit import armlsd
+        status = armlsd.ARMLSD(fitsdict, store=store)
+    elif spect.__dict__['_spect']['mosaic']['reduction'] == 'ARMED':
+        msgs.info("Data reduction will be performed using PYPIT-ARMED")
+        from pypit import armed
+        status = armed.ARMED(fitsdict)
+    return status
+
+
+def watch_reduction(argf, spect, pyp_dict, interval, npass=None):
+    """ Observing mode: reduce the raw files, and then watch the raw data
+    directories and reduce the new science frames as they arrive
+
+    The process, and therefore the memoised checksums of the raw files,
+    the header index and the master frames (in a MasterStore), are kept
+    between the reductions. Each reduction resumes the previous one (run
+    resume), so that only the new science frames are reduced, with the
+    existing master frames. The settings are restored before each
+    reduction.
+
+    Parameters
+    ----------
+    argf : class
+      Arguments and flags class
+    spect : class
+      Spectrograph settings class
+    pyp_dict : dict
+      The input .pypit file (see load_input)
+    interval : float
+      Time (in seconds) between two polls of the raw data directories
+    npass : int, optional
+      Stop after this number of polls
+
+    Returns
+    -------
+    status : int
+      Status of the reduction procedure
+    """
+    import copy
+    from pypit import arparse
+    from pypit import armasters
+    from pypit import arwatch
+    msgs = armsgs.get_logger()
+    patterns = [dfn for dfn in pyp_dict['dfn'] if dfn[0] == '/']
+    if len(patterns) == 0:
+        msgs.error("The observing mode needs the full path to the raw data (with wild cards)" +
+                   msgs.newline() + "in the data block")
+    if arparse.argflag['run']['setup'] or arparse.argflag['run']['calcheck']:
+        msgs.error("The observing mode cannot be used with run setup or run calcheck")
+    argf.set_param('run resume True')
+    argf.set_param('reduce masters reuse True')
+    argflag0 = copy.deepcopy(argf.__dict__['_argflag'])
+    spect0 = copy.deepcopy(spect.__dict__['_spect'])
+    store = armasters.MasterStore()
+
+    def reduce_new(files, new):
+        # Restore the settings of the reduction
+        argf.__dict__['_argflag'] = copy.deepcopy(argflag0)
+        spect.__dict__['_spect'] = copy.deepcopy(spect0)
+        arparse.init(argf, spect)
+        fitsdict = load_fitsdict(files)
+        status = reduce_data(fitsdict, spect, store=store)
+        if status != 0:
+            msgs.warn("The reduction finished with status ID {0:d}".format(status))
+        science = [fitsdict['directory'][idx[0]]+fitsdict['filename'][idx[0]]
+                   for idx in arparse.spect['science']['index']]
+        return [name for name in new if name in science]
+
+    watcher = arwatch.FileWatcher(patterns, skip_files=pyp_dict['skip'], initial=pyp_dict['dat'])
+    arwatch.watch(watcher, reduce_new, interval, npass=npass)
+    return 0
+
+
 def load_input(redname, msgs):
     """
     Load user defined input .pypit reduction file. Updates are
@@ -297,6 +418,8 @@ def load_input(redname, msgs):
           'lines' list of lines in the setup block
       'ftype' : dict
          dict of filename: frametype
+      'skip' : list
+         Files to be skipped
     """
     import os
     # Read in the model file
@@ -423,7 +546,7 @@ def load_input(redname, msgs):
     # Let's return a dict
     pypit_dict = dict(par=parlines, dat=datlines, spc=spclines,
                       dfn=dfnames, setup={'name': setups, 'lines': setuplines},
-                    ftype=ftype_dict)
+                    ftype=ftype_dict, skip=skip_files)
     return pypit_dict # parlines, datlines, spclines, dfnames, setup, setuplines, ftype_dict
 
 
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# See top-level LICENSE file for Copyright information
+#
+# -*- coding: utf-8 -*-
+
+"""
+This script times the PYPIT compute kernels on synthetic data
+"""
+
+
+def parser(options=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='kernel', help='Kernels to benchmark')
+
+    comb = subparsers.add_parser('comb', help='arcycomb frame combination kernels',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    comb.add_argument('--nx', type=int, default=4096, help='Number of rows in each frame')
+    comb.add_argument('--ny', type=int, default=4096, help='Number of columns in each frame')
+    comb.add_argument('--nframes', type=int, default=5, help='Number of frames in the stack')
+    comb.add_argument('--ncpus', type=int, default=None,
+                      help='Number of threads for the parallel kernels (default: all cores)')
+    comb.add_argument('--repeat', type=int, default=1, help='Number of times each kernel is run')
+
+    lacosmic = subparsers.add_parser('lacosmic', help='L.A.Cosmic detection of cosmic rays',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    lacosmic.add_argument('--nx', type=int, default=4096, help='Number of rows in the frame')
+    lacosmic.add_argument('--ny', type=int, default=4096, help='Number of columns in the frame')
+    lacosmic.add_argument('--ncpus', type=int, default=None,
+                          help='Number of threads for the median filters (default: all cores)')
+    lacosmic.add_argument('--slitfrac', type=float, default=0.25,
+                          help='Fraction of the columns covered by the slit (for reduce crmask slitonly)')
+    lacosmic.add_argument('--repeat', type=int, default=1, help='Number of times each kernel is run')
+
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+    return args
+
+
+def time_kernel(func, args, repeat):
+    """ Return the best time of several runs of func(*args), and its output
+    """
+    import time
+    best = None
+    for i in range(repeat):
+        # Kernels that modify their input get a fresh copy each time
+        fargs = [arg.copy() if hasattr(arg, 'copy') else arg for arg in args]
+        tstart = time.time()
+        out = func(*fargs)
+        tt = time.time() - tstart
+        if best is None or tt < best:
+            best = tt
+    return best, out
+
+
+def bench_comb(args):
+    import multiprocessing
+    import numpy as np
+    from pypit import arcycomb
+
+    ncpus = multiprocessing.cpu_count() if args.ncpus is None else args.ncpus
+    maskvalue = 1048577.0
+    # A stack of bias-like frames with cosmic rays and a few masked pixels
+    np.random.seed(1)
+    frames = np.random.normal(1000.0, 10.0, (args.nx, args.ny, args.nframes))
+    crs = np.random.uniform(size=frames.shape) < 0.001
+    frames[crs] += 5000.0
+    frames[np.random.uniform(size=frames.shape) < 0.0005] = maskvalue
+    limit = np.median(frames, axis=2) + 50.0
+    print("Stack of {0:d} frames of {1:d}x{2:d} pixels ({3:.2f} GB)".format(
+        args.nframes, args.nx, args.ny, frames.nbytes/1024.0**3))
+    kernels = [('masked_median', (frames, maskvalue)),
+               ('masked_mean', (frames, maskvalue)),
+               ('masked_weightmean', (frames, maskvalue)),
+               ('maxnonsat', (frames, 60000.0)),
+               ('masked_limitset', (frames, 3000.0, 2, maskvalue)),
+               ('masked_limitsetarr', (frames, limit, 2, maskvalue)),
+               ('minmax', (frames, 1)),
+               ('mean', (frames,)),
+               ('median', (frames,))]
+    print("{0:20s} {1:>10s} {2:>10s} {3:>8s} {4:>10s}".format(
+        'kernel', '1 thread', '{0:d} threads'.format(ncpus), 'speedup', 'identical'))
+    for name, kargs in kernels:
+        func = getattr(arcycomb, name)
+        tser, oser = time_kernel(lambda *a: func(*a, nthreads=1), kargs, args.repeat)
+        tpar, opar = time_kernel(lambda *a: func(*a, nthreads=ncpus), kargs, args.repeat)
+        print("{0:20s} {1:9.2f}s {2:9.2f}s {3:8.2f} {4:>10s}".format(
+            name, tser, tpar, tser/tpar, str(np.array_equal(oser, opar))))
+
+
+def lacosmic_fullframe(sciframe, noise_model, satpix, sigclip=5.0, sigfrac=0.3, objlim=5.0):
+    """ One iteration of the L.A.Cosmic detection as it was implemented
+    in arproc.lacosmic before arcosmic (for reference)
+    """
+    import numpy as np
+    from scipy import ndimage, signal
+    from pypit import arutils
+    laplkernel = np.array([[0.0, -1.0, 0.0], [-1.0, 4.0, -1.0], [0.0, -1.0, 0.0]])
+    growkernel = np.ones((3, 3))
+    subsam = arutils.subsample(sciframe)
+    conved = signal.convolve2d(subsam, laplkernel, mode="same", boundary="symm")
+    lplus = arutils.rebin(conved.clip(min=0.0), np.array(conved.shape)/2.0)
+    m5 = ndimage.median_filter(sciframe, size=5, mode='mirror')
+    noise = noise_model(m5)
+    s = lplus / (2.0 * noise)
+    sp = s - ndimage.median_filter(s, size=5, mode='mirror')
+    candidates = np.logical_and(sp > sigclip, np.logical_not(satpix))
+    m3 = ndimage.median_filter(sciframe, size=3, mode='mirror')
+    m37 = ndimage.median_filter(m3, size=7, mode='mirror')
+    f = ((m3 - m37) / noise).clip(min=0.01)
+    cosmics = np.logical_and(candidates, sp/f > objlim)
+    growcosmics = signal.convolve2d(cosmics.astype(np.float32), growkernel, mode="same", boundary="symm") > 0
+    growcosmics = np.logical_and(sp > sigclip, growcosmics)
+    finalsel = signal.convolve2d(growcosmics.astype(np.float32), growkernel, mode="same", boundary="symm") > 0
+    finalsel = np.logical_and(sp > sigclip*sigfrac, finalsel)
+    return np.logical_and(np.logical_not(satpix), finalsel)
+
+
+def bench_lacosmic(args):
+    import multiprocessing
+    import numpy as np
+    from pypit import arcosmic
+
+    ncpus = multiprocessing.cpu_count() if args.ncpus is None else args.ncpus
+    # A sky-dominated frame with an object trace, cosmic rays and a saturated star
+    np.random.seed(1)
+    sciframe = np.random.normal(200.0, 15.0, (args.nx, args.ny))
+    sciframe += 2000.0*np.exp(-0.5*((np.arange(args.ny)-args.ny/2.0)/4.0)**2)[np.newaxis, :]
+    ncr = args.nx*args.ny//2000
+    rows, cols = np.random.randint(0, args.nx, ncr), np.random.randint(0, args.ny-1, ncr)
+    sciframe[rows, cols] += np.random.uniform(300.0, 20000.0, ncr)
+    sciframe[rows[::2], cols[::2]+1] += np.random.uniform(300.0, 5000.0, rows[::2].size)
+    sciframe[10:20, 10:20] = 70000.0
+    satpix = sciframe >= 65000.0
+    slitpix = np.zeros(sciframe.shape, dtype=np.int)
+    nslit = int(args.ny*args.slitfrac)
+    slitpix[:, (args.ny-nslit)//2:(args.ny+nslit)//2] = 1
+    region = arcosmic.slit_region(slitpix)
+
+    def noise_model(m5):
+        return np.sqrt(np.abs(m5) + 16.0)
+
+    def slitonly(sciframe, nthreads):
+        crmask = np.zeros(sciframe.shape, dtype=bool)
+        crmask[region] = arcosmic.detect(sciframe[region], noise_model, satpix=satpix[region],
+                                         nthreads=nthreads)
+        return crmask
+
+    print("Frame of {0:d}x{1:d} pixels with {2:d} cosmic rays".format(args.nx, args.ny, ncr))
+    tref, mref = time_kernel(lambda f: lacosmic_fullframe(f, noise_model, satpix), (sciframe,), args.repeat)
+    kernels = [('arcosmic 1 thread', lambda f: arcosmic.detect(f, noise_model, satpix=satpix, nthreads=1)),
+               ('arcosmic {0:d} threads'.format(ncpus),
+                lambda f: arcosmic.detect(f, noise_model, satpix=satpix, nthreads=ncpus)),
+               ('slitonly {0:d} threads'.format(ncpus), lambda f: slitonly(f, ncpus))]
+    print("{0:24s} {1:>10s} {2:>8s} {3:>10s}".format('kernel', 'time', 'speedup', 'identical'))
+    print("{0:24s} {1:9.2f}s {2:8.2f} {3:>10s}".format('full frame (reference)', tref, 1.0, 'True'))
+    for name, func in kernels:
+        tt, mask = time_kernel(func, (sciframe,), args.repeat)
+        if name.startswith('slitonly'):
+            # Only the pixels in the slit are searched
+            ident = np.array_equal(mask[slitpix > 0], mref[slitpix > 0])
+        else:
+            ident = np.array_equal(mask, mref)
+        print("{0:24s} {1:9.2f}s {2:8.2f} {3:>10s}".format(name, tt, tref/tt, str(ident)))
+
+
+def main(args):
+    from pypit import pyputils
+    msgs = pyputils.get_dummy_logger()
+
+    if args.kernel == 'comb':
+        bench_comb(args)
+    elif args.kernel == 'lacosmic':
+        bench_lacosmic(args)
+    else:
+        msgs.error("Please specify a kernel to benchmark")
@@ -38,6 +38,11 @@ def parser(options=None):
     parser.add_argument("pypit_file", type=str, help="PYPIT reduction file (must have .pypit extension)")
     parser.add_argument("-v", "--verbosity", type=int, default=2, help="(2) Level of verbosity (0-2)")
     parser.add_argument("-m", "--use_masters", default=False, action='store_true', help="Load previously generated MasterFrames")
+    parser.add_argument("-r", "--resume", default=False, action='store_true',
+                        help="Resume a previous reduction, skipping the completed exposures and stages")
+    parser.add_argument("-w", "--watch", type=float, default=None, metavar='INTERVAL',
+                        help="Observing mode: reduce the new science frames as they arrive, "
+                             "looking for new files every INTERVAL seconds")
     parser.add_argument("-d", "--develop", default=False, action='store_true', help="Turn develop debugging on")
     parser.add_argument("--debug_arc", default=False, action='store_true', help="Turn wavelength/arc debugging on")
     #parser.add_argument("-q", "--quick", default=False, help="Quick reduction", action="store_true")
@@ -79,11 +84,13 @@ def main(args):
     # Execute the reduction, and catch any bugs for printout
     if debug['develop']:
         pypit.PYPIT(args.pypit_file, progname=pypit.__file__, quick=qck, ncpus=cpu, verbosity=args.verbosity,
-              use_masters=args.use_masters, logname=logname, debug=debug)
+              use_masters=args.use_masters, logname=logname, debug=debug,
+              resume=args.resume, watch=args.watch)
     else:
         try:
             pypit.PYPIT(args.pypit_file, progname=pypit.__file__, quick=qck, ncpus=cpu, verbosity=args.verbosity,
-                  use_masters=args.use_masters, logname=logname, debug=debug)
+                  use_masters=args.use_masters, logname=logname, debug=debug,
+                  resume=args.resume, watch=args.watch)
         except:
             # There is a bug in the code, print the file and line number of the error.
             et, ev, tb = sys.exc_info()
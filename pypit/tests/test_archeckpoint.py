@@ -0,0 +1,57 @@
+# Module to run tests on archeckpoint
+
+### TEST_UNICODE_LITERALS
+
+import os
+import numpy as np
+import pytest
+
+from pypit import pyputils
+msgs = pyputils.get_dummy_logger()
+from pypit import arparse as settings
+from pypit import archeckpoint
+from pypit import arutils
+
+
+def dummy_exposure(tmpdir):
+    """ A science exposure whose raw files exist
+    """
+    class Exposure(object):
+        pass
+
+    filenames = ['sci.fits', 'std.fits', 'bias.fits', 'arc.fits', 'flat.fits']
+    for filename in filenames:
+        tmpdir.join(filename).write(filename)
+    slf = Exposure()
+    slf._basename = 'Dummy_kastb_2015Jan23T001111.04'
+    slf._fitsdict = dict(directory=[str(tmpdir)+'/']*5, filename=filenames)
+    slf._idx_sci, slf._idx_std = [0], [1]
+    slf._idx_bias, slf._idx_arcs = [2], [3]
+    slf._idx_trace = slf._idx_flat = [4]
+    return slf
+
+
+def test_checkpoint(tmpdir):
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    settings.argflag['run']['directory']['science'] = str(tmpdir.join('Science'))
+    slf = dummy_exposure(tmpdir)
+    sky = dict(bgframe=np.ones((5, 5)))
+    archeckpoint.save_checkpoint(slf, 'skymodel', 1, sky)
+    assert os.path.exists(archeckpoint.checkpoint_name(slf, 'skymodel', 1) + '.done')
+    # Checkpoints are only used when resuming
+    assert archeckpoint.load_checkpoint(slf, 'skymodel', 1) is None
+    settings.argflag['run']['resume'] = True
+    assert np.array_equal(archeckpoint.load_checkpoint(slf, 'skymodel', 1)['bgframe'], sky['bgframe'])
+    assert archeckpoint.load_checkpoint(slf, 'objtrace', 1) is None
+    # A checkpoint is out of date once the settings change
+    settings.argflag['reduce']['skysub']['perform'] = not settings.argflag['reduce']['skysub']['perform']
+    assert archeckpoint.load_checkpoint(slf, 'skymodel', 1) is None
+    settings.argflag['reduce']['skysub']['perform'] = not settings.argflag['reduce']['skysub']['perform']
+    # Completed exposures are skipped (and their checkpoints removed), until a raw frame changes
+    assert not archeckpoint.exposure_done(slf)
+    archeckpoint.mark_exposure_done(slf)
+    assert archeckpoint.exposure_done(slf)
+    assert not os.path.exists(archeckpoint.checkpoint_name(slf, 'skymodel', 1))
+    tmpdir.join('arc.fits').write('a new arc frame')
+    assert not archeckpoint.exposure_done(slf)
+    settings.argflag['run']['resume'] = False
@@ -0,0 +1,98 @@
+# Module to run tests on arcomb
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from pypit import pyputils
+msgs = pyputils.get_dummy_logger()
+from pypit import arparse as settings
+from pypit import arutils
+from pypit import arcomb
+
+
+def test_comb_frames_tiles():
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    np.random.seed(1234)
+    frames = np.random.normal(1000., 30., (301, 200, 7))
+    frames[np.random.uniform(size=frames.shape) < 0.01] = 70000.
+    # Whole stack at once
+    settings.argflag['reduce']['combine']['tilesize'] = 0.
+    settings.argflag['run']['ncpus'] = 1
+    comb = arcomb.comb_frames(frames.copy(), 1, 'bias')
+    # Strips of rows on several threads
+    settings.argflag['reduce']['combine']['tilesize'] = 0.3
+    settings.argflag['run']['ncpus'] = 4
+    tcomb = arcomb.comb_frames(frames.copy(), 1, 'bias')
+    assert np.array_equal(comb, tcomb)
+
+
+def test_kernel_threads():
+    from pypit import arcycomb
+    np.random.seed(1234)
+    frames = np.random.normal(1000., 30., (51, 40, 5))
+    frames[np.random.uniform(size=frames.shape) < 0.05] = 1048577.
+    med = arcycomb.masked_median(frames, 1048577., nthreads=1)
+    tmed = arcycomb.masked_median(frames, 1048577., nthreads=3)
+    assert np.array_equal(med, tmed)
+    mean = arcycomb.masked_weightmean(frames, 1048577., nthreads=1)
+    tmean = arcycomb.masked_weightmean(frames, 1048577., nthreads=3)
+    assert np.array_equal(mean, tmean)
+
+
+def test_lowhigh():
+    from pypit import arcycomb
+    maskvalue = 1048577.
+    frames = np.array([[[5., 1., maskvalue, 4., 2., 3.]]])
+    frames = arcycomb.masked_lowhigh(frames, 1, 2, maskvalue)
+    # Reject the lowest and two highest unmasked values
+    assert np.array_equal(frames[0, 0, :], [maskvalue, maskvalue, maskvalue, maskvalue, 2., 3.])
+
+
+def test_levelclip():
+    import warnings
+    from pypit import arcycomb
+    maskvalue = 1048577.
+    np.random.seed(1234)
+    frames = np.random.normal(1000., 5., (30, 20, 7))
+    frames[np.random.uniform(size=frames.shape) < 0.1] = maskvalue
+    frames[3, 4, :] = maskvalue
+    frames[5, 6, 2] = 2000.
+    frames[7, 8, 3] = 0.
+    for dtype in [np.float64, np.float32]:
+        # NumPy reference: the median and MAD of the unmasked values of each pixel
+        tframes = frames.astype(dtype)
+        masked = np.where(tframes == maskvalue, np.nan, tframes.astype(np.float64))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            med = np.nanmedian(masked, axis=2)[:, :, np.newaxis]
+            std = 1.4826*np.nanmedian(np.abs(masked-med), axis=2)[:, :, np.newaxis]
+        for lolev, hilev in [(3., 3.), (-1., 3.), (2., 0.)]:
+            reject = np.zeros(frames.shape, dtype=bool)
+            with np.errstate(invalid='ignore'):
+                if lolev > 0.:
+                    reject |= masked < med-lolev*std
+                if hilev > 0.:
+                    reject |= masked > med+hilev*std
+            clipped = arcycomb.masked_levelclip(tframes.copy(), lolev, hilev, maskvalue)
+            assert np.array_equal(clipped, np.where(reject, maskvalue, tframes).astype(dtype))
+            assert (clipped[5, 6, 2] == maskvalue) == (hilev > 0.)
+            assert (clipped[7, 8, 3] == maskvalue) == (lolev > 0.)
+
+
+def test_single_precision():
+    from pypit import arload
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    np.random.seed(1234)
+    frames = np.round(np.random.normal(1000., 5., (101, 80, 6)))
+    settings.argflag['run']['ncpus'] = 1
+    comb = arcomb.comb_frames(frames.copy(), 1, 'bias')
+    settings.argflag['reduce']['precision'] = 'single'
+    dtype = arload.frame_dtype('bias')
+    assert dtype == np.float32
+    assert arload.frame_dtype('science') == np.float64
+    scomb = arcomb.comb_frames(frames.astype(dtype), 1, 'bias', dtype=dtype)
+    settings.argflag['reduce']['precision'] = 'double'
+    assert scomb.dtype == np.float32
+    assert np.allclose(comb, scomb, rtol=0., atol=1e-3)
@@ -0,0 +1,66 @@
+# Module to run tests on arcosmic
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from scipy import ndimage, signal
+
+from pypit import pyputils
+msgs = pyputils.get_dummy_logger()
+from pypit import arutils
+from pypit import arcosmic
+
+
+def test_median_filter():
+    np.random.seed(1234)
+    frame = np.random.normal(100., 10., (600, 130))
+    for size in [3, 5, 7]:
+        med = ndimage.median_filter(frame, size=size, mode='mirror')
+        assert np.array_equal(arcosmic.median_filter(frame, size, nthreads=3), med)
+
+
+def test_laplacian_plus():
+    np.random.seed(1234)
+    frame = np.random.normal(100., 10., (51, 40))
+    # Subsample, convolve, clip negative values, and rebin to original size
+    laplkernel = np.array([[0.0, -1.0, 0.0], [-1.0, 4.0, -1.0], [0.0, -1.0, 0.0]])
+    conved = signal.convolve2d(arutils.subsample(frame), laplkernel, mode="same", boundary="symm")
+    lplus = arutils.rebin(conved.clip(min=0.0), np.array(conved.shape)/2.0)
+    assert np.allclose(arcosmic.laplacian_plus(frame), lplus, rtol=0., atol=1e-10)
+
+
+def test_cr_screen():
+    np.random.seed(1234)
+    frame = np.random.normal(0., 1., (4, 9))
+    frame[1, ::2] = 0.
+    frame[2, :] = 0.
+    sigimg = arcosmic.cr_screen(frame, 0.)
+    row = frame[1][frame[1] != 0.]
+    mad = 1.4826*np.median(np.abs(row-np.median(row)))
+    assert np.allclose(sigimg[1], np.abs(frame[1]-np.median(row))/mad)
+    assert np.all(sigimg[2] == 0.)
+
+
+def test_detect():
+    np.random.seed(1234)
+    frame = np.random.normal(200., 15., (200, 150))
+    frame[50, 60] += 5000.
+    frame[120, 30:32] += 3000.
+    frame[150:160, 100:110] = 70000.
+    satpix = frame >= 65000.
+
+    def noise_model(m5):
+        return np.sqrt(np.abs(m5) + 16.)
+
+    crmask = arcosmic.detect(frame, noise_model, satpix=satpix)
+    assert crmask[50, 60] and crmask[120, 30] and crmask[120, 31]
+    assert not np.any(crmask[satpix])
+    # Limited to the slits
+    slitpix = np.zeros(frame.shape, dtype=int)
+    slitpix[:, 50:70] = 1
+    region = arcosmic.slit_region(slitpix)
+    assert region == (slice(0, 200), slice(34, 86))
+    slitmask = arcosmic.detect(frame[region], noise_model, satpix=satpix[region])
+    assert np.array_equal(slitmask[:, 16:-16], crmask[:, 50:70])
@@ -41,6 +41,18 @@ def test_find_standard():
     assert std_dict is None
 
 
+def test_find_standard_files():
+    from pypit import arflux as arflx
+    # G191b2b, near G191b2b, and Feige 34
+    radecs = [('05:06:36.6', '52:52:01.0'), ('05:06:36.6', '52:22:01.0'), ('10:39:36.7', '43:06:10.1')]
+    assert arflx.find_standard_files(radecs, check=True) == [True, False, True]
+    std_dicts = arflx.find_standard_files(radecs)
+    assert std_dicts[0]['name'] == 'G191B2B'
+    assert std_dicts[1] is None
+    # The catalogue is only loaded once
+    assert arflx.load_calspec()[1] is arflx.load_calspec()[1]
+
+
 def test_load_extinction():
     from pypit import arflux as arflx
     # Dummy self
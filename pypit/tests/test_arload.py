@@ -29,6 +29,34 @@ def test_load_headers():
     assert headers[0][0]['OBJECT'] == 'Arcs'
 
 
+def test_header_index(tmpdir):
+    from pypit import arparse as settings
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    settings.argflag['run']['redname'] = str(tmpdir.join('test.pypit'))
+    kast_files = [data_path('b1.fits.gz'), data_path('b27.fits.gz')]
+    fitsdict = arl.load_headers(kast_files)
+    assert os.path.isfile(str(tmpdir.join('test.hindex')))
+    # Reload from the index
+    ifitsdict = arl.load_headers(kast_files)
+    for key in fitsdict.keys():
+        if key == 'headers':
+            continue
+        assert fitsdict[key].dtype == ifitsdict[key].dtype
+        assert np.array_equal(fitsdict[key], ifitsdict[key])
+    assert ifitsdict['headers'][1][0]['OBJECT'] == 'J1217p3905'
+
+
+def test_read_header_cards():
+    from astropy.io import fits
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    kast_file = data_path('b1.fits.gz')
+    cards = arl.read_header_cards(kast_file, [0])[0]
+    head = fits.getheader(kast_file)
+    for key in ['OBJECT', 'TSEC', 'NAXIS1', 'DATE', 'EXPTIME']:
+        assert cards[key] == head[key]
+        assert type(cards[key]) == type(head[key])
+
+
 def test_load_1dspec():
     from linetools.spectra.xspectrum1d import XSpectrum1D
 
@@ -44,3 +72,149 @@ def test_load_1dspec():
     assert isinstance(spec2, XSpectrum1D)
 
 
+def test_load_frames():
+    from pypit import arparse as settings
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    kast_files = [data_path('b1.fits.gz'), data_path('b27.fits.gz')]
+    fitsdict = arl.load_headers(kast_files)
+    # Serial
+    settings.argflag['run']['ncpus'] = 1
+    frames = arl.load_frames(fitsdict, [0, 1], 1, frametype='arc', msbias='overscan')
+    assert frames.shape[2] == 2
+    # Threaded
+    settings.argflag['run']['ncpus'] = 2
+    tframes = arl.load_frames(fitsdict, [0, 1], 1, frametype='arc', msbias='overscan')
+    assert np.array_equal(frames, tframes)
+
+
+def test_load_frames_error(monkeypatch):
+    """ An error reading a frame on a worker thread reaches the caller
+    """
+    from pypit import arparse as settings
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    kast_files = [data_path('b1.fits.gz'), data_path('b27.fits.gz'), data_path('b1.fits.gz')]
+    fitsdict = arl.load_headers(kast_files)
+    load_raw_frame = arl.load_raw_frame
+
+    def fail_raw_frame(fitsdict, idx, det, **kwargs):
+        if idx == 1:
+            msgs.error("Could not read the frame")
+        return load_raw_frame(fitsdict, idx, det, **kwargs)
+
+    monkeypatch.setattr(arl, 'load_raw_frame', fail_raw_frame)
+    settings.argflag['run']['ncpus'] = 2
+    with pytest.raises(SystemExit):
+        arl.load_frames(fitsdict, [0, 1, 2], 1, frametype='arc', msbias='overscan')
+
+
+def test_load_compressed(tmpdir):
+    from astropy.io import fits
+    from pypit import arparse as settings
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    # Write an fpack-style (Rice tile compressed) copy of a raw frame
+    with fits.open(data_path('b1.fits.gz')) as hdulist:
+        hdu = fits.CompImageHDU(hdulist[0].data, header=hdulist[0].header)
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(str(tmpdir.join('b1.fits.fz')))
+    fitsdict = arl.load_headers([data_path('b1.fits.gz'), str(tmpdir.join('b1.fits.fz'))])
+    assert fitsdict['target'][0] == fitsdict['target'][1]
+    settings.argflag['run']['ncpus'] = 1
+    oframes = arl.load_frames(fitsdict, [0, 1], 1, frametype='arc', msbias='overscan')
+    assert np.array_equal(oframes[:, :, 0], oframes[:, :, 1])
+    # Decompress the data sections only
+    msbias = np.ones(arl.load_frames(fitsdict, [0], 1, frametype='bias').shape[:2])
+    frames = arl.load_frames(fitsdict, [0, 1], 1, frametype='arc', msbias=msbias)
+    assert np.array_equal(frames[:, :, 0], frames[:, :, 1])
+    # Decompress a strip of rows at a time
+    settings.argflag['reduce']['memmap'] = True
+    stack = arl.load_frames(fitsdict, [0, 1], 1, frametype='arc', msbias='overscan', memmap=True)
+    assert np.array_equal(stack.read_rows(10, 50), oframes[10:50, :, :])
+    stack.close()
+    # Raw frames of different sizes
+    with fits.open(data_path('b1.fits.gz')) as hdulist:
+        fits.PrimaryHDU(hdulist[0].data, header=hdulist[0].header).writeto(str(tmpdir.join('b1.fits')))
+        fits.PrimaryHDU(hdulist[0].data[:, :-10], header=hdulist[0].header).writeto(str(tmpdir.join('b2.fits')))
+    fitsdict = arl.load_headers([str(tmpdir.join('b1.fits')), str(tmpdir.join('b2.fits'))])
+    with pytest.raises(SystemExit):
+        arl.load_frames(fitsdict, [0, 1], 1, frametype='arc', msbias='overscan', memmap=True)
+    settings.argflag['reduce']['memmap'] = False
+
+
+def test_preprocess_frame():
+    from astropy.io import fits
+    from pypit import arparse as settings
+    from pypit import arproc
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    settings.spect['det01']['gain'] = [1.2, 1.5]
+    raw = fits.getdata(data_path('b1.fits.gz'))
+    if settings.argflag['trace']['dispersion']['direction'] == 1:
+        raw = raw.T
+    # Subtract the overscan, trim and apply the gain one step at a time
+    frame = raw.astype(np.float64)
+    arproc.sub_overscan(frame, 1)
+    frame = arproc.trim(frame, 1)
+    frame[:, :1024] *= 1.2
+    frame[:, 1024:] *= 1.5
+    # In a single pass
+    pframe = arproc.preprocess_frame(raw, 1, msbias='overscan', gain=True)
+    assert np.allclose(frame, pframe, rtol=1e-12, atol=0.)
+    # A strip of rows
+    strip = arproc.preprocess_frame(raw, 1, msbias='overscan', gain=True, rows=(100, 300))
+    assert np.array_equal(strip, pframe[100:300, :])
+
+
+def test_master_bundle(tmpdir):
+    """ Save master frames to a single HDF5 file, and load (sections of) them
+    """
+    import json
+    from pypit import arparse as settings
+    from pypit import armasters
+    from pypit import arsave
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    settings.argflag['reduce']['masters']['format'] = 'hdf5'
+    filename = armasters.master_name('tilts', 'A_01_aa', mdir=str(tmpdir))
+    settings.argflag['reduce']['masters']['format'] = 'fits'
+    assert filename.endswith('Masters_A_01_aa.hdf5')
+    tilts = np.random.uniform(size=(300, 200))
+    trace = np.ones((300, 200))
+    edges = np.arange(600.).reshape(300, 2)
+    arsave.save_master_bundle(None, [dict(ftype='tilts', data=tilts, frametype='tilts', keywds=dict(PYPKEY='abc')),
+                                     dict(ftype='trace', data=trace, frametype='trace', extensions=[edges],
+                                          names=['LeftEdges_det'])], filename)
+    # Replace one master frame, and keep the others
+    arsave.save_master_bundle(None, [dict(ftype='wave_calib', json=json.dumps(dict(fitc=[1., 2.])))], filename)
+    assert len(tmpdir.listdir()) == 1
+    data, head = arl.load_master(filename, frametype='tilts')
+    assert np.array_equal(data, tilts)
+    assert head['PYPKEY'] == 'abc'
+    assert arl.load_master_header(filename, frametype='tilts')['FRAMETYP'] == 'tilts'
+    # The tilts of one slit
+    data, head = arl.load_master(filename, frametype='tilts', section=(slice(None), slice(50, 80)))
+    assert np.array_equal(data, tilts[:, 50:80])
+    data, head = arl.load_master(filename, exten=1, frametype='trace')
+    assert np.array_equal(data, edges)
+    assert arl.load_master(filename, frametype='wv_calib')['fitc'] == [1., 2.]
+    with pytest.raises(IOError):
+        arl.load_master(filename, frametype='arc')
+
+
+def test_load_master_frame_bundle(tmpdir):
+    """ Reuse a master frame saved to an HDF5 bundle
+    """
+    from pypit import arparse as settings
+    from pypit import armasters
+    from pypit import arsave
+    arutils.dummy_settings(spectrograph='kast_blue')
+    settings.argflag['reduce']['masters']['format'] = 'hdf5'
+    slf = arutils.dummy_self()
+    # The raw frames are identified by the checksums of their files
+    for name in slf._fitsdict['filename']:
+        tmpdir.join(name).write(name)
+    slf._fitsdict['directory'] = [str(tmpdir)+'/']*len(slf._fitsdict['filename'])
+    filename = armasters.master_name('arc', 'A_01_aa', mdir=str(tmpdir))
+    arc = np.random.uniform(size=(300, 200))
+    arsave.save_master_bundle(slf, [dict(ftype='arc', data=arc, frametype='arc',
+                                         keywds=armasters.master_provenance(slf, 'arc', 1))], filename)
+    head = slf.LoadMasterFrame('arc', 1, name=filename)
+    settings.argflag['reduce']['masters']['format'] = 'fits'
+    assert head['FRAMETYP'] == 'arc'
+    assert np.array_equal(slf.GetMasterFrame('arc', 1), arc)
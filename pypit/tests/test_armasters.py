@@ -27,3 +27,125 @@ def test_master_name():
             exten = 'fits'
         assert armasters.master_name(itype, '01', mdir='MasterFrames') == 'MasterFrames/Master{:s}_01.{:s}'.format(isuff,exten)
 
+
+def test_master_store():
+    """ Test sharing, read-only frames and spilling to disk
+    """
+    import numpy as np
+    store = armasters.MasterStore(cachesize=1.5)
+    bias = np.ones((512, 512))  # 2 MB
+    ref = store.put('bias', bias)
+    assert 'bias' in store
+    assert np.shares_memory(ref.get(), bias)
+    assert not ref.get().flags.writeable
+    # The flags of the caller's frame are unchanged
+    assert bias.flags.writeable
+    # An identical frame is not stored twice
+    store.put('bias', np.zeros((512, 512)))
+    assert np.all(store.get('bias') == 1.)
+    # The least recently used frame is spilled to disk, and memory mapped when requested
+    arc = np.zeros((512, 512))
+    slots = armasters.MasterSlots([None, None])
+    slots[0] = store.put('arc', arc)
+    assert np.shares_memory(slots[0], arc)
+    spilled = store.get('bias')
+    assert isinstance(spilled, np.memmap)
+    assert not spilled.flags.writeable
+    assert np.all(spilled == 1.)
+    assert slots[1] is None
+    store.clear()
+    assert 'arc' not in store
+
+
+def test_master_key():
+    """ Test that the master keys follow the inputs of each frame
+    """
+    from pypit import arparse as settings
+    from pypit import arutils
+
+    class Exposure(object):
+        pass
+
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    slfa, slfb = Exposure(), Exposure()
+    for slf in [slfa, slfb]:
+        slf._idx_bias = [0, 1, 2]
+        slf._idx_arcs = [3]
+        slf._idx_trace = [4, 5]
+    slfb._idx_bias = [0, 1]
+    assert armasters.master_key(slfa, 'trace', 1) == armasters.master_key(slfa, 'trace', 1)
+    assert armasters.master_key(slfa, 'trace', 1) != armasters.master_key(slfa, 'trace', 2)
+    # The arc frames are the same, but the bias frames are not
+    assert armasters.master_key(slfa, 'arc', 1) != armasters.master_key(slfb, 'arc', 1)
+    slfb._idx_bias = [0, 1, 2]
+    assert armasters.master_key(slfa, 'wave', 1) == armasters.master_key(slfb, 'wave', 1)
+    # Settings used to build the frame
+    key = armasters.master_key(slfa, 'arc', 1)
+    settings.argflag['arc']['combine']['method'] = 'median'
+    assert armasters.master_key(slfa, 'arc', 1) != key
+
+
+def test_master_provenance(tmpdir):
+    """ Test that a master frame on disk goes out of date with its inputs
+    """
+    from astropy.io import fits
+    from pypit import arparse as settings
+    from pypit import arutils
+
+    class Exposure(object):
+        pass
+
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    filenames = ['bias1.fits', 'bias2.fits', 'arc1.fits']
+    for filename in filenames:
+        tmpdir.join(filename).write(filename)
+    slf = Exposure()
+    slf._fitsdict = dict(directory=[str(tmpdir)+'/']*3, filename=filenames)
+    slf._idx_bias = [0, 1]
+    slf._idx_arcs = [2]
+    # Write the provenance to a header, as is done when saving the master frames
+    head = fits.Header()
+    for key, value in armasters.master_provenance(slf, 'arc', 1).items():
+        head[key] = value
+    assert head['FMD5001'] == armasters.file_checksum(str(tmpdir.join('arc1.fits')))
+    assert armasters.master_uptodate(slf, 'arc', 1, head)
+    # Settings that are not used to build the arc frame
+    settings.argflag['trace']['combine']['method'] = 'median'
+    assert armasters.master_uptodate(slf, 'arc', 1, head)
+    # A raw frame of a master frame that the arc depends on
+    tmpdir.join('bias2.fits').write('a new bias frame')
+    assert not armasters.master_uptodate(slf, 'arc', 1, head)
+    # Older master frames have no provenance
+    assert not armasters.master_uptodate(slf, 'arc', 1, fits.Header())
+
+
+def test_master_store_register(tmpdir):
+    """ Test master frames that are read from disk when needed
+    """
+    import numpy as np
+    from astropy.io import fits
+    from pypit import arutils
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    filename = str(tmpdir.join('MasterArc_A_01.fits'))
+    fits.PrimaryHDU(np.arange(512*512.).reshape(512, 512)).writeto(filename)
+    nread = []
+
+    def loader():
+        nread.append(1)
+        return armasters.master_loader(filename, 'arc')()
+
+    store = armasters.MasterStore(cachesize=1.5)
+    slots = armasters.MasterSlots([None])
+    slots[0] = store.register('arc', loader)
+    assert 'arc' in store
+    assert len(nread) == 0
+    # Read when first used, and then held in memory
+    assert slots[0][1, 0] == 512.
+    assert not slots[0].flags.writeable
+    assert slots[0][1, 1] == 513.
+    assert len(nread) == 1
+    # Released from memory (not spilled to disk) when the store is full, and read again
+    store.put('bias', np.zeros((512, 512)))
+    assert store._spilldir is None
+    assert slots[0][1, 0] == 512.
+    assert len(nread) == 2
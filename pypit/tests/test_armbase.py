@@ -25,3 +25,76 @@ def test_update_masters():
     #  Not actually filling anything
     armb.UpdateMasters(sciexp, 0, 1, 'arc')
 
+
+def test_detector_state():
+    import pickle
+    from pypit import arparse as settings
+    from pypit import armasters
+    arut.dummy_settings(spectrograph='kast_blue', set_idx=True)
+    store = armasters.MasterStore()
+    slf = arut.dummy_self()
+    slf._store = store
+    slf.SetMasterFrame(np.ones((10, 10)), 'bias', 1)
+    slf._specobjs[0] = ['obj']
+    # Return the products of the detector through a pickle, as a process pool does
+    state = pickle.loads(pickle.dumps(armb.detector_state([None, slf], 1)))
+    settings.argflag['reduce']['masters']['loaded'] = []
+    nslf = arut.dummy_self()
+    nslf._store = store
+    armb.merge_detector_state([None, nslf], 1, state)
+    assert nslf._specobjs[0] == ['obj']
+    assert isinstance(nslf._msbias.ref(0), armasters.MasterRef)
+    assert np.array_equal(nslf._msbias[0], np.ones((10, 10)))
+
+
+def test_schedule_exposures(tmpdir):
+    import os
+    from pypit import arparse as settings
+    arut.dummy_settings(spectrograph='kast_blue', set_idx=True)
+    settings.argflag['run']['ncpus'] = 2
+    settings.argflag['run']['retries'] = 1
+    sciexp = []
+    for sc in range(4):
+        slf = arut.dummy_self()
+        slf._nspec[0], slf._nspat[0] = 100, 100
+        sciexp.append(slf)
+    assert armb.exposure_memory(sciexp[0]) == armb._sciframes_inmem * 100 * 100 * 8
+    # Only one exposure fits in memory at a time
+    settings.argflag['run']['memory'] = 1.5 * armb.exposure_memory(sciexp[0]) / 1024**2
+
+    def reduce_exposure(sc):
+        # Exposure 1 fails on its first attempt, and exposure 2 always fails
+        attempt = str(tmpdir.join('attempt{0:d}'.format(sc)))
+        first = not os.path.exists(attempt)
+        open(attempt, 'w').close()
+        if sc == 2 or (sc == 1 and first):
+            msgs.error("Failed")
+
+    status = armb.schedule_exposures(sciexp, reduce_exposure)
+    assert [stat['state'] for stat in status] == ['done', 'done', 'failed', 'done']
+    assert [stat['attempts'] for stat in status] == [1, 2, 2, 1]
+    assert sciexp[0] is None
+    assert sciexp[2] is not None
+    settings.argflag['run']['memory'] = 0.
+
+
+def test_schedule_exposures_serial(monkeypatch):
+    import types
+    from pypit import arparse as settings
+    arut.dummy_settings(spectrograph='kast_blue', set_idx=True)
+    settings.argflag['run']['retries'] = 1
+    sciexp = [arut.dummy_self() for sc in range(3)]
+    # Without process contexts (Python 2.7), the exposures are reduced in this process
+    monkeypatch.setattr(armb, 'multiprocessing', types.ModuleType(str('multiprocessing')))
+    attempts = []
+
+    def reduce_exposure(sc):
+        attempts.append(sc)
+        if sc == 1:
+            msgs.error("Failed")
+
+    status = armb.schedule_exposures(sciexp, reduce_exposure)
+    assert attempts == [0, 1, 2, 1]
+    assert [stat['state'] for stat in status] == ['done', 'failed', 'done']
+    assert sciexp[0] is None
+    assert sciexp[1] is not None
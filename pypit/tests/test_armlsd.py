@@ -11,3 +11,83 @@ msgs = pyputils.get_dummy_logger()
 #def data_path(filename):
 #    data_dir = os.path.join(os.path.dirname(__file__), 'files')
 #    return os.path.join(data_dir, filename)
+
+
+def test_reduce_detectors(monkeypatch):
+    import copy
+    from pypit import arparse as settings
+    from pypit import armasters
+    from pypit import armlsd
+    from pypit import arutils as arut
+
+    def reduce_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster):
+        import os
+        slf = sciexp[sc]
+        slf._specobjs[det-1] = [os.getpid()]
+        slf.SetMasterFrame(np.full((5, 5), float(det)), 'bias', det)
+        settings.argflag['reduce']['masters']['setup'] = 'A_{0:02d}_aa'.format(det)
+        return True
+
+    monkeypatch.setattr(armlsd, 'reduce_detector', reduce_detector)
+    arut.dummy_settings(spectrograph='kast_blue', set_idx=True)
+    settings.spect['mosaic']['ndet'] = 2
+    settings.spect['det02'] = copy.deepcopy(settings.spect['det01'])
+    slf = arut.dummy_self()
+    slf._store = armasters.MasterStore()
+    settings.argflag['run']['detpool'] = True
+    settings.argflag['run']['ncpus'] = 2
+    assert armlsd.reduce_detectors([slf], 0, None, {}, False)
+    # Each detector was reduced in a separate process
+    assert slf._specobjs[0] != slf._specobjs[1]
+    assert np.all(slf._msbias[1] == 2.)
+    assert settings.argflag['reduce']['masters']['setup'] == 'A_02_aa'
+    settings.spect['mosaic']['ndet'] = 1
+    settings.argflag['run']['detpool'] = False
+
+
+def test_reduce_detectors_preponly(monkeypatch):
+    """ Only the calibrations are prepared with run preponly
+    """
+    from pypit import arparse as settings
+    from pypit import armlsd
+    from pypit import arutils as arut
+
+    def reduce_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster):
+        return not settings.argflag['run']['preponly']
+
+    monkeypatch.setattr(armlsd, 'reduce_detector', reduce_detector)
+    arut.dummy_settings(spectrograph='kast_blue', set_idx=True)
+    slf = arut.dummy_self()
+    settings.argflag['run']['preponly'] = True
+    assert not armlsd.reduce_detectors([slf], 0, None, {}, False)
+    settings.argflag['run']['preponly'] = False
+    assert armlsd.reduce_detectors([slf], 0, None, {}, False)
+
+
+def test_reduce_detectors_serial(monkeypatch):
+    """ The detectors are reduced in turn where processes cannot be forked
+    """
+    import copy
+    import os
+    import types
+    from pypit import arparse as settings
+    from pypit import armlsd
+    from pypit import arutils as arut
+
+    def reduce_detector(sciexp, sc, det, fitsdict, setup_dict, reuseMaster):
+        sciexp[sc]._specobjs[det-1] = [os.getpid()]
+        return True
+
+    monkeypatch.setattr(armlsd, 'reduce_detector', reduce_detector)
+    # Python 2.7 has no process contexts
+    monkeypatch.setattr(armlsd, 'multiprocessing', types.ModuleType(str('multiprocessing')))
+    arut.dummy_settings(spectrograph='kast_blue', set_idx=True)
+    settings.spect['mosaic']['ndet'] = 2
+    settings.spect['det02'] = copy.deepcopy(settings.spect['det01'])
+    slf = arut.dummy_self()
+    settings.argflag['run']['detpool'] = True
+    settings.argflag['run']['ncpus'] = 2
+    assert armlsd.reduce_detectors([slf], 0, None, {}, False)
+    assert slf._specobjs[0] == slf._specobjs[1] == [os.getpid()]
+    settings.spect['mosaic']['ndet'] = 1
+    settings.argflag['run']['detpool'] = False
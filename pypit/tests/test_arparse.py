@@ -49,3 +49,22 @@ def test_parse_binning():
     bin1, bin2 = arparse.parse_binning((2,2))   # String output required so this returns 1,1 (the default)
     assert bin1 == 1
     assert bin2 == 1
+
+
+def test_frozen_settings():
+    """ Test the immutable copy of the settings
+    """
+    argf = arparse.get_argflag_class(('ARMLSD', ''))
+    argf.init_param()
+    frozen = arparse.FrozenSettings(argf._argflag)
+    assert frozen['reduce']['trim'] == True
+    # Two copies of the same settings are equal, and have the same hash
+    argf2 = arparse.get_argflag_class(('ARMLSD', ''))
+    argf2.init_param()
+    assert arparse.FrozenSettings(argf2._argflag) == frozen
+    assert len(set([frozen, arparse.FrozenSettings(argf2._argflag)])) == 1
+    argf2.set_param('run ncpus 3')
+    assert arparse.FrozenSettings(argf2._argflag) != frozen
+    with pytest.raises(TypeError):
+        frozen['reduce']['trim'] = False
+    assert frozen.thaw() == argf._argflag
@@ -0,0 +1,59 @@
+# Module to run tests on arproc
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import os
+import pytest
+
+from pypit import pyputils
+msgs = pyputils.get_dummy_logger()
+from pypit import arparse as settings
+from pypit import arutils
+from pypit import arproc
+
+
+def data_path(filename):
+    data_dir = os.path.join(os.path.dirname(__file__), 'files')
+    return os.path.join(data_dir, filename)
+
+
+@pytest.mark.parametrize('method,params', [('savgol', [5, 65]), ('polynomial', [3]), ('median', [])])
+def test_overscan_models(method, params):
+    from astropy.io import fits
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    settings.argflag['reduce']['overscan']['method'] = method
+    settings.argflag['reduce']['overscan']['params'] = params
+    frames = [fits.getdata(data_path(fil)) for fil in ['b1.fits.gz', 'b27.fits.gz']]
+    timing = []
+    models = arproc.overscan_models(frames, 1, timing=timing)
+    assert len(timing) == settings.spect['det01']['numamplifiers']
+    # Fitting all frames together gives the same model as fitting each frame
+    for frame, model in zip(frames, models):
+        for (xds, yds, ossub), (sxds, syds, sossub) in zip(model, arproc.overscan_model(frame, 1)):
+            assert np.array_equal(xds, sxds) and np.array_equal(yds, syds)
+            assert np.allclose(ossub, sossub, rtol=1e-12, atol=0.)
+
+
+def test_flatfield_precision():
+    """ A normalised pixel flat stored in single precision changes the
+    flat-fielded science frame by less than 1e-7 (fractional)
+    """
+    from pypit import arload
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=True)
+    np.random.seed(1234)
+    sciframe = np.random.normal(5000., 100., (200, 150))
+    normflat = np.random.normal(1., 0.02, (200, 150))
+    flatfielded = {}
+    for precision in ['double', 'single']:
+        settings.argflag['reduce']['precision'] = precision
+        slf = arutils.dummy_self()
+        slf.SetMasterFrame(normflat, 'normpixelflat', 1)
+        assert slf._mspixelflatnrm[0].dtype == arload.frame_dtype('normpixelflat')
+        flatfielded[precision] = arproc.flatfield(slf, sciframe, slf._mspixelflatnrm[0], 1)
+        # The science frame remains in double precision
+        assert flatfielded[precision].dtype == np.float64
+    settings.argflag['reduce']['precision'] = 'double'
+    assert slf._mspixelflatnrm[0].dtype == np.float32
+    reldiff = np.abs(flatfielded['single']/flatfielded['double'] - 1.)
+    assert np.max(reldiff) < 1e-7
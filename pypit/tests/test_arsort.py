@@ -101,3 +101,60 @@ def test_instr_setup(fitsdict):
     setupID3 = arsort.instr_setup(sciexp1, 1, fitsdict, setup_dict)
     assert setupID3 == 'A_01_ab'
     assert setup_dict['A']['ab']['arcs'][0] == 'b009.fits'
+
+
+def test_sort_cache(fitsdict, tmpdir):
+    """ Test the persistent sorting cache
+    """
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    settings.argflag['run']['setup'] = True  # Over-ride default numbers
+    settings.argflag['run']['redname'] = str(tmpdir.join('test.pypit'))
+    cache_file = arsort.sort_cache_file()
+    assert cache_file == str(tmpdir.join('test.scache'))
+    assert arsort.load_sort_cache(cache_file, fitsdict) is None
+    # Sort and match, recording the standard star checks
+    standards = {}
+    filesort = arsort.sort_data(fitsdict, standards=standards)
+    assert standards['./b004.fits'] and not standards['./b005.fits']
+    arsort.match_science(fitsdict, filesort)
+    arsort.save_sort_cache(cache_file, fitsdict, filesort, {'A': {}}, standards)
+    cache = arsort.load_sort_cache(cache_file, fitsdict)
+    assert np.array_equal(cache['filesort']['standard'], filesort['standard'])
+    assert np.array_equal(cache['index']['arc'][1], settings.spect['arc']['index'][1])
+    assert cache['setup_dict'] == {'A': {}}
+    # The settings that are updated during a reduction do not change the hash
+    settings.spect['det01']['datasec01'] = [[0, 10], [0, 10]]
+    assert 'filesort' in arsort.load_sort_cache(cache_file, fitsdict)
+    # With different settings (as loaded), only the standard star checks are reused
+    settings.spect['arc']['number'] = 2
+    settings.spect_loaded = settings.FrozenSettings(settings.spect)
+    cache = arsort.load_sort_cache(cache_file, fitsdict)
+    assert 'filesort' not in cache
+    cache['standards']['./b004.fits'] = False
+    filesort = arsort.sort_data(fitsdict, standards=cache['standards'])
+    assert 4 not in filesort['standard']
+    # A cache that cannot be written is skipped
+    cache_file = str(tmpdir.join('missing', 'test.scache'))
+    arsort.save_sort_cache(cache_file, fitsdict, filesort, {'A': {}}, standards)
+    assert not tmpdir.join('missing').check()
+
+
+def test_match_calibs(fitsdict):
+    """ Test the indexed matching of calibration frames
+    """
+    arutils.dummy_settings(spectrograph='kast_blue', set_idx=False)
+    values = np.array([0.1, 0.5, 1.0, 2.0])
+    assert np.array_equal(arsort.match_mask(values, 0.6, '|<=0.5'), [True, True, True, False])
+    assert np.array_equal(arsort.match_mask(values, 0.5, '<0.5'), [True, True, False, False])
+    assert np.array_equal(arsort.match_mask(values, 0.5, "''"), [False, True, False, False])
+    # Index the arcs by their setup
+    settings.spect['fits']['calwin'] = 0.
+    settings.spect['arc']['match'] = dict(dispname="''", dichroic="''")
+    fitsdict['dispname'][3] = '452/3306'
+    index = arsort.calib_match_index(fitsdict, 'arc', np.array([3, 1]))
+    assert len(index['groups']) == 2
+    assert np.array_equal(arsort.match_calibs(fitsdict, index, 5), [1])
+    assert np.array_equal(arsort.match_calibs(fitsdict, index, 3), [3])
+    # A malformed condition on a split header keyword is ignored
+    index = dict(groups={(): np.array([1, 3])}, exact=[], other=[('dispname', '%,/')], split={})
+    assert np.array_equal(arsort.match_calibs(fitsdict, index, 3), [1, 3])
@@ -41,3 +41,17 @@ def test_calc_ivar():
     res = arut.calc_ivar(x)
     assert np.array_equal(res, np.array([0.0, 0.0, 0.0, 10.0, 1.0]))
     assert np.array_equal(arut.calc_ivar(res), np.array([0.0, 0.0, 0.0, 0.1, 1.0]))
+
+
+def test_thread_map():
+    """ Results are returned in order, and errors reach the caller
+    """
+    res = arut.thread_map(lambda x: x**2, range(10), 4)
+    assert res == [x**2 for x in range(10)]
+
+    def fail(x):
+        if x == 3:
+            raise ValueError("Bad item")
+        return x
+    with pytest.raises(ValueError):
+        arut.thread_map(fail, range(10), 4)
@@ -0,0 +1,79 @@
+# Module to run tests on arwatch
+
+### TEST_UNICODE_LITERALS
+
+import pytest
+
+from pypit import pyputils
+msgs = pyputils.get_dummy_logger()
+from pypit import arwatch
+
+
+def test_file_watcher(tmpdir):
+    old = str(tmpdir.join('b0001.fits'))
+    open(old, 'w').write('old')
+    watcher = arwatch.FileWatcher([str(tmpdir)+'/*.fits'], skip_files=['b0003.fits'], initial=[old])
+    assert watcher.files == [old]
+    assert watcher.poll() == []
+    # A new file is only accepted once it is no longer changing
+    new = str(tmpdir.join('b0002.fits'))
+    open(new, 'w').write('new')
+    open(str(tmpdir.join('b0003.fits')), 'w').write('skip')
+    assert watcher.poll() == []
+    open(new, 'a').write(' frame')
+    assert watcher.poll() == []
+    assert watcher.poll() == [new]
+    assert watcher.files == [old, new]
+    assert watcher.poll() == []
+
+
+def test_watch(tmpdir):
+    old = str(tmpdir.join('b0001.fits'))
+    open(old, 'w').write('old')
+    watcher = arwatch.FileWatcher([str(tmpdir)+'/*.fits'], initial=[old])
+    passes = []
+
+    def reduce_files(files, new):
+        passes.append((list(files), list(new)))
+        if len(passes) == 1:
+            # A frame arrives during the first reduction
+            open(str(tmpdir.join('b0002.fits')), 'w').write('new')
+        return new
+
+    # The new frame is seen on the first poll, and accepted on the second
+    latency = arwatch.watch(watcher, reduce_files, 0.01, npass=3)
+    new = str(tmpdir.join('b0002.fits'))
+    assert passes == [([old], [old]), ([old, new], [new])]
+    assert sorted(latency.keys()) == [old, new]
+    assert latency[new] >= 0.01
+
+
+def test_watch_error(tmpdir, monkeypatch):
+    from pypit import ardebug
+    from pypit import armsgs
+    # A logger with a log file, as opened by run_pypit
+    logname = str(tmpdir.join('watch.log'))
+    logger = armsgs.Messages(logname, ardebug.init(), 0)
+    monkeypatch.setattr(arwatch, 'msgs', logger)
+    old = str(tmpdir.join('b0001.fits'))
+    open(old, 'w').write('old')
+    watcher = arwatch.FileWatcher([str(tmpdir)+'/*.fits'], initial=[old])
+    passes = []
+
+    def reduce_files(files, new):
+        passes.append(list(new))
+        if len(passes) == 1:
+            open(str(tmpdir.join('b0002.fits')), 'w').write('new')
+            logger.error("The reduction failed")
+        return new
+
+    # The failed reduction does not stop the observing mode
+    latency = arwatch.watch(watcher, reduce_files, 0.01, npass=3)
+    new = str(tmpdir.join('b0002.fits'))
+    assert passes == [[old], [new]]
+    assert list(latency.keys()) == [new]
+    logger.close()
+    log = open(logname).read()
+    assert 'The reduction failed' in log
+    assert 'The new frames could not be reduced' in log
+    assert 'Reduced b0002.fits' in log
@@ -89,6 +89,10 @@ for pyx_file in pyx_files:
         library_dirs=[lib_gsl_dir],
         libraries=["gsl","gslcblas"]
     )
+    # The frame combination kernels are parallelised with OpenMP
+    if pyx_split2[1] == 'arcycomb':
+        ext.extra_compile_args = ['-fopenmp']
+        ext.extra_link_args = ['-fopenmp']
     # Append
     setup_keywords['ext_modules'].append(ext)
 #for pyx_file in pyx_files: